@@ -1,8 +1,4 @@
 from settings.secure import OAUTH_TOKEN, CANVAS_URL, TEST_CANVAS_URL
-from canvas_sdk.methods import courses, users, assignments
-from canvas_sdk.utils import get_all_list_data
-from canvas_sdk.exceptions import CanvasAPIError
-from canvas_sdk import RequestContext
 import sys
 import os.path
 import logging
@@ -12,15 +8,28 @@ import urlparse
 import datetime
 import re
 import csv
-import xlwt
 
-logging.basicConfig() # you need to initialize logging, otherwise you will not see anything from requests
-logging.getLogger().setLevel(logging.DEBUG)
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.DEBUG)
-requests_log.propagate = True
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.imports import lazy_import
+from canvasutils.metrics import METRICS, instrument_request_context
+from canvasutils.logs import LazyJSON, configure_logging, add_logging_arguments
+from canvasutils import canvasdata
+from canvasutils.extsort import ExternalSorter
+from canvasutils.records import PageViewTable, to_json
+from canvasutils.store import EntityStore
+
+# Imported when they're first used, so --help and cached runs start quickly.
+# canvasutils.client and canvasutils.httpcache (which import requests) are
+# imported by the functions that fetch data.
+canvas_sdk = lazy_import('canvas_sdk')
+courses = lazy_import('canvas_sdk.methods.courses')
+assignments = lazy_import('canvas_sdk.methods.assignments')
+xlwt = lazy_import('xlwt')
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+
+# Fields of the page views used by create_page_views_xls()
+PAGE_VIEW_FIELDS = ['id', 'url', 'created_at', 'user_agent', 'interaction_seconds', 'links']
 
 def main():
     # Parse CLI arguments
@@ -29,7 +38,14 @@ def main():
     parser.add_argument('--anonymized_students_csv', type=str, help="CSV file that maps student HUID's to random identifiers to anonymize the data", required=False)
     parser.add_argument('--start_time', type=str, help="Start time ISO 8601 format YYYY-MM-DD.")
     parser.add_argument('--end_time', type=str, help="End time ISO 8601 format YYYY-MM-DD.")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of users whose profiles and page views are fetched at the same time. Defaults to 1.")
+    parser.add_argument('--metrics', type=str, metavar='PREFIX', help="Save request metrics as a JSON summary to PREFIX.json and a Prometheus textfile to PREFIX.prom.")
+    parser.add_argument('--canvas_data', type=str, metavar='PATH', help="Read page views from Canvas Data requests files (a .gz/.tsv file or a directory of them) instead of the API.")
+    parser.add_argument('--http_cache', type=str, metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags).")
+    parser.add_argument('--entity_store', type=str, metavar='DB', help="Save the students (with their profiles), their enrollments and the assignments to the SQLite entity store DB (created if needed), shared with the other scripts.")
+    add_logging_arguments(parser)
     args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
 
     course_id = args.course_id
     anonymized_students_csv = args.anonymized_students_csv
@@ -44,15 +60,25 @@ def main():
         logger.info("Loading data from file %s instead of fetching from %s" % (cache_json_filename, CANVAS_URL))
         with open(cache_json_filename, 'r') as f:
             data = json.load(f)
+            data['page_views'] = PageViewTable.from_dicts(data['page_views'], PAGE_VIEW_FIELDS)
             data['_cache'] = False
+        METRICS.cache_hit('course_json')
     else:
+        METRICS.cache_miss('course_json')
         logger.info("Loading data from %s" % CANVAS_URL)
-        data = load_data(course_id, start_time=start_time, end_time=end_time)
+        from canvasutils.httpcache import ConditionalCache
+        http_cache = args.http_cache and ConditionalCache(args.http_cache) or None
+        data = load_data(course_id, start_time=start_time, end_time=end_time, concurrency=args.concurrency, canvas_data=args.canvas_data, http_cache=http_cache)
         data['_cache'] = True
 
     # Save the raw API data (i.e. cache it) since it's expensive to load
     if data['_cache'] is True:
         save_json(filename=cache_json_filename, data=data)
+    if args.entity_store:
+        update_entity_store(args.entity_store, course_id, data)
+    METRICS.log_summary()
+    if args.metrics:
+        METRICS.save(args.metrics, labels={'script': 'assignmentviews', 'course_id': course_id})
     
     # Check if the user provided a CSV file mapping a student's HUID to a random ID
     anonymized_students = None
@@ -62,19 +88,27 @@ def main():
     # Process the data
     process_data(data, anonymized_students=anonymized_students)
 
-    logger.info("Total enrollment: %s" % len(data['enrollment']))
-    logger.info("Total page views: %s" % len(data['page_views']))
+    logger.info("Total enrollment: %s", len(data['enrollment']))
+    logger.info("Total page views: %s", len(data['page_views']))
     logger.info("Done.")
 
-def load_data(course_id, start_time=None, end_time=None):
+def load_data(course_id, start_time=None, end_time=None, concurrency=1, canvas_data=None, http_cache=None):
     '''
-    Load page views for all users in a course.
+    Load page views for all users in a course. If canvas_data is the path to
+    Canvas Data requests files, the page views are read from there instead of
+    being fetched from the API. API responses go through the http_cache
+    (a ConditionalCache), if given.
     '''
-    course_enrollment = get_students(course_id)
-    course_assignments = get_assignments(course_id)
+    from canvasutils.client import CanvasClient, api_base_url
+    client = CanvasClient(api_base_url(CANVAS_URL), OAUTH_TOKEN, max_connections=concurrency, http_cache=http_cache)
+    course_enrollment = get_students(course_id, http_cache=http_cache)
+    course_assignments = get_assignments(course_id, http_cache=http_cache)
     user_ids = [user['id'] for user in course_enrollment]
-    user_profiles = get_user_profiles(user_ids)
-    page_views = get_page_views(course_id, user_ids, start_time=start_time, end_time=end_time)
+    user_profiles = get_user_profiles(client, user_ids)
+    if canvas_data is not None:
+        page_views = read_page_views(canvas_data, course_id, user_ids, start_time=start_time, end_time=end_time)
+    else:
+        page_views = get_page_views(client, course_id, user_ids, start_time=start_time, end_time=end_time)
     
     data = {
         "course_id": course_id,
@@ -86,6 +120,25 @@ def load_data(course_id, start_time=None, end_time=None):
 
     return data
 
+def update_entity_store(path, course_id, data):
+    '''
+    Saves the students of the course (merged with their profiles), their
+    enrollments and the assignments to the entity store at path. The page
+    views aren't saved: only those of this course are kept, and the store
+    replaces all of a user's page views over a date range (see
+    canvas_page_views.py --entity_store).
+    '''
+    profiles = dict([(p['id'], p) for p in data['user_profiles'] if p])
+    students = [dict(profiles.get(s['id'], {}), **s) for s in data['enrollment']]
+    entity_store = EntityStore(path)
+    try:
+        entity_store.upsert_users(students)
+        entity_store.replace_enrollments({course_id: [s['id'] for s in students]}, 'StudentEnrollment')
+        entity_store.replace_assignments({course_id: data['assignments']})
+    finally:
+        entity_store.close()
+    logger.info("Saved the data of course %s to %s" % (course_id, path))
+
 def process_data(data, anonymized_students=None):
     '''
     Process the data.
@@ -108,44 +161,46 @@ def get_anonymized_students(csv_file_name):
             huid = row[3]
             if random_id.isdigit():
                 anonymized_students[huid] = random_id
-    logger.debug("Randomized students: number of random_ids=%s mapping=%s" % (len(anonymized_students.keys()), anonymized_students))
+    logger.debug("Randomized students: number of random_ids=%s mapping=%s", len(anonymized_students), LazyJSON(anonymized_students, max_items=5))
     return anonymized_students
 
-def get_students(course_id):
+def get_students(course_id, http_cache=None):
     '''
     Get the student enrollment from TEST environment because the course must be
     unconcluded and/or enrollment active. Since we can't unconclude the course
     in production, we need to do it in TEST and then hit that API endpoint.
     '''
-    request_context = RequestContext(OAUTH_TOKEN, TEST_CANVAS_URL, per_page=100)
-    result = get_all_list_data(request_context, courses.list_users_in_course_users, course_id, "email", enrollment_type="student")
+    from canvasutils.httpcache import install_request_context
+    request_context = install_request_context(instrument_request_context(canvas_sdk.RequestContext(OAUTH_TOKEN, TEST_CANVAS_URL, per_page=100)), http_cache)
+    result = canvas_sdk.utils.get_all_list_data(request_context, courses.list_users_in_course_users, course_id, "email", enrollment_type="student")
     return result
 
-def get_user_profiles(user_ids):
+def get_user_profiles(client, user_ids):
     '''
     Get the user profiles for each user.
     '''
-    request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL)
+    fetch_profile = lambda user_id: client.get_one('/users/%s/profile' % user_id)
     user_profiles = []
-    for user_id in user_ids:
-        user_profile = users.get_user_profile(request_context, user_id)
-        user_profiles.append(user_profile.json())
+    for user_id, user_profile in client.map(fetch_profile, user_ids):
+        user_profiles.append(user_profile)
     return user_profiles
 
-def get_assignments(course_id):
+def get_assignments(course_id, http_cache=None):
     '''
     Returns a list of the assignments for the course.
     '''
-    request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)
-    result = get_all_list_data(request_context, assignments.list_assignments, course_id, '')
+    from canvasutils.httpcache import install_request_context
+    request_context = install_request_context(instrument_request_context(canvas_sdk.RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)), http_cache)
+    result = canvas_sdk.utils.get_all_list_data(request_context, assignments.list_assignments, course_id, '')
     return result
 
-def get_page_views(course_id, user_ids, start_time=None, end_time=None):
+def get_page_views(client, course_id, user_ids, start_time=None, end_time=None):
     '''
     Get the page views from the PROD environment because the page views aren't
-    synced over to the TEST environment.
+    synced over to the TEST environment. Returns a PageViewTable, which stores
+    the repeated URLs, user agents and links of the page views once.
     '''
-    request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)
+    from canvasutils.client import CanvasClientError
     course_url = _get_canvas_course_url(CANVAS_URL, course_id)
     date_range = {}
     if start_time is not None:
@@ -153,18 +208,31 @@ def get_page_views(course_id, user_ids, start_time=None, end_time=None):
     if end_time is not None:
         date_range['end_time'] = end_time
 
-    page_views = []
-    for user_id in user_ids:
+    def fetch_page_views(user_id):
         try:
-            results = get_all_list_data(request_context, users.list_user_page_views, user_id, **date_range)
-        except CanvasAPIError as e:
+            return client.get_all('/users/%s/page_views' % user_id, params=date_range, fields=PAGE_VIEW_FIELDS)
+        except CanvasClientError as e:
             logger.error(str(e))
-        logger.debug("Page views for user_id=%s results=%s" % (user_id, results))
+            return []
+
+    page_views = PageViewTable(PAGE_VIEW_FIELDS)
+    for user_id, results in client.map(fetch_page_views, user_ids):
+        logger.debug("Page views for user_id=%s: %s page views %s", user_id, len(results or []), LazyJSON(results, max_items=3))
         if results:
             page_views.extend([r for r in results if r and r.get('url','').startswith(course_url)])
 
     return page_views
 
+def read_page_views(path, course_id, user_ids, start_time=None, end_time=None):
+    '''
+    Get the page views from Canvas Data requests files, in the same form as get_page_views().
+    '''
+    course_url = _get_canvas_course_url(CANVAS_URL, course_id)
+    base_url = course_url[:course_url.index('/courses/')]
+    page_views = canvasdata.iter_page_views(path, course_id=course_id, user_ids=set(user_ids),
+        start_time=start_time, end_time=end_time, base_url=base_url)
+    return PageViewTable.from_dicts((r for r in page_views if r['url'].startswith(course_url)), PAGE_VIEW_FIELDS)
+
 def save_json(filename=None, data=None):
     '''
     Saves the raw data to a JSON file.
@@ -173,11 +241,13 @@ def save_json(filename=None, data=None):
         raise Exception("Filename is required")
     logger.info("Writing data to %s" % filename)
     with open(filename, 'w') as outfile:
-        json.dump(data, outfile, sort_keys=True, indent=2, separators=(',', ': '))
+        json.dump(data, outfile, sort_keys=True, indent=2, separators=(',', ': '), default=to_json)
 
 def create_page_views_xls(data, anonymized_students):
     '''
-    Creates a spreadsheet containing the raw page views data
+    Creates a spreadsheet containing the raw page views data, sorted by
+    student, assignment and date. The rows are sorted with an ExternalSorter,
+    so large exports are sorted in runs saved to temporary files.
     '''
     course_id = data['course_id']
     page_views = data['page_views']
@@ -201,8 +271,8 @@ def create_page_views_xls(data, anonymized_students):
                    'Request_Date','Request_Url','Interaction_Seconds', 'UserAgent']
     max_col_widths = [len(header) for header in header_cols]
 
-    # Body Rows
-    row_data = []
+    # Body Rows (sorted by student, assignment and date)
+    row_data = ExternalSorter(key=lambda r: (r[1], r[2], r[4]))
     for page_view in page_views:
         request_url = page_view['url']
         if not request_url.startswith(course_url + '/assignments/'):
@@ -248,10 +318,10 @@ def create_page_views_xls(data, anonymized_students):
         ws.write(0, col_idx, header_col, bold_style)
 
     # Insert Body Rows
-    sorted_row_data = sorted(row_data, key=lambda r: (r[1], r[2], r[4]))
-    for row_idx, row in enumerate(sorted_row_data):
-        for col_idx, col_value in enumerate(row):
-            ws.write(row_idx+1, col_idx, col_value)
+    with row_data:
+        for row_idx, row in enumerate(row_data):
+            for col_idx, col_value in enumerate(row):
+                ws.write(row_idx+1, col_idx, col_value)
 
     # Adjust column widths
     for col_idx, col_width in enumerate(max_col_widths):
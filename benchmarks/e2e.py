@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+End-to-end benchmarks of the canvas-utils scripts against the mock Canvas API.
+
+Each script runs as a separate process with a cold cache in its own
+temporary directory (with a settings/secure.py pointing at the mock server),
+and the harness records:
+
+- wall time of the run
+- number of API requests and bytes sent by the server (and throttled requests)
+- peak RSS of the process
+
+Usage:
+
+    $ python e2e.py --students 2000 --page_views 200000 --concurrency 4
+    $ python e2e.py --tools canvas_page_views find_due_dates --output results.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+import requests
+
+import mock_canvas
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+OAUTH_TOKEN = 'benchmark-token'
+
+TOOLS = ['canvas_page_views', 'assignmentviews', 'rubricassessments', 'find_due_dates']
+
+def prepare_workdir(tool, canvas_url):
+    '''
+    Copies the tool into a temporary directory next to a link to the shared
+    canvasutils package, and writes a settings/secure.py for the mock server.
+    Returns the path to the copied tool directory.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='canvas-utils-bench-')
+    os.symlink(os.path.join(REPO_DIR, 'canvasutils'), os.path.join(tmpdir, 'canvasutils'))
+    workdir = os.path.join(tmpdir, tool)
+    shutil.copytree(os.path.join(REPO_DIR, tool), workdir, ignore=shutil.ignore_patterns('*.pyc', 'secure.py', '*.json', '*.xls', '*.csv'))
+    if os.path.isdir(os.path.join(workdir, 'settings')):
+        with open(os.path.join(workdir, 'settings', 'secure.py'), 'w') as f:
+            f.write("OAUTH_TOKEN=%r\nCANVAS_URL=%r\nTEST_CANVAS_URL=%r\n" % (OAUTH_TOKEN, canvas_url, canvas_url))
+    return workdir
+
+def tool_command(tool, server, args):
+    '''Returns the command line used to run the tool against the mock server.'''
+    canvas = server.canvas
+    course_id = str(canvas.courses[0]['id'])
+    concurrency = str(args.concurrency)
+    if tool == 'canvas_page_views':
+        return ['canvas_page_views.py', course_id, '--oauth_token', OAUTH_TOKEN, '--api_base_url', server.url + '/v1',
+                '--start_time', '2016-01-25', '--end_time', '2016-05-14', '--enrollment_types', 'StudentEnrollment',
+                '--concurrency', concurrency]
+    if tool == 'assignmentviews':
+        return ['assignmentviews.py', course_id, '--concurrency', concurrency]
+    if tool == 'rubricassessments':
+        return ['rubricassessments.py', course_id, '--concurrency', concurrency]
+    if tool == 'find_due_dates':
+        return ['find_due_dates.py', str(canvas.account_id), '--enrollment_term_id', str(canvas.term['id']),
+                '--reading_period_start', '2016-04-28', '--reading_period_end', '2016-05-04',
+                '--exam_period_start', '2016-05-05', '--exam_period_end', '2016-05-13',
+                '--concurrency', concurrency]
+    raise Exception("Unknown tool: %s" % tool)
+
+def run_tool(tool, server, args):
+    '''
+    Runs one tool and returns a dict with its measurements.
+    '''
+    # assignmentviews only keeps page views whose URL starts with the course URL
+    # derived from CANVAS_URL, so the page views have to point at the mock server.
+    if tool == 'assignmentviews':
+        server.canvas.page_view_base_url = 'http://%s:%s' % server.server_address
+    else:
+        server.canvas.page_view_base_url = args.page_view_base_url
+
+    workdir = prepare_workdir(tool, server.url)
+    command = tool_command(tool, server, args)
+    log_file = os.path.join(workdir, 'benchmark.log')
+    requests.get(server.url.replace('/api', '/__reset'))
+
+    started_at = time.time()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen([args.python] + command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.time() - started_at
+
+    stats = requests.get(server.url.replace('/api', '/__stats')).json()
+    result = {
+        'tool': tool,
+        'command': ' '.join(command),
+        'exit_status': os.WEXITSTATUS(status),
+        'wall_seconds': round(wall_seconds, 3),
+        'requests': stats['requests'],
+        'bytes': stats['bytes'],
+        'throttled': stats['throttled'],
+        'peak_rss_kb': rusage.ru_maxrss,
+        'endpoints': stats['endpoints'],
+        'log_file': log_file,
+    }
+    if args.keep:
+        result['workdir'] = workdir
+    else:
+        shutil.rmtree(os.path.dirname(workdir), ignore_errors=True)
+        del result['log_file']
+    return result
+
+def print_results(results):
+    print "%-20s %6s %10s %10s %12s %10s %12s" % ('Tool', 'Exit', 'Wall (s)', 'Requests', 'Bytes', 'Throttled', 'Peak RSS (KB)')
+    for r in results:
+        print "%-20s %6s %10.2f %10d %12d %10d %12d" % (r['tool'], r['exit_status'], r['wall_seconds'], r['requests'], r['bytes'], r['throttled'], r['peak_rss_kb'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the canvas-utils scripts against a synthetic Canvas API and records their cost.')
+    parser.add_argument('--tools', nargs='*', default=TOOLS, choices=TOOLS, help="Tools to run. Default: all of them")
+    parser.add_argument('--concurrency', type=int, default=1, help="Value of the --concurrency option passed to the tools. Default: 1")
+    parser.add_argument('--python', default=sys.executable, help="Python interpreter used to run the tools. Default: %s" % sys.executable)
+    parser.add_argument('--output', help="File to save the results to. Default: results/e2e-[timestamp].json")
+    parser.add_argument('--keep', action='store_true', help="Keep the working directories (with the logs and reports) of each run.")
+    mock_canvas.add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    server = mock_canvas.create_server(args)
+    mock_canvas.start_server(server)
+    print "Mock Canvas API at %s/v1" % server.url
+
+    results = []
+    for tool in args.tools:
+        print "Running %s..." % tool
+        results.append(run_tool(tool, server, args))
+    server.shutdown()
+
+    output = args.output
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, 'e2e-%s.json' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    scale = dict([(k, getattr(args, k)) for k in ('seed', 'courses', 'students', 'courses_per_student', 'assignments_per_course', 'page_views', 'rate_limit', 'cost_per_item')])
+    with open(output, 'w') as f:
+        json.dump({'scale': scale, 'concurrency': args.concurrency, 'results': results}, f, sort_keys=True, indent=2, separators=(',', ': '))
+
+    print_results(results)
+    print "Saved results to %s" % output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+'''
+Micro-benchmarks of the data transformation functions in the canvas-utils scripts.
+
+Each benchmark generates seeded synthetic data at a few sizes, then times the
+function (best of several runs) and reports its throughput and the number of
+objects it allocated that were still alive when it returned. Results can be
+saved as a baseline and later runs compared against it, so a change that
+slows one of these functions down shows up before a big report run.
+
+Usage:
+
+    $ python micro.py --save_baseline           # on the base commit
+    $ python micro.py --check                   # after a change: exits 1 on a regression
+    $ python micro.py --cases reduce_paginated_data is_course_url --sizes large
+'''
+import os
+import gc
+import sys
+import imp
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'micro_baseline.json')
+CANVAS_URL = 'https://canvas.harvard.edu/api'
+COURSE_ID = 1693
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/601.6.17 (KHTML, like Gecko) Version/9.1.1 Safari/601.6.17',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36',
+    'candroid/4.6.2 (Android 6.0.1)',
+]
+
+def load_script(tool, script=None):
+    '''
+    Imports one of the canvas-utils scripts as a module. The benchmarks never
+    call the API, so placeholder settings are used when the tool has no
+    settings/secure.py.
+    '''
+    tool_dir = os.path.join(REPO_DIR, tool)
+    for name in ('settings', 'settings.secure'):
+        sys.modules.pop(name, None)
+    if os.path.isdir(os.path.join(tool_dir, 'settings')) and not os.path.exists(os.path.join(tool_dir, 'settings', 'secure.py')):
+        settings = imp.new_module('settings')
+        settings.secure = imp.new_module('settings.secure')
+        settings.secure.OAUTH_TOKEN = ''
+        settings.secure.CANVAS_URL = CANVAS_URL
+        settings.secure.TEST_CANVAS_URL = CANVAS_URL
+        sys.modules['settings'] = settings
+        sys.modules['settings.secure'] = settings.secure
+    sys.path.insert(0, tool_dir)
+    try:
+        return imp.load_source(tool, os.path.join(tool_dir, (script or tool) + '.py'))
+    finally:
+        sys.path.remove(tool_dir)
+
+# Synthetic data generators
+
+def iso_time(rng):
+    start = datetime.datetime(2016, 1, 25)
+    return (start + datetime.timedelta(seconds=rng.randint(0, 110 * 86400))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def make_page_view(rng, user_id, course_id, assignment_ids):
+    if rng.random() < 0.05:
+        url, context_type = 'https://canvas.harvard.edu/', 'User'
+    else:
+        path = rng.choice(['assignments/%s' % rng.choice(assignment_ids), 'pages/week-%d' % rng.randint(1, 14), 'files/%d' % rng.randint(1, 200), 'modules', ''])
+        url, context_type = 'https://canvas.harvard.edu/courses/%s/%s' % (course_id, path), 'Course'
+    return {
+        'id': '%032x' % rng.getrandbits(128),
+        'url': url,
+        'context_type': context_type,
+        'asset_type': None,
+        'controller': 'assignments',
+        'action': 'show',
+        'interaction_seconds': float(rng.randint(0, 600)),
+        'created_at': iso_time(rng),
+        'user_request': True,
+        'render_time': rng.random(),
+        'user_agent': rng.choice(USER_AGENTS),
+        'participated': rng.random() < 0.25,
+        'http_method': 'get',
+        'remote_ip': '10.0.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255)),
+        'links': {'user': user_id, 'context': course_id, 'asset': None, 'real_user': None, 'account': 1},
+    }
+
+def make_page_view_pages(num_views, seed=1, per_page=100, num_users=None):
+    '''Returns page views as a list of API pages (lists of up to per_page page views).'''
+    rng = random.Random(seed)
+    num_users = num_users or max(1, num_views // 200)
+    assignment_ids = range(10000, 10040)
+    views = [make_page_view(rng, 100000 + i % num_users, COURSE_ID, assignment_ids) for i in range(num_views)]
+    return [views[i:i + per_page] for i in range(0, len(views), per_page)]
+
+def make_rubric_data(num_students, num_assignments, num_criteria=4, seed=1):
+    '''Returns raw data in the shape saved by rubricassessments.load_rubric_data().'''
+    rng = random.Random(seed)
+    students = sorted([{'id': 100000 + i, 'sortable_name': 'Student %05d, Test' % i} for i in range(num_students)], key=lambda s: s['sortable_name'])
+    assignments = []
+    submissions = []
+    for a in range(num_assignments):
+        rubric = [{'id': '%d_%d' % (a, k), 'description': 'Criterion %d' % (k + 1), 'points': 5} for k in range(num_criteria)]
+        assignment = {'id': 10000 + a, 'name': 'Assignment %d' % (a + 1)}
+        if a % 4 != 3:
+            assignment['rubric'] = rubric
+        assignments.append(assignment)
+        assignment_submissions = []
+        for student in students:
+            submission = {'user_id': student['id'], 'assignment_id': assignment['id']}
+            if rng.random() < 0.8:
+                submission['rubric_assessment'] = dict([(c['id'], {'points': rng.randint(0, 5), 'comments': 'Comment %d' % rng.randint(0, 99)}) for c in rubric])
+            assignment_submissions.append(submission)
+        submissions.append({'assignment_id': assignment['id'], 'submissions': assignment_submissions})
+    return {'students': students, 'assignments': assignments, 'submissions': submissions}
+
+def make_assignmentviews_data(num_views, seed=1):
+    '''Returns raw data in the shape saved by assignmentviews.load_data().'''
+    rng = random.Random(seed)
+    num_users = max(1, num_views // 200)
+    assignments = [{'id': 10000 + a, 'name': ('Video Lecture %d' if a % 2 == 0 else 'Essay %d') % (a + 1)} for a in range(40)]
+    page_views = []
+    for i in range(num_views):
+        page_view = make_page_view(rng, 100000 + i % num_users, COURSE_ID, [a['id'] for a in assignments])
+        page_view['url'] = page_view['url'].replace('/pages/', '/assignments/%d/pages/' % rng.choice(assignments)['id'])
+        page_views.append(page_view)
+    profiles = [{'id': 100000 + i, 'login_id': '%08d' % (10000000 + i)} for i in range(num_users)]
+    return {'course_id': COURSE_ID, 'enrollment': profiles, 'assignments': assignments, 'user_profiles': profiles, 'page_views': page_views}
+
+def make_due_dates_data(num_courses, assignments_per_course=20, seed=1):
+    '''Returns data in the shape used by find_due_dates.save_spreadsheet().'''
+    rng = random.Random(seed)
+    courses = [{'id': 1000 + c, 'name': 'Course %d' % c, 'term': {'name': 'Spring 2016'}} for c in range(num_courses)]
+    assignments = {}
+    for course in courses:
+        assignments[str(course['id'])] = [
+            {'id': course['id'] * 1000 + a, 'name': 'Assignment %d' % a, 'due_at': iso_time(rng) if rng.random() < 0.9 else None}
+            for a in range(assignments_per_course)]
+    return {'courses': courses, 'assignments': assignments}
+
+# Benchmark cases. Each setup function takes a size and returns a tuple
+# (function to time, number of items it processes).
+
+def setup_reduce_paginated_data(size):
+    pages = make_page_view_pages(size)
+    return lambda: canvas_page_views.reduce_paginated_data(pages, ['id', 'url', 'created_at', 'context_type']), size
+
+def setup_reduce_user_page_views(size):
+    pages = make_page_view_pages(size)
+    return lambda: canvas_page_views.reduce_user_page_views(pages), size
+
+def setup_is_course_url(size):
+    urls = [pv['url'] for page in make_page_view_pages(size) for pv in page]
+    return lambda: [canvas_page_views.is_course_url(COURSE_ID, url) for url in urls], size
+
+def setup_save_data(size):
+    rows = [[100000 + i % 500, 'https://canvas.harvard.edu/courses/%s/assignments/%d' % (COURSE_ID, i % 300), '2016-02-01T12:00:00Z'] for i in range(size)]
+    items = [
+        {'format': 'csv', 'name': 'user-pageviews', 'labels': ['User ID', 'Course URL', 'Request Date'], 'items': rows},
+        {'format': 'json', 'name': 'user-pageviews', 'labels': ['user_id', 'course_url', 'request_date'], 'items': rows},
+    ]
+    return lambda: canvas_page_views.save_data(items), size
+
+def setup_transform_rubric_data(size):
+    data = make_rubric_data(size, 20)
+    return lambda: rubricassessments.transform_rubric_data(data), size * 20
+
+def setup_merge_rubric(size):
+    data = make_rubric_data(50, 4, num_criteria=6)
+    pairs = []
+    for assignment, submissions in zip(data['assignments'], data['submissions']):
+        for submission in submissions['submissions']:
+            pairs.append((assignment.get('rubric', []), submission.get('rubric_assessment')))
+    pairs = (pairs * (size // len(pairs) + 1))[:size]
+    return lambda: [rubricassessments._merge_rubric(d, a) for d, a in pairs], size
+
+def setup_create_page_views_xls(size):
+    data = make_assignmentviews_data(size)
+    return lambda: assignmentviews.create_page_views_xls(data, None), size
+
+def setup_save_spreadsheet(size):
+    data = make_due_dates_data(size)
+    find_due_dates.args = find_due_dates.parser.parse_args(['1', '--reading_period_start', '2016-04-28', '--reading_period_end', '2016-05-04',
+        '--exam_period_start', '2016-05-05', '--exam_period_end', '2016-05-14'])
+    return lambda: find_due_dates.save_spreadsheet(filename='duedates.xls', data=data), size * 20
+
+# (case, tool module it needs, sizes)
+CASES = [
+    ('reduce_paginated_data', 'canvas_page_views', {'small': 1000, 'medium': 10000, 'large': 50000}),
+    ('reduce_user_page_views', 'canvas_page_views', {'small': 1000, 'medium': 10000, 'large': 50000}),
+    ('is_course_url', 'canvas_page_views', {'small': 1000, 'medium': 10000, 'large': 100000}),
+    ('save_data', 'canvas_page_views', {'small': 1000, 'medium': 10000, 'large': 100000}),
+    ('transform_rubric_data', 'rubricassessments', {'small': 50, 'medium': 200, 'large': 1000}),
+    ('merge_rubric', 'rubricassessments', {'small': 1000, 'medium': 10000, 'large': 100000}),
+    ('create_page_views_xls', 'assignmentviews', {'small': 1000, 'medium': 10000, 'large': 50000}),
+    ('save_spreadsheet', 'find_due_dates', {'small': 50, 'medium': 500, 'large': 3000}),
+]
+
+def measure(func, repeat):
+    '''
+    Returns (best time in seconds, objects allocated and still alive on return,
+    peak KB allocated or None when tracemalloc isn't available).
+    '''
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        started_at = time.time()
+        func()
+        times.append(time.time() - started_at)
+
+    gc.collect()
+    gc.disable()
+    try:
+        objects_before = len(gc.get_objects())
+        if tracemalloc is not None:
+            tracemalloc.start()
+        result = func()
+        peak_kb = None
+        if tracemalloc is not None:
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        allocated = len(gc.get_objects()) - objects_before
+        del result
+    finally:
+        gc.enable()
+    return min(times), allocated, peak_kb
+
+def load_tools(names):
+    '''Imports the scripts needed by the cases as module globals. Returns the names that failed.'''
+    failed = {}
+    for tool in sorted(set(names)):
+        try:
+            globals()[tool] = load_script(tool)
+        except ImportError as e:
+            failed[tool] = str(e)
+    return failed
+
+def run(cases, sizes, repeat):
+    failed = load_tools([tool for name, tool, case_sizes in cases])
+    results = {}
+    for name, tool, case_sizes in cases:
+        if tool in failed:
+            print "%-24s skipped: could not import %s (%s)" % (name, tool, failed[tool])
+            continue
+        for size_name in sizes:
+            func, num_items = globals()['setup_' + name](case_sizes[size_name])
+            seconds, allocated, peak_kb = measure(func, repeat)
+            key = '%s:%s' % (name, size_name)
+            results[key] = {
+                'seconds': seconds,
+                'items': num_items,
+                'items_per_second': num_items / seconds if seconds > 0 else None,
+                'allocated_objects': allocated,
+                'peak_kb': peak_kb,
+            }
+            print "%-32s %10d items %10.4fs %12.0f items/s %10d objects" % (key, num_items, seconds, results[key]['items_per_second'] or 0, allocated)
+    return results
+
+def compare(results, baseline, threshold):
+    '''Prints the change against the baseline and returns the keys that regressed.'''
+    regressions = []
+    print
+    print "%-32s %10s %10s %8s" % ('Benchmark', 'Baseline', 'Current', 'Change')
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        before, after = baseline[key]['seconds'], results[key]['seconds']
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = ' REGRESSION'
+        print "%-32s %9.4fs %9.4fs %+7.1f%%%s" % (key, before, after, change * 100, flag)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the canvas-utils data transformation functions.')
+    parser.add_argument('--cases', nargs='*', choices=[c[0] for c in CASES], help="Benchmarks to run. Default: all")
+    parser.add_argument('--sizes', nargs='*', default=['small', 'medium'], choices=['small', 'medium', 'large'], help="Data sizes to run. Default: small medium")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed runs of each benchmark (the best is kept). Default: 3")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Baseline results file. Default: %s" % BASELINE_FILE)
+    parser.add_argument('--save_baseline', action='store_true', help="Save the results as the new baseline.")
+    parser.add_argument('--check', action='store_true', help="Exit with status 1 if any benchmark is slower than the baseline by more than the threshold.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Slowdown that counts as a regression. Default: 0.2 (20%%)")
+    parser.add_argument('--output', help="File to save the results to.")
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if not args.cases or c[0] in args.cases]
+
+    # The functions log their progress. Log at the scripts' default level (INFO)
+    # to a discarded stream, so the messages are formatted as in a real run
+    # without being printed, and write any output files to a scratch directory.
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+    root_logger.setLevel(logging.INFO)
+    scratch_dir = tempfile.mkdtemp(prefix='canvas-utils-micro-')
+    cwd = os.getcwd()
+    os.chdir(scratch_dir)
+    try:
+        results = run(cases, args.sizes, args.repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=2, separators=(',', ': '))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    compared = baseline is not None and [key for key in results if key in baseline] or []
+    if compared and (args.check or not args.save_baseline):
+        regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        baseline = dict(baseline or {}, **results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, sort_keys=True, indent=2, separators=(',', ': '))
+        print "Saved baseline to %s" % args.baseline
+
+    if args.check:
+        # A check without anything to compare to would pass without checking anything
+        if not compared:
+            sys.stderr.write("ERROR: --check has no baseline results to compare to (%s is missing or has none of these benchmarks). "
+                             "Save a baseline with --save_baseline on the base commit first.\n" % args.baseline)
+            sys.exit(2)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+'''
+Local stand-in for the Canvas API, serving synthetic data for benchmarks.
+
+The server generates courses, student enrollments, assignments with rubrics,
+submissions with rubric assessments and page views, and serves them with the
+same URLs, "Link" pagination headers and rate limit headers as Canvas.
+
+Page views are never held in memory: each one is computed from the student ID
+and its position in the student's history, so the server can stand in for
+an account with tens of millions of page views.
+
+Usage:
+
+    $ python mock_canvas.py --port 8000 --students 10000 --page_views 50000000
+    $ curl -H "Authorization: Bearer x" "http://localhost:8000/api/v1/users/100000/page_views?per_page=100"
+
+Besides the API, the server has two endpoints for the benchmark harness:
+
+- GET /__stats returns the number of requests, bytes sent and throttled
+  requests since the last reset, overall and by endpoint.
+- GET /__reset resets the stats and the rate limit bucket.
+
+Successful responses have a weak ETag (a hash of the body), and requests
+with a matching If-None-Match header get an empty 304 Not Modified response,
+like Canvas.
+'''
+import re
+import sys
+import json
+import time
+import hashlib
+import urllib
+import urlparse
+import argparse
+import datetime
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/601.6.17 (KHTML, like Gecko) Version/9.1.1 Safari/601.6.17',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 9_3_2 like Mac OS X) AppleWebKit/601.1.46 (KHTML, like Gecko) Mobile/13F69',
+    'candroid/4.6.2 (Android 6.0.1)',
+]
+
+PAGE_VIEW_PATHS = [
+    ('assignments/{assignment_id}', 'Assignment', 'assignments', 'show'),
+    ('assignments/{assignment_id}', 'Assignment', 'assignments', 'show'),
+    ('assignments/{assignment_id}/submissions/{user_id}', 'Assignment', 'submissions', 'show'),
+    ('pages/week-{n}', 'WikiPage', 'wiki_pages', 'show'),
+    ('files/{n}', 'Attachment', 'files', 'show'),
+    ('modules', None, 'context_modules', 'index'),
+    ('discussion_topics/{n}', 'DiscussionTopic', 'discussion_topics', 'show'),
+    ('', None, 'courses', 'show'),
+]
+
+def _hash(*values):
+    '''Cheap deterministic hash of a few integers, used instead of a random number generator.'''
+    h = 2166136261
+    for v in values:
+        h = ((h ^ (v & 0xffffffff)) * 16777619) & 0xffffffff
+        h = ((h ^ (h >> 13)) * 1274126177) & 0xffffffff
+    return h
+
+def _iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _parse_time(value):
+    '''Parses the start_time/end_time parameters (YYYY-MM-DD or ISO 8601).'''
+    value = value.rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value[:19], fmt)
+        except ValueError:
+            pass
+    return None
+
+class SyntheticCanvas(object):
+    '''
+    Synthetic account data. Everything except page views is built up front.
+    '''
+    def __init__(self, seed=1, courses=5, students=1000, courses_per_student=3, assignments_per_course=20,
+                 page_views=100000, page_view_base_url='https://canvas.harvard.edu', start_time='2016-01-25', end_time='2016-05-14',
+                 account_id=1, term_id=1):
+        self.seed = seed
+        self.account_id = account_id
+        self.page_view_base_url = page_view_base_url
+        self.window_start = datetime.datetime.strptime(start_time, '%Y-%m-%d')
+        self.window_end = datetime.datetime.strptime(end_time, '%Y-%m-%d')
+        self.window_seconds = int((self.window_end - self.window_start).total_seconds())
+        self.term = {'id': term_id, 'name': 'Spring 2016'}
+
+        self.courses = []
+        self.course_of = {}
+        for c in range(courses):
+            course = {'id': 1000 + c, 'name': 'Synthetic Course %03d' % c, 'course_code': 'SYN%03d' % c,
+                      'workflow_state': 'available', 'account_id': account_id, 'enrollment_term_id': term_id, 'term': self.term}
+            self.courses.append(course)
+            self.course_of[course['id']] = course
+
+        self.students = []
+        self.student_of = {}
+        self.courses_of_student = {}
+        self.students_of_course = dict([(c['id'], []) for c in self.courses])
+        stride = max(courses // max(courses_per_student, 1), 1)
+        for j in range(students):
+            user_id = 100000 + j
+            student = {'id': user_id, 'name': 'Student %05d' % j, 'sortable_name': '%05d, Student' % j,
+                       'short_name': 'Student %05d' % j, 'login_id': '%08d' % (10000000 + j), 'email': 'student%05d@example.edu' % j}
+            self.students.append(student)
+            self.student_of[user_id] = student
+            course_ids = sorted(set([self.courses[(j + m * stride) % courses]['id'] for m in range(min(courses_per_student, courses))]))
+            self.courses_of_student[user_id] = course_ids
+            for course_id in course_ids:
+                self.students_of_course[course_id].append(student)
+
+        self.assignments_of_course = {}
+        self.assignment_of = {}
+        for course in self.courses:
+            assignments = []
+            for a in range(assignments_per_course):
+                assignment_id = course['id'] * 1000 + a
+                h = _hash(seed, assignment_id)
+                due_at = None
+                if h % 10 != 0:
+                    due_at = _iso(self.window_start + datetime.timedelta(seconds=h % self.window_seconds))
+                assignment = {
+                    'id': assignment_id,
+                    'course_id': course['id'],
+                    'name': ('Video Lecture %d' if a % 2 == 0 else 'Essay %d') % (a + 1),
+                    'due_at': due_at,
+                    'points_possible': 10,
+                    'html_url': '%s/courses/%s/assignments/%s' % (page_view_base_url, course['id'], assignment_id),
+                }
+                if a % 3 != 2:
+                    assignment['rubric'] = [{'id': '%d_%d' % (assignment_id, k), 'description': 'Criterion %d' % (k + 1), 'points': 5} for k in range(3)]
+                assignments.append(assignment)
+                self.assignment_of[assignment_id] = assignment
+            self.assignments_of_course[course['id']] = assignments
+
+        self.page_views_per_student = page_views // max(students, 1)
+        self.extra_page_views = page_views % max(students, 1)
+
+        self.analytics_of_course = {}
+        self.analytics_lock = threading.Lock()
+
+    # Resources
+
+    def enrollments(self, course_id, types=None):
+        result = []
+        for student in self.students_of_course.get(course_id, []):
+            if types and 'StudentEnrollment' not in types:
+                continue
+            result.append({'id': course_id * 100000 + student['id'], 'course_id': course_id, 'user_id': student['id'],
+                           'type': 'StudentEnrollment', 'enrollment_state': 'active', 'user': student})
+        return result
+
+    def submissions(self, course_id, assignment_id, include_rubric=False):
+        assignment = self.assignment_of[assignment_id]
+        result = []
+        for student in self.students_of_course.get(course_id, []):
+            h = _hash(self.seed, assignment_id, student['id'])
+            submission = {'id': h, 'assignment_id': assignment_id, 'user_id': student['id'],
+                          'workflow_state': 'graded' if h % 5 else 'unsubmitted', 'score': h % 11}
+            if include_rubric and 'rubric' in assignment and h % 5:
+                submission['rubric_assessment'] = dict([
+                    (criterion['id'], {'points': (h >> k) % 6, 'comments': 'Comment %d' % k})
+                    for k, criterion in enumerate(assignment['rubric'])])
+            result.append(submission)
+        return result
+
+    def num_page_views(self, user_id):
+        j = user_id - 100000
+        return self.page_views_per_student + (1 if j < self.extra_page_views else 0)
+
+    def page_view_range(self, user_id, start_time=None, end_time=None):
+        '''
+        Returns the (first, last) positions of the user's page views between
+        the given times. Page views are evenly spaced over the window, newest first.
+        '''
+        count = self.num_page_views(user_id)
+        if count == 0:
+            return 0, 0
+        spacing = float(self.window_seconds) / count
+        first, last = 0, count
+        if end_time is not None:
+            first = max(0, int((self.window_end - end_time).total_seconds() / spacing))
+        if start_time is not None:
+            last = min(count, int((self.window_end - start_time).total_seconds() / spacing) + 1)
+        return first, max(first, last)
+
+    def page_view(self, user_id, i):
+        count = self.num_page_views(user_id)
+        h = _hash(self.seed, user_id, i)
+        created_at = self.window_end - datetime.timedelta(seconds=(i + 0.5) * self.window_seconds / count)
+        course_ids = self.courses_of_student[user_id]
+        course_id = course_ids[h % len(course_ids)]
+        assignments = self.assignments_of_course[course_id]
+        path, asset_type, controller, action = PAGE_VIEW_PATHS[(h >> 4) % len(PAGE_VIEW_PATHS)]
+        context_type = 'Course'
+        if (h >> 8) % 20 == 0:
+            url = '%s/' % self.page_view_base_url
+            context_type, asset_type, controller, action = 'User', None, 'users', 'user_dashboard'
+        else:
+            path = path.format(assignment_id=assignments[(h >> 12) % len(assignments)]['id'] if assignments else 0, user_id=user_id, n=(h >> 12) % 15)
+            url = '%s/courses/%s/%s' % (self.page_view_base_url, course_id, path)
+        return {
+            'id': '%08x-%04x-%04x-%04x-%012x' % (h, user_id & 0xffff, i & 0xffff, (h >> 16) & 0xffff, user_id * 1000003 + i),
+            'url': url,
+            'context_type': context_type,
+            'asset_type': asset_type,
+            'controller': controller,
+            'action': action,
+            'interaction_seconds': float((h >> 3) % 600),
+            'created_at': _iso(created_at),
+            'user_request': True,
+            'render_time': 0.05 + ((h >> 5) % 100) / 1000.0,
+            'user_agent': USER_AGENTS[(h >> 20) % len(USER_AGENTS)],
+            'participated': (h >> 24) % 4 == 0,
+            'http_method': 'get',
+            'remote_ip': '10.%d.%d.%d' % ((h >> 8) & 0xff, (h >> 16) & 0xff, h & 0xff),
+            'links': {'user': user_id, 'context': course_id if context_type == 'Course' else user_id, 'asset': None, 'real_user': None, 'account': self.account_id},
+        }
+
+    def course_analytics(self, course_id):
+        '''
+        Returns the course analytics: the page views and participations of
+        each student in the course, by student and by hour, over the whole
+        window (analytics aren't limited to a date range). They're computed
+        from the page views the first time they're requested.
+        '''
+        with self.analytics_lock:
+            if course_id not in self.analytics_of_course:
+                totals, hours, participations = {}, {}, {}
+                for student in self.students_of_course.get(course_id, []):
+                    user_id = student['id']
+                    totals[user_id] = [0, 0]
+                    hours[user_id] = {}
+                    participations[user_id] = []
+                    for i in range(self.num_page_views(user_id)):
+                        page_view = self.page_view(user_id, i)
+                        if page_view['context_type'] != 'Course' or page_view['links']['context'] != course_id:
+                            continue
+                        hour = page_view['created_at'][:13] + ':00:00Z'
+                        totals[user_id][0] += 1
+                        hours[user_id][hour] = hours[user_id].get(hour, 0) + 1
+                        if page_view['participated']:
+                            totals[user_id][1] += 1
+                            participations[user_id].append({'created_at': page_view['created_at'], 'url': page_view['url']})
+                self.analytics_of_course[course_id] = (totals, hours, participations)
+            return self.analytics_of_course[course_id]
+
+    def student_summaries(self, course_id):
+        totals, hours, participations = self.course_analytics(course_id)
+        max_views = max([t[0] for t in totals.values()] or [0])
+        max_participations = max([t[1] for t in totals.values()] or [0])
+        return [{'id': user_id, 'page_views': totals[user_id][0], 'max_page_views': max_views,
+                 'participations': totals[user_id][1], 'max_participations': max_participations,
+                 'tardiness_breakdown': {'total': 0, 'on_time': 0, 'late': 0, 'missing': 0, 'floating': 0}}
+                for user_id in sorted(totals)]
+
+    def course_activity(self, course_id):
+        totals, hours, participations = self.course_analytics(course_id)
+        days = {}
+        for user_id in hours:
+            for hour, views in hours[user_id].items():
+                days.setdefault(hour[:10], [0, 0])[0] += views
+            for participation in participations[user_id]:
+                days.setdefault(participation['created_at'][:10], [0, 0])[1] += 1
+        return [{'date': day, 'views': days[day][0], 'participations': days[day][1]} for day in sorted(days)]
+
+    def user_activity(self, course_id, user_id):
+        totals, hours, participations = self.course_analytics(course_id)
+        if user_id not in totals:
+            return None
+        return {'page_views': hours[user_id], 'participations': participations[user_id]}
+
+class RateLimitBucket(object):
+    '''
+    Leaky bucket like the one Canvas uses to throttle API requests.
+    '''
+    def __init__(self, capacity=700.0, leak_rate=100.0, preflight_cost=50.0):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.preflight_cost = preflight_cost
+        self.reset()
+
+    def reset(self):
+        self.level = 0.0
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def _leak(self):
+        now = time.time()
+        self.level = max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def start(self):
+        '''Charges the up-front cost of a request. Returns False if the request should be throttled.'''
+        with self.lock:
+            self._leak()
+            if self.level + self.preflight_cost > self.capacity:
+                return False
+            self.level += self.preflight_cost
+            return True
+
+    def finish(self, cost):
+        '''Replaces the up-front cost with the actual cost. Returns the remaining quota.'''
+        with self.lock:
+            self._leak()
+            self.level = max(0.0, self.level - self.preflight_cost + cost)
+            return max(0.0, self.capacity - self.level)
+
+class MockCanvasHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serves the Canvas API endpoints used by the canvas-utils scripts.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        (r'^/api/v1/accounts/(\d+)/courses$', 'account_courses'),
+        (r'^/api/v1/courses/(\d+)$', 'course'),
+        (r'^/api/v1/courses/(\d+)/enrollments$', 'course_enrollments'),
+        (r'^/api/v1/courses/(\d+)/users$', 'course_users'),
+        (r'^/api/v1/courses/(\d+)/assignments$', 'course_assignments'),
+        (r'^/api/v1/courses/(\d+)/assignments/(\d+)/submissions$', 'assignment_submissions'),
+        (r'^/api/v1/users/(\d+)/profile$', 'user_profile'),
+        (r'^/api/v1/users/(\d+)/page_views$', 'user_page_views'),
+        (r'^/api/v1/courses/(\d+)/analytics/student_summaries$', 'student_summaries'),
+        (r'^/api/v1/courses/(\d+)/analytics/activity$', 'course_activity'),
+        (r'^/api/v1/courses/(\d+)/analytics/users/(\d+)/activity$', 'user_activity'),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(parsed.query)
+        self.endpoint = parsed.path
+        if parsed.path == '/__stats':
+            return self.send_json(200, self.server.stats_snapshot(), record=False)
+        if parsed.path == '/__reset':
+            self.server.reset()
+            return self.send_json(200, {'reset': True}, record=False)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json(401, {'errors': [{'message': 'Invalid access token.'}]})
+
+        for pattern, name in self.ROUTES:
+            m = re.match(pattern, parsed.path)
+            if m is not None:
+                break
+        else:
+            return self.send_json(404, {'errors': [{'message': 'The specified resource does not exist.'}]})
+
+        self.endpoint = re.sub(r'\d+', ':id', parsed.path)
+        bucket = self.server.bucket
+        if bucket is not None and not bucket.start():
+            self.server.record_throttled(self.endpoint)
+            return self.send_text(403, '403 Forbidden (Rate Limit Exceeded)', {'X-Rate-Limit-Remaining': '0.0'})
+
+        started_at = time.time()
+        ids = [int(g) for g in m.groups()]
+        status, data, page_info = getattr(self, 'get_' + name)(query, *ids)
+        headers = {}
+        if page_info is not None:
+            headers['Link'] = self.link_header(parsed.path, query, *page_info)
+        if bucket is not None:
+            cost = (time.time() - started_at) + self.server.cost_per_item * (len(data) if isinstance(data, list) else 1)
+            headers['X-Request-Cost'] = '%.4f' % cost
+            headers['X-Rate-Limit-Remaining'] = '%.4f' % bucket.finish(cost)
+        if status != 200:
+            return self.send_json(status, data, headers=headers)
+        body = json.dumps(data)
+        headers['ETag'] = 'W/"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            return self.send_text(304, '', headers)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.send_text(status, body, headers)
+
+    # Helpers
+
+    def paginate(self, query, items):
+        '''Returns a page of a list and the (page, per_page, last_page) info for the Link header.'''
+        page, per_page = self.page_params(query)
+        last_page = max(1, (len(items) + per_page - 1) // per_page)
+        return items[(page - 1) * per_page:page * per_page], (page, per_page, last_page)
+
+    def page_params(self, query):
+        try:
+            page = max(1, int(query.get('page', ['1'])[0]))
+        except ValueError:
+            page = 1
+        try:
+            per_page = min(self.server.max_per_page, max(1, int(query.get('per_page', ['10'])[0])))
+        except ValueError:
+            per_page = 10
+        return page, per_page
+
+    def link_header(self, path, query, page, per_page, last_page):
+        base = 'http://%s%s' % (self.headers.get('Host', '%s:%s' % self.server.server_address), path)
+        def link(rel, n):
+            q = dict([(k, v) for k, v in query.items() if k not in ('page', 'per_page')])
+            q['page'] = [str(n)]
+            q['per_page'] = [str(per_page)]
+            return '<%s?%s>; rel="%s"' % (base, urllib.urlencode(q, doseq=True), rel)
+        links = [link('current', page)]
+        if page < last_page:
+            links.append(link('next', page + 1))
+        if page > 1:
+            links.append(link('prev', page - 1))
+        links.append(link('first', 1))
+        links.append(link('last', last_page))
+        return ','.join(links)
+
+    def send_json(self, status, data, headers=None, record=True):
+        self.send_text(status, json.dumps(data), dict(headers or {}, **{'Content-Type': 'application/json; charset=utf-8'}), record=record)
+
+    def send_text(self, status, body, headers=None, record=True):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if record:
+            self.server.record(self.endpoint, len(body))
+
+    # Endpoints: each returns (status, data, page_info or None)
+
+    def get_account_courses(self, query, account_id):
+        canvas = self.server.canvas
+        courses = canvas.courses
+        term_id = query.get('enrollment_term_id', [None])[0]
+        if term_id is not None and str(canvas.term['id']) != term_id:
+            courses = []
+        items, page_info = self.paginate(query, courses)
+        return 200, items, page_info
+
+    def get_course(self, query, course_id):
+        course = self.server.canvas.course_of.get(course_id)
+        if course is None:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        return 200, course, None
+
+    def get_course_enrollments(self, query, course_id):
+        items, page_info = self.paginate(query, self.server.canvas.enrollments(course_id, query.get('type[]')))
+        return 200, items, page_info
+
+    def get_course_users(self, query, course_id):
+        items, page_info = self.paginate(query, self.server.canvas.students_of_course.get(course_id, []))
+        return 200, items, page_info
+
+    def get_course_assignments(self, query, course_id):
+        items, page_info = self.paginate(query, self.server.canvas.assignments_of_course.get(course_id, []))
+        return 200, items, page_info
+
+    def get_assignment_submissions(self, query, course_id, assignment_id):
+        if assignment_id not in self.server.canvas.assignment_of:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        include_rubric = 'rubric_assessment' in query.get('include[]', []) + query.get('include', [])
+        items, page_info = self.paginate(query, self.server.canvas.submissions(course_id, assignment_id, include_rubric))
+        return 200, items, page_info
+
+    def get_user_profile(self, query, user_id):
+        student = self.server.canvas.student_of.get(user_id)
+        if student is None:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        profile = dict(student)
+        profile['primary_email'] = profile.pop('email')
+        return 200, profile, None
+
+    def get_user_page_views(self, query, user_id):
+        canvas = self.server.canvas
+        if user_id not in canvas.student_of:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        start_time = end_time = None
+        if 'start_time' in query:
+            start_time = _parse_time(query['start_time'][0])
+        if 'end_time' in query:
+            end_time = _parse_time(query['end_time'][0])
+        first, last = canvas.page_view_range(user_id, start_time, end_time)
+        page, per_page = self.page_params(query)
+        last_page = max(1, (last - first + per_page - 1) // per_page)
+        start = first + (page - 1) * per_page
+        items = [canvas.page_view(user_id, i) for i in range(start, min(last, start + per_page))]
+        return 200, items, (page, per_page, last_page)
+
+    def get_student_summaries(self, query, course_id):
+        if course_id not in self.server.canvas.course_of:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        items, page_info = self.paginate(query, self.server.canvas.student_summaries(course_id))
+        return 200, items, page_info
+
+    def get_course_activity(self, query, course_id):
+        if course_id not in self.server.canvas.course_of:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        return 200, self.server.canvas.course_activity(course_id), None
+
+    def get_user_activity(self, query, course_id, user_id):
+        activity = self.server.canvas.user_activity(course_id, user_id)
+        if activity is None:
+            return 404, {'errors': [{'message': 'The specified resource does not exist.'}]}, None
+        return 200, activity, None
+
+class MockCanvasServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Threaded HTTP server holding the synthetic data and request stats.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, canvas, bucket=None, cost_per_item=0.01, max_per_page=100, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, MockCanvasHandler)
+        self.canvas = canvas
+        self.bucket = bucket
+        self.cost_per_item = cost_per_item
+        self.max_per_page = max_per_page
+        self.verbose = verbose
+        self.stats_lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return 'http://%s:%s/api' % self.server_address
+
+    def reset(self):
+        with self.stats_lock:
+            self.stats = {'requests': 0, 'bytes': 0, 'throttled': 0, 'endpoints': {}}
+        if self.bucket is not None:
+            self.bucket.reset()
+
+    def record(self, endpoint, num_bytes):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += num_bytes
+            endpoint_stats = self.stats['endpoints'].setdefault(endpoint, {'requests': 0, 'bytes': 0, 'throttled': 0})
+            endpoint_stats['requests'] += 1
+            endpoint_stats['bytes'] += num_bytes
+
+    def record_throttled(self, endpoint):
+        with self.stats_lock:
+            self.stats['throttled'] += 1
+            self.stats['endpoints'].setdefault(endpoint, {'requests': 0, 'bytes': 0, 'throttled': 0})['throttled'] += 1
+
+    def stats_snapshot(self):
+        with self.stats_lock:
+            return json.loads(json.dumps(self.stats))
+
+def add_scale_arguments(parser):
+    '''Adds the arguments controlling the size of the synthetic data set.'''
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the synthetic data. Default: 1")
+    parser.add_argument('--courses', type=int, default=5, help="Number of courses in the account. Default: 5")
+    parser.add_argument('--students', type=int, default=1000, help="Number of students in the account. Default: 1000")
+    parser.add_argument('--courses_per_student', type=int, default=3, help="Number of courses each student is enrolled in. Default: 3")
+    parser.add_argument('--assignments_per_course', type=int, default=20, help="Number of assignments in each course. Default: 20")
+    parser.add_argument('--page_views', type=int, default=100000, help="Total number of page views across all students. Default: 100000")
+    parser.add_argument('--page_view_base_url', default='https://canvas.harvard.edu', help="Scheme and host used in page view URLs. Default: https://canvas.harvard.edu")
+    parser.add_argument('--rate_limit', type=float, default=100.0, help="Quota units per second that leak out of the rate limit bucket (0 disables rate limiting). Default: 100")
+    parser.add_argument('--cost_per_item', type=float, default=0.01, help="Quota cost of each object in a response. Default: 0.01")
+
+def create_server(args, host='127.0.0.1', port=0, verbose=False):
+    '''Creates a MockCanvasServer from parsed arguments (see add_scale_arguments()).'''
+    canvas = SyntheticCanvas(seed=args.seed, courses=args.courses, students=args.students,
+        courses_per_student=args.courses_per_student, assignments_per_course=args.assignments_per_course,
+        page_views=args.page_views, page_view_base_url=args.page_view_base_url)
+    bucket = None
+    if args.rate_limit > 0:
+        bucket = RateLimitBucket(leak_rate=args.rate_limit)
+    return MockCanvasServer((host, port), canvas, bucket=bucket, cost_per_item=args.cost_per_item, verbose=verbose)
+
+def start_server(server):
+    '''Serves requests in a background thread and returns the thread.'''
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a synthetic Canvas API for benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. Default: 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on. Default: 8000")
+    parser.add_argument('--verbose', action='store_true', help="Log every request.")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    server = create_server(args, host=args.host, port=args.port, verbose=args.verbose)
+    canvas = server.canvas
+    print "Serving %d courses, %d students and %d page views at %s/v1" % (len(canvas.courses), len(canvas.students), args.page_views, server.url)
+    print "Account ID: %s, Term ID: %s, Course IDs: %s-%s" % (canvas.account_id, canvas.term['id'], canvas.courses[0]['id'], canvas.courses[-1]['id'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+Fetches an API endpoint for each ID in a file, and writes the results as
+newline-delimited JSON (one object per line).
+
+The endpoint is a template like "users/{id}/profile", relative to the API
+base URL. Paginated lists are followed to the last page, and the IDs are
+fetched concurrently over a shared connection pool:
+
+    $ export CANVAS_URL='https://canvas.harvard.edu/api' OAUTH_TOKEN='mytoken'
+    $ ./bulk_fetch.py 'users/{id}/profile' --ids user_ids.txt --concurrency 16 --output profiles.ndjson
+    $ ./bulk_fetch.py 'courses/{id}/assignments' --ids course_ids.txt --fields id,name,due_at
+    $ ./bulk_fetch.py 'users/{id}/page_views' --ids user_ids.txt --params 'start_time=2016-01-25&end_time=2016-05-14'
+
+Each line is {"id": ID, "data": OBJECT}, with one line per object of a list.
+An ID that fails gets an error record instead (after the objects fetched
+before the failure, if any):
+
+    {"id": "123", "error": {"status": 404, "url": "...", "message": "..."}}
+
+Lines are written in the order the IDs complete, all the lines of an ID at
+once. With --resume, the IDs whose last fetch in the output file succeeded
+are skipped and the new results are appended.
+'''
+import os
+import sys
+import json
+import time
+import urllib
+import urlparse
+import argparse
+import logging
+import threading
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.client import CanvasClient, CanvasClientError, api_base_url
+from canvasutils.metrics import METRICS
+from canvasutils.logs import configure_logging, add_logging_arguments
+from canvasutils.httpcache import ConditionalCache
+
+logger = logging.getLogger(__name__)
+
+def read_ids(path):
+    '''Returns the IDs in a file (or stdin for "-"), one per line. Blank lines and # comments are skipped.'''
+    f = path == '-' and sys.stdin or open(path, 'r')
+    try:
+        ids = [line.split('#', 1)[0].strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return [i for i in ids if i]
+
+def read_done_ids(path):
+    '''
+    Returns the IDs whose last fetch in an output file succeeded. The lines of
+    a fetch are written together, ending with the error record if it failed,
+    so the last record of an ID tells whether its last fetch succeeded (an ID
+    that failed and then succeeded on a resumed run is done).
+    '''
+    failed = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # a partial line from an interrupted run
+            failed[record.get('id')] = 'error' in record
+    return set([item_id for item_id, had_error in failed.iteritems() if not had_error])
+
+class BulkFetcher(object):
+    '''
+    Fetches an endpoint template for many IDs and writes the results to
+    `output` as they arrive (see the module docstring).
+    '''
+    def __init__(self, client, endpoint, output, params=None, fields=None):
+        self.client = client
+        self.endpoint = '/' + endpoint.lstrip('/')
+        self.output = output
+        self.params = params
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.num_objects = 0
+        self.num_errors = 0
+
+    def url(self, item_id):
+        return self.endpoint.replace('{id}', urllib.quote(str(item_id), safe=''))
+
+    def write(self, records):
+        lines = ''.join([json.dumps(record, sort_keys=True) + '\n' for record in records])
+        with self.lock:
+            self.output.write(lines)
+
+    def fetch(self, item_id):
+        '''
+        Fetches the objects of one ID and writes them once all its pages have
+        arrived, so the lines of an ID are never split by an interrupted run
+        (see --resume). Returns the number of objects, or None if it failed.
+        '''
+        records = []
+        try:
+            for page in self.client.iter_pages_checkpointed(self.url(item_id), params=self.params, fields=self.fields):
+                data = page.data if isinstance(page.data, list) else [page.data]
+                records.extend([{'id': item_id, 'data': item} for item in data])
+        except (CanvasClientError, requests.exceptions.RequestException, ValueError) as e:
+            error = {'message': str(e), 'objects_before_error': len(records)}
+            if isinstance(e, CanvasClientError):
+                error.update({'status': e.status_code, 'url': e.url})
+            self.write(records + [{'id': item_id, 'error': error}])
+            with self.lock:
+                self.num_errors += 1
+            logger.warning("Failed to fetch %s: %s" % (self.url(item_id), e))
+            return None
+        self.write(records)
+        with self.lock:
+            self.num_objects += len(records)
+        return len(records)
+
+    def run(self, ids, concurrency):
+        '''Fetches all the IDs, logging the progress every 100 IDs.'''
+        started_at = time.time()
+        for index, (item_id, result) in enumerate(self.client.map(self.fetch, ids, concurrency=concurrency)):
+            if (index + 1) % 100 == 0 or index + 1 == len(ids):
+                logger.info("Fetched %d of %d IDs (%d objects, %d errors) in %.1fs" % (index + 1, len(ids), self.num_objects, self.num_errors, time.time() - started_at))
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetches an API endpoint for each ID in a file and writes the results as newline-delimited JSON.')
+    parser.add_argument('endpoint', help="Endpoint relative to the API base URL, with {id} where the ID goes, e.g. users/{id}/profile")
+    parser.add_argument('--ids', metavar='FILE', help="File with one ID per line (- for stdin). Required if the endpoint has {id}.")
+    parser.add_argument('--params', default='', help="Query string to add to each request, e.g. 'start_time=2016-01-25&include[]=email'")
+    parser.add_argument('--fields', help="Comma-separated fields to keep of each object (list endpoints only). The other fields are dropped while the response is parsed.")
+    parser.add_argument('--output', help="File to write to. Defaults to stdout.")
+    parser.add_argument('--resume', action='store_true', help="Skip the IDs that already have results in the output file, and append to it.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of IDs fetched at the same time. Defaults to 8.")
+    parser.add_argument('--per_page', type=int, default=100, help="Page size requested for paginated lists. Defaults to 100.")
+    parser.add_argument('--canvas_url', default=os.environ.get('CANVAS_URL'), help="Canvas API URL, e.g. https://canvas.harvard.edu/api. Defaults to the CANVAS_URL environment variable.")
+    parser.add_argument('--oauth_token', default=os.environ.get('OAUTH_TOKEN'), help="OAuth access token. Defaults to the OAUTH_TOKEN environment variable.")
+    parser.add_argument('--metrics', type=str, metavar='PREFIX', help="Save request metrics as a JSON summary to PREFIX.json and a Prometheus textfile to PREFIX.prom.")
+    parser.add_argument('--http_cache', type=str, metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags).")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
+
+    if not args.canvas_url or not args.oauth_token:
+        parser.error("set CANVAS_URL and OAUTH_TOKEN in the environment, or use --canvas_url and --oauth_token")
+    if '{id}' in args.endpoint:
+        if not args.ids:
+            parser.error("the endpoint has {id}, so --ids is required")
+        ids = read_ids(args.ids)
+    else:
+        ids = [None]
+    if args.resume:
+        if not args.output:
+            parser.error("--resume requires --output")
+        if os.path.exists(args.output):
+            done = read_done_ids(args.output)
+            num_ids = len(ids)
+            ids = [i for i in ids if i not in done]
+            logger.info("Skipping %d IDs that were already fetched" % (num_ids - len(ids)))
+
+    http_cache = args.http_cache and ConditionalCache(args.http_cache) or None
+    client = CanvasClient(api_base_url(args.canvas_url), args.oauth_token, per_page=args.per_page, max_connections=args.concurrency, http_cache=http_cache)
+    params = urlparse.parse_qs(args.params, keep_blank_values=True)
+    fields = args.fields and [f.strip() for f in args.fields.split(',')] or None
+
+    output = args.output and open(args.output, args.resume and 'a' or 'w') or sys.stdout
+    fetcher = BulkFetcher(client, args.endpoint, output, params=params, fields=fields)
+    try:
+        logger.info("Fetching %s for %d IDs" % (args.endpoint, len(ids)))
+        fetcher.run(ids, args.concurrency)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    METRICS.log_summary()
+    if args.metrics:
+        METRICS.save(args.metrics, labels={'script': 'bulk_fetch'})
+    if fetcher.num_errors:
+        logger.error("%d of %d IDs failed (see the error records in the output)" % (fetcher.num_errors, len(ids)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,7 @@
 
 import os
 import sys
-import re
 import argparse
-import requests
 import json
 import logging
 import csv
@@ -12,11 +10,22 @@ from datetime import date, timedelta
 from collections import Counter
 from functools import wraps
 import hashlib
+import urlparse
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.metrics import METRICS
+from canvasutils.logs import EventLogger, LazyJSON
+from canvasutils import canvasdata
+from canvasutils.sketches import HyperLogLog, SpaceSaving, sketch_from_dict
+from canvasutils.rollups import RollupStore
+from canvasutils.store import EntityStore, url_course_id
+from canvasutils import sessions
+from canvasutils.extsort import ExternalSorter
+from canvasutils.records import PageViewTable, iter_fields, to_json, epoch_seconds, format_timestamp
 
 logger = logging.getLogger(__name__)
-#logger.setLevel(logging.DEBUG)
-logger.setLevel(logging.INFO)
-logger.addHandler(logging.StreamHandler())
+events = EventLogger(logger)
 
 # Holds global settings used throughout the script
 SETTINGS = {
@@ -39,6 +48,15 @@ SETTINGS = {
     # API defaults to 10 per page when returning paginated results (i.e. for User Page Views, Enrollment, etc)
     "api_per_page": 100, 
 
+    # Number of users whose page views are fetched at the same time
+    "concurrency": 1,
+
+    # Number of processes counting page views (users are sharded across them)
+    "processes": 1,
+
+    # Only log every Nth page fetched (the other progress messages are skipped)
+    "log_sample_every": 10,
+
     # Date range for retrieving results (in ISO8601 format)
     "start_time": (date.today() - timedelta(90)).isoformat(),
     "end_time": date.today().isoformat(),
@@ -49,11 +67,72 @@ SETTINGS = {
 
     # File to save cache
     "cache_file": "cache-{hash}.json",
+
+    # Number of user page view rows sorted in memory; more rows are sorted in
+    # runs saved to temporary files and merged into the report
+    "sort_buffer_rows": 100000,
+
+    # Report the page views and participations of each student from the course analytics
+    # endpoints instead of each user's page views, and whether to also report each student's
+    # page views by hour (one request per student) and the page views by URL (supplied from CLI)
+    "analytics": False,
+    "analytics_user_activity": False,
+    "url_reports": False,
+
+    # Approximate reports with bounded memory (sketches) instead of exact counts, supplied from CLI
+    "approximate": False,
+
+    # Number of URLs in the approximate top URLs report
+    "top_urls": 1000,
+
+    # File to save the sketches of an approximate report, and sketch files to merge into it (supplied from CLI)
+    "sketch_file": "sketch_{course_id}_{start_time}-{end_time}.json",
+    "merge_sketches": [],
+
+    # SQLite database of hourly, daily and weekly page view rollups to update, supplied from CLI
+    "rollups": None,
+
+    # SQLite entity store to save the course, enrollments and page views in, and to count the
+    # exact reports with indexed queries of (supplied from CLI)
+    "entity_store": None,
+
+    # Report study sessions, split when a user is inactive for more than session_gap minutes (supplied from CLI)
+    "sessions": False,
+    "session_gap": 30,
+
+    # File prefix for saving request metrics (PREFIX.json and PREFIX.prom), supplied from CLI
+    "metrics": None,
+
+    # Canvas Data "requests" file or directory to read page views from instead of the API, supplied from CLI
+    "canvas_data": None,
+
+    # Directory to keep API responses in for conditional requests (ETags), supplied from CLI
+    "http_cache": None,
 }
 
+# Settings before any arguments are applied (see load_settings())
+DEFAULT_SETTINGS = dict(SETTINGS)
+
+# Fields of the page view objects that are used in the reports
+PAGE_VIEW_FIELDS = ['id', 'url', 'created_at', 'context_type']
+
 # Holds cached data
 _CACHE = {} 
 
+# Tables of the distinct URLs and context types of the page views in _CACHE,
+# shared by their PageViewTables (see reduce_user_page_views())
+_INTERNED = {}
+
+# Cache file loaded in _CACHE and its (modification time, size), so it isn't
+# read again while it's unchanged (see load_cache()), and whether _CACHE has
+# changed since it was loaded or saved
+_CACHE_FILE = None
+_CACHE_CHANGED = False
+
+# Holds the API client and the settings it was created with (see api_client())
+_CLIENT = None
+_CLIENT_SETTINGS = None
+
 def read_oauth_token():
     '''Returns the oauth token contained in the config file.'''
     logger.debug("Reading OAuth token from file...")
@@ -67,32 +146,71 @@ def read_oauth_token():
 
     return oauth_token
 
-def load_settings():
-    '''Loads the script settings into the SETTINGS global variable.'''
+def load_settings(argv=None):
+    '''
+    Loads the script settings into the SETTINGS global variable, from the
+    command line or the given list of arguments.
+    '''
     parser = argparse.ArgumentParser(description='Aggregates data about page views for a course in the Canvas LMS')
     parser.add_argument('course_id', type=int, help="The ID of the course object")
     parser.add_argument('--oauth_token', type=str, help="OAuth access token for Canavs API requests. Defaults to the value in %s (if present)." % SETTINGS['oauth_file'])
     parser.add_argument('--start_time', type=str, help="Start time ISO 8601 format YYYY-MM-DD. Defaults to 90 days ago.")
     parser.add_argument('--end_time', type=str, help="End time ISO 8601 format YYYY-MM-DD. Defaults to today.")
     parser.add_argument('--enrollment_types',  nargs='*',  default=[], help='Enrollment types to include: StudentEnrollment TeacherEnrollment TaEnrollment DesignerEnrollment ObserverEnrollment. If omitted, includes all types.')
-    args = parser.parse_args()
-
+    parser.add_argument('--api_base_url', type=str, help="API base URL. Defaults to %s." % SETTINGS['api_base_url'])
+    parser.add_argument('--concurrency', type=int, default=SETTINGS['concurrency'], help="Number of users whose page views are fetched at the same time. Defaults to %s." % SETTINGS['concurrency'])
+    parser.add_argument('--processes', type=int, default=SETTINGS['processes'], help="Number of processes counting page views, each with a share of the users (at most the number of CPUs). Defaults to %s." % SETTINGS['processes'])
+    parser.add_argument('--sort_buffer_rows', type=int, default=SETTINGS['sort_buffer_rows'], metavar='ROWS', help="Number of user page view rows sorted in memory. Larger reports are sorted in runs saved to temporary files. Defaults to %s." % SETTINGS['sort_buffer_rows'])
+    parser.add_argument('--analytics', action='store_true', help="Report the page views and participations of each student, and the course activity by day, from the course analytics (a few requests) instead of fetching every user's page views. User page views are then only fetched for --url_reports, --approximate, --sessions and --rollups.")
+    parser.add_argument('--analytics_user_activity', action='store_true', help="With --analytics, also report each student's page views by hour (one request per student).")
+    parser.add_argument('--url_reports', action='store_true', help="With --analytics, also fetch every user's page views for the page views by URL reports.")
+    parser.add_argument('--approximate', action='store_true', help="Report the top URLs and the unique users per URL category from bounded-memory sketches instead of counting every URL and user exactly. The sketches are saved to %s." % SETTINGS['sketch_file'])
+    parser.add_argument('--top_urls', type=int, default=SETTINGS['top_urls'], help="Number of URLs kept in the approximate top URLs report. Defaults to %s." % SETTINGS['top_urls'])
+    parser.add_argument('--merge_sketches', nargs='*', default=[], metavar='FILE', help="Sketch files of other runs or courses to merge into the approximate report.")
+    parser.add_argument('--rollups', type=str, metavar='DB', help="Add the page views to the hourly, daily and weekly rollups in the SQLite database DB (created if needed). Query them with query_rollups.py.")
+    parser.add_argument('--entity_store', type=str, metavar='DB', help="Save the course, its enrollments and the page views to the SQLite entity store DB (created if needed), shared with the other scripts, and count the exact reports with queries of it.")
+    parser.add_argument('--sessions', action='store_true', help="Also report study sessions per user and per user and week.")
+    parser.add_argument('--session_gap', type=int, default=SETTINGS['session_gap'], metavar='MINUTES', help="Start a new session when a user has no page views for this many minutes. Defaults to %s." % SETTINGS['session_gap'])
+    parser.add_argument('--metrics', type=str, metavar='PREFIX', help="Save request metrics as a JSON summary to PREFIX.json and a Prometheus textfile to PREFIX.prom.")
+    parser.add_argument('--log_sample_every', type=int, default=SETTINGS['log_sample_every'], help="Log the progress of every Nth page fetched. Defaults to %s." % SETTINGS['log_sample_every'])
+    parser.add_argument('--canvas_data', type=str, metavar='PATH', help="Read page views from Canvas Data requests files (a .gz/.tsv file or a directory of them) instead of the API. All users with page views in the course are counted.")
+    parser.add_argument('--http_cache', type=str, metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags). Useful when the cache file is deleted for a full refresh.")
+    args = parser.parse_args(argv)
+
+    SETTINGS.update(DEFAULT_SETTINGS)
     SETTINGS['course_id'] = args.course_id
+    SETTINGS['http_cache'] = args.http_cache
+    SETTINGS['canvas_data'] = args.canvas_data
+    SETTINGS['log_sample_every'] = args.log_sample_every
+    SETTINGS['metrics'] = args.metrics
     SETTINGS['enrollment_types'] = args.enrollment_types
+    SETTINGS['concurrency'] = args.concurrency
+    SETTINGS['processes'] = args.processes
+    SETTINGS['sort_buffer_rows'] = args.sort_buffer_rows
+    SETTINGS['analytics'] = args.analytics or args.analytics_user_activity
+    SETTINGS['analytics_user_activity'] = args.analytics_user_activity
+    SETTINGS['url_reports'] = args.url_reports
+    SETTINGS['approximate'] = args.approximate or len(args.merge_sketches) > 0
+    SETTINGS['top_urls'] = args.top_urls
+    SETTINGS['merge_sketches'] = args.merge_sketches
+    SETTINGS['rollups'] = args.rollups
+    SETTINGS['entity_store'] = args.entity_store
+    SETTINGS['sessions'] = args.sessions
+    SETTINGS['session_gap'] = args.session_gap
+
+    if args.api_base_url is not None:
+        SETTINGS['api_base_url'] = args.api_base_url
 
     if args.oauth_token is not None:
         SETTINGS['oauth_token'] = args.oauth_token
-    else:
+    elif args.canvas_data is None:
         SETTINGS['oauth_token'] = read_oauth_token()
 
-    if args.start_time is not None:
-        SETTINGS['start_time'] = args.start_time
-
-    if args.end_time is not None:
-        SETTINGS['end_time'] = args.end_time
+    SETTINGS['start_time'] = args.start_time or (date.today() - timedelta(90)).isoformat()
+    SETTINGS['end_time'] = args.end_time or date.today().isoformat()
 
     logger.info("Loaded script settings")
-    logger.debug("Settings: %s" % SETTINGS)
+    logger.debug("Settings: %s", SETTINGS)
 
 def cid():
     '''Convenience function used to return the course_id.'''
@@ -102,30 +220,22 @@ def jsonpp(jsondata):
     '''Convenience function to pretty print JSON.'''
     return json.dumps(jsondata, separators=(',',':'), indent=4, sort_keys=True)
 
-def extract_header_links(link_header):
+def write_json_rows(json_file, json_data, rows):
     '''
-    Extracts the "Link:" header from the response and returns a dictionary mapping rel => url.
-
-    See also: https://canvas.instructure.com/doc/api/file.pagination.html
-
-    Parameters:
-    - link_header: a string containing the value of the "Link" header
-
-    Returns:
-    - a dictionary mapping each link relationship to its corresponding URL
+    Writes json_data formatted like jsonpp(), with the rows as its "data"
+    list. The rows are written one at a time, so they can come from an
+    iterator that doesn't hold them all in memory.
     '''
-    result = {}
-    if not link_header:
-        return result 
-
-    p = re.compile(ur'<([^<>]+)>;\s*rel="([^"]+)",?')
-    matches = re.findall(p, link_header)
-    result = {m[1]:m[0] for m in matches}
-
-    logger.debug("Extracted header links=%s", result)
-
-    return result
-
+    head, tail = jsonpp(dict(json_data, data=[None])).split('\n        null\n')
+    json_file.write(head)
+    separator = '\n        '
+    for row in rows:
+        json_file.write(separator + jsonpp(row).replace('\n', '\n        '))
+        separator = ',\n        '
+    if separator == '\n        ':
+        json_file.write(tail.lstrip())
+    else:
+        json_file.write('\n' + tail)
 
 def api_url(url):
     '''Returns the full URL to use for making requests to the API, assuming it's not an absolute URL.'''
@@ -133,6 +243,23 @@ def api_url(url):
         return url
     return SETTINGS['api_base_url'] + url
 
+def api_client():
+    '''Returns the API client, creating it the first time it's needed.'''
+    global _CLIENT, _CLIENT_SETTINGS
+    # Imported here rather than at the top (with requests), so runs that
+    # read the page views from the cache start quickly
+    from canvasutils.client import CanvasClient
+    from canvasutils.httpcache import ConditionalCache
+    client_settings = [SETTINGS[k] for k in ('api_base_url', 'oauth_token', 'api_per_page', 'concurrency', 'http_cache')]
+    if _CLIENT is None or client_settings != _CLIENT_SETTINGS:
+        http_cache = None
+        if SETTINGS['http_cache']:
+            http_cache = ConditionalCache(SETTINGS['http_cache'])
+        _CLIENT = CanvasClient(SETTINGS['api_base_url'], SETTINGS['oauth_token'],
+            per_page=SETTINGS['api_per_page'], max_connections=max(SETTINGS['concurrency'], 1), http_cache=http_cache)
+        _CLIENT_SETTINGS = client_settings
+    return _CLIENT
+
 def api_fetch_cache(f): 
     '''
     Decorator that wraps the api_fetch() function and returns values from the
@@ -142,27 +269,51 @@ def api_fetch_cache(f):
     '''
     @wraps(f)
     def wrapper(*args, **kwargs):
+        global _CACHE_CHANGED
         url = args[0]
         params = kwargs.get('params', None)
         _CACHE = f.func_globals['_CACHE']
 
-        cache_key_str = url 
-        if params is not None:
-            cache_key_str = cache_key_str + "?" + "&".join([k+"="+str(params[k]) for k in params])
-
-        cache_key = hashlib.md5(bytes(cache_key_str)).hexdigest()
+        cache_key, cache_key_str = api_cache_key(url, params)
 
-        if cache_key in _CACHE:
+        entry = _CACHE.get(cache_key)
+        if entry is not None and entry.get("complete", True):
+            METRICS.cache_hit("api_fetch")
             logger.info("Retrieved %s from cache with params=%s" % (url, params))
-            logger.debug("Cache hit %s (%s)" % (cache_key, cache_key_str))
-            return _CACHE[cache_key]["data"]
+            logger.debug("Cache hit %s (%s)", cache_key, cache_key_str)
+            return entry["data"]
+
+        # Incomplete entries hold the checkpoint of a chain of pages that failed
+        # part way, so the fetch picks up from the page that failed. The entry is
+        # in the cache while fetching, so it's saved even if the script is interrupted.
+        # The pages fetched so far are only kept in the checkpoint (the results
+        # are built from them again when resuming), not as the entry's data too.
+        if entry is not None:
+            checkpoint = entry["checkpoint"]
+            logger.info("Resuming %s from %s" % (url, checkpoint.get("next_url")))
         else:
-            logger.debug("Cache miss %s (%s)... fetching from API" % (cache_key, cache_key_str))
-            result = f(*args, **kwargs)
+            logger.debug("Cache miss %s (%s)... fetching from API", cache_key, cache_key_str)
+            checkpoint = {}
+        METRICS.cache_miss("api_fetch")
+        entry = {"key": cache_key_str, "complete": False, "checkpoint": checkpoint}
+        _CACHE[cache_key] = entry
+        _CACHE_CHANGED = True
+
+        result = f(*args, checkpoint=checkpoint, **kwargs)
+        if checkpoint.get("complete"):
             _CACHE[cache_key] = {"data": result, "key": cache_key_str}
-            return result
+        else:
+            logger.warning("Incomplete results for %s with params=%s will be resumed on the next run" % (url, params))
+        return result
     return wrapper
 
+def api_cache_key(url, params=None):
+    '''Returns the key of a request in the cache, and the string it's a hash of.'''
+    cache_key_str = url 
+    if params is not None:
+        cache_key_str = cache_key_str + "?" + "&".join([k+"="+str(params[k]) for k in params])
+    return hashlib.md5(bytes(cache_key_str)).hexdigest(), cache_key_str
+
 def file_cache_key():
     '''Returns a hash of the parameters for the data set.'''
     format_str = "{course_id}_{enrollment_types}_{start_time}_{end_time}"
@@ -173,32 +324,73 @@ def file_cache_key():
         end_time=SETTINGS['end_time'])
     return hashlib.md5(bytes(result_str)).hexdigest()
 
+def cache_file_stat(cachefile):
+    '''Returns the (modification time, size) of the cache file.'''
+    stat = os.stat(cachefile)
+    return stat.st_mtime, stat.st_size
+
 def save_cache():
-    '''Writes out the cache to a file.'''
+    '''Writes out the cache to a file (unless it's unchanged since it was loaded from the file).'''
+    global _CACHE_FILE, _CACHE_CHANGED
     cachefile = SETTINGS['cache_file'].format(hash=file_cache_key())
+    if not _CACHE_CHANGED and _CACHE_FILE is not None and _CACHE_FILE[0] == cachefile:
+        logger.info("Cache file %s is up to date" % cachefile)
+        return
     logger.info("Saving cache to file %s..." % cachefile)
     with open(cachefile, "w") as f:
-        f.write(json.dumps(_CACHE, separators=(',',':'), indent=4))
+        # Written piece by piece, and the PageViewTables are turned back
+        # into lists of dicts one at a time (see to_json())
+        json.dump(_CACHE, f, separators=(',',':'), indent=4, default=to_json)
+    _CACHE_FILE = (cachefile, cache_file_stat(cachefile))
+    _CACHE_CHANGED = False
+
+def save_metrics():
+    '''Logs a summary of the API requests and saves the metrics if requested.'''
+    METRICS.log_summary(logger)
+    if SETTINGS['metrics']:
+        METRICS.save(SETTINGS['metrics'], labels={"script": "canvas_page_views", "course_id": cid()})
 
 def load_cache():
-    '''Loads the cache into memory.'''
-    global _CACHE
-    _CACHE = {}
+    '''
+    Loads the cache into memory, unless the same cache file was loaded (or
+    saved) last and hasn't changed since, e.g. when running several reports
+    in one process.
+    '''
+    global _CACHE, _CACHE_FILE, _CACHE_CHANGED, _INTERNED
 
     cachefile = SETTINGS['cache_file'].format(hash=file_cache_key())
+    if _CACHE_FILE is not None and os.path.exists(cachefile) and _CACHE_FILE == (cachefile, cache_file_stat(cachefile)):
+        logger.info("Cache file %s is already loaded (%s keys)" % (cachefile, len(_CACHE)))
+        return
+
+    _CACHE = {}
+    _CACHE_FILE = None
+    _INTERNED = {}
     logger.info("Loading cache file %s" % cachefile)
 
     if os.path.exists(cachefile):
         with open(cachefile, "r") as f:
             result = f.read().strip()
             if result:
-                _CACHE = json.loads(result)
+                _CACHE = json.loads(result, object_hook=compact_cache_entry)
+        _CACHE_FILE = (cachefile, cache_file_stat(cachefile))
+        _CACHE_CHANGED = False
         logger.info("Cache file loaded")
     else:
         logger.info("Cache file not found")
 
     logger.info("Cache has %s keys" % len(_CACHE))
 
+def compact_cache_entry(obj):
+    '''
+    JSON object hook that stores the page views of user page view cache
+    entries in a PageViewTable as the cache file is parsed, so the page view
+    dicts of only one entry are in memory at a time.
+    '''
+    if '/page_views' in obj.get('key', '') and isinstance(obj.get('data'), list):
+        obj['data'] = PageViewTable.from_dicts(obj['data'], PAGE_VIEW_FIELDS, interned=_INTERNED)
+    return obj
+
 @api_fetch_cache
 def api_fetch(url, **kwargs):
     '''
@@ -213,43 +405,45 @@ def api_fetch(url, **kwargs):
 
     Optional keyword arguments:
     - params: a dictionary of parameters to include in the URL
-    - response_data: an initial list of data objects to augment
+    - action: a function applied to the list of pages before it's returned
+    - fields: if the resource is a list of objects, only keep these fields of
+      each object (they're picked out while the response is parsed)
+    - checkpoint: a dictionary holding the progress through the pages, which is
+      updated as pages arrive (see CanvasClient.iter_pages_checkpointed()).
+      checkpoint['pages'] holds the pages fetched so far, and when
+      checkpoint['complete'] is not True after the call, the results are
+      incomplete and the fetch can be resumed by calling again with it.
 
     Returns:
     - A list of data objects
     '''
-    # curl -H "Authorization: Bearer <ACCESS-TOKEN>" https://canvas.instructure.com/api/v1/courses
-    headers = {'Authorization': 'Bearer %s' % SETTINGS['oauth_token']}
     request_url = api_url(url)
     params = kwargs.get('params', None)
     action = kwargs.get('action', None)
-    response_data = []
-    result = None
-    has_next = True
-    page_num = 0
-
+    fields = kwargs.get('fields', None)
+    checkpoint = kwargs.get('checkpoint', None)
+    if checkpoint is None:
+        checkpoint = {}
+    response_data = checkpoint.setdefault('pages', [])
+    page_num = len(response_data)
+
+    from canvasutils.client import CanvasClientError
     logger.info("\tRequest Initiated [url=%s]" % request_url)
-    while has_next:
+    try:
+        for page in api_client().iter_pages_checkpointed(request_url, params=params, checkpoint=checkpoint, fields=fields):
+            page_num += 1
+            events.info("page_fetched", sample_every=SETTINGS['log_sample_every'], page=page_num, url=page.url, status=page.status_code, items=len(page.data))
+            logger.debug("Response headers=%s", LazyJSON(dict(page.headers)))
+            response_data.append(page.data)
+    except CanvasClientError as e:
         page_num += 1
-        r = requests.get(request_url, headers=headers, params=params)
-        logger.info("\tRequest In Progress [page=%d] [request_url=%s] [response_code=%s]" % (page_num, r.url, r.status_code))
-        logger.debug("Response headers=%s" % r.headers)
-
-        if r.status_code == 200:
-            logger.debug("\tResponse data=%s" % r.text)
-            result = json.loads(r.text)
-            response_data.append(result)
-        else:
-            logger.debug("\tNo response data")
-
-        links = extract_header_links(r.headers.get('link'))
-        has_next = 'next' in links
-        if has_next:
-            request_url = links['next']
-            params = None # cleared params because link url is opaque
+        logger.warning("\tRequest Failed [page=%d] [request_url=%s] [response_code=%s]" % (page_num, e.url, e.status_code))
+        # Errors like 401 Unauthorized or 404 Not Found won't go away by trying again later
+        if not e.retriable:
+            checkpoint['complete'] = True
 
     if action is not None and hasattr(action, '__call__'):
-        response_data = action(response_data)
+        response_data = action(list(response_data))
 
     logger.info("\tRequest Completed [pages=%d] [total_size=%d]" % (page_num, sum([isinstance(p, list) and len(p) or 1 for p in response_data])))
 
@@ -259,7 +453,7 @@ def fetch_course():
     '''Fetches Course data from the API.'''
     url = '/courses/{course_id}'.format(course_id=cid())
     data = api_fetch(url)
-    logger.debug("Course object=%s" % jsonpp(data))
+    logger.debug("Course object=%s", LazyJSON(data))
     if len(data) == 1: 
         return data[0]
     return None
@@ -271,21 +465,69 @@ def fetch_course_enrollment():
     if len(SETTINGS['enrollment_types']) > 0:
         params['type[]'] = SETTINGS['enrollment_types']
     data = api_fetch(url, params=params, action=reduce_enrollment)
-    logger.debug("Course enrollment object=%s" % jsonpp(data))
+    logger.debug("Course enrollment object=%s", LazyJSON(data))
     return data
 
-def fetch_user_page_views(user_id, start_time, end_time):
-    '''Fetches User Page View objects from the API for a given user and date range.'''
+def user_page_views_request(user_id, start_time, end_time, per_page):
+    '''Returns the URL and parameters of the request for a user's page views.'''
     url = '/users/{user_id}/page_views'.format(user_id=user_id)
     params = {
         "start_time": start_time, 
         "end_time": end_time, 
-        "per_page": SETTINGS['api_per_page']
+        "per_page": per_page
     }
-    data = api_fetch(url, params=params, action=reduce_user_page_views)
-    logger.debug("Page views for user_id=%s object=%s" % (user_id, jsonpp(data)))
+    return url, params
+
+def fetch_user_page_views(user_id, start_time, end_time):
+    '''Fetches User Page View objects from the API for a given user and date range.'''
+    url, params = user_page_views_request(user_id, start_time, end_time, SETTINGS['api_per_page'])
+    data = api_fetch(url, params=params, action=reduce_user_page_views, fields=PAGE_VIEW_FIELDS)
+    logger.debug("Page views for user_id=%s object=%s", user_id, LazyJSON(data))
     return data
 
+def incomplete_user_ids(user_ids):
+    '''
+    Returns the set of the users whose page views in the cache are incomplete
+    (see api_fetch_cache()).
+    '''
+    incomplete = set()
+    for user_id in user_ids:
+        url, params = user_page_views_request(user_id, SETTINGS['start_time'], SETTINGS['end_time'], SETTINGS['api_per_page'])
+        entry = _CACHE.get(api_cache_key(url, params)[0])
+        if entry is not None and not entry.get("complete", True):
+            incomplete.add(user_id)
+    return incomplete
+
+def fetch_student_summaries():
+    '''
+    Fetches the page views and participations of each student in the course
+    from the course analytics (over the whole course, not the date range).
+
+    https://canvas.instructure.com/doc/api/analytics.html#method.analytics_api.course_student_summaries
+    '''
+    url = '/courses/{course_id}/analytics/student_summaries'.format(course_id=cid())
+    return api_client().get_all(url, fields=['id', 'page_views', 'participations'])
+
+def fetch_course_activity():
+    '''
+    Fetches the page views and participations in the course by day from the
+    course analytics.
+
+    https://canvas.instructure.com/doc/api/analytics.html#method.analytics_api.course_participation
+    '''
+    url = '/courses/{course_id}/analytics/activity'.format(course_id=cid())
+    return api_client().get_all(url)
+
+def fetch_user_activity(user_id):
+    '''
+    Fetches a student's page views in the course by hour, and participations,
+    from the course analytics.
+
+    https://canvas.instructure.com/doc/api/analytics.html#method.analytics_api.student_in_course_participation
+    '''
+    url = '/courses/{course_id}/analytics/users/{user_id}/activity'.format(course_id=cid(), user_id=user_id)
+    return api_client().get_one(url)
+
 def reduce_paginated_data(data, whitelist=None):
     '''
     Flattens (joins all pages into one giant page) and reduces (scrubs data not in the whitelist).
@@ -300,22 +542,27 @@ def reduce_paginated_data(data, whitelist=None):
 
 def reduce_enrollment(data):
     '''Returns a flattened enrollment list (not paginated).'''
-    return reduce_paginated_data(data, ['id', 'course_id', 'user_id'])
+    return reduce_paginated_data(data, ['id', 'course_id', 'user_id', 'type'])
 
 def reduce_user_page_views(data):
-    '''Returns a user page veiws list (not paginated).'''
-    filtered_data = []
-    whitelist = ['id', 'url', 'created_at', 'context_type']
-    for d in reduce_paginated_data(data, whitelist):
-        if d['context_type'] == 'Course':
-            filtered_data.append(d)
+    '''
+    Returns a user's course page views (not paginated) as a PageViewTable,
+    which stores them in a fraction of the memory of a list of dicts.
+    '''
+    filtered_data = PageViewTable(PAGE_VIEW_FIELDS, interned=_INTERNED)
+    for page in data:
+        for d in page:
+            if d.get('context_type') == 'Course':
+                filtered_data.append(d)
     return filtered_data
 
 def save_data(items):
     '''
     Saves data to a CSV or JSON file (defaults to CSV).
     Input: 
-        - items: an array of data dictionaries
+        - items: an array of data dictionaries (the items of each one can
+          be any iterable that can be iterated more than once, such as
+          an ExternalSorter)
         [{
             "format": "csv",
             "name": "total-pageviews",
@@ -353,28 +600,43 @@ def save_data(items):
                     "start_time": start_time,
                     "end_time": end_time, 
                     "course_id": course_id,
-                    "data": []
                 }
-                for row in data['items']:
-                    json_row = {}
-                    for idx, value in enumerate(row):
-                        json_row[data['labels'][idx]] = value
-                    json_data['data'].append(json_row)
-                json_file.write(jsonpp(json_data))
+                json_rows = (dict(zip(data['labels'], row)) for row in data['items'])
+                write_json_rows(json_file, json_data, json_rows)
         else:
             raise "Data format not supported: %s" % data['format']
 
         logger.info("Saving data as %s to file %s..." % (data['format'], file_name))
 
 def is_course_url(course_id, url):
-    '''Returns true if the URL is a valid course URL for the course ID.'''
-    course_url_pattern = r'^https?://canvas.harvard.edu/(?:api/v1/)?courses/{course_id}'.format(course_id=cid())
-    result = re.search(course_url_pattern, url.lower())
-    return result is not None
+    '''
+    Returns true if the URL is a URL of the course, e.g.
+    https://canvas.harvard.edu/courses/1693/assignments/123. The entity store
+    files page views under the course ID of their URL with the same function
+    (url_course_id()), so the reports counted in memory and with queries of
+    the store (--entity_store) agree.
+    '''
+    return url_course_id(url) == int(course_id)
 
-def main():
-    '''Main script.'''
-    load_settings()
+def url_category(url):
+    '''
+    Returns the category of a course URL: the tool it belongs to, e.g.
+    "assignments" for https://canvas.harvard.edu/courses/1693/assignments/123,
+    or "home" for the course home page.
+    '''
+    path = urlparse.urlparse(url).path
+    parts = path.strip('/').split('/')
+    if parts[:2] == ['api', 'v1']:
+        parts = parts[2:]
+    if len(parts) > 2 and parts[0] == 'courses':
+        return parts[2]
+    return 'home'
+
+def fetch_page_views_by_user(entity_store=None):
+    '''
+    Fetches the page views of each user enrolled in the course from the API,
+    and saves them to the entity store, if given.
+    '''
     load_cache()
 
     logger.info("=> Fetching course data")
@@ -389,62 +651,555 @@ def main():
     user_set = set([e['user_id'] for e in enrollment if e['user_id'] is not None])
     num_users = len(user_set)
     logger.info("=> Retrieved %d enrolled users for course %s" % (num_users, course_id))
-    logger.debug("=> Enrolled users=%s" % sorted(list(user_set)))
+    logger.debug("=> Enrolled users=%s", LazyJSON(user_set))
 
     # Get each user's page views for the designated date range
     page_views_by_user = {}
     num_page_view_objects = 0
-    for index, user_id in enumerate(user_set):
-        logger.info("=> Fetching %d of %d user page views [user_id=%s]" % (index+1, num_users, user_id))
-        result = fetch_user_page_views(user_id, SETTINGS['start_time'], SETTINGS['end_time'])
-        if result is None:
-            result = []
-        else:
-            num_page_view_objects += len(result)
-        page_views_by_user[user_id] = result
-
-    logger.info("=> Fetched %d of %d user page views with %d total objects" % (index+1, num_users, num_page_view_objects))
-    logger.debug("=> Page views by user=%s" % jsonpp(page_views_by_user))
+    fetch_page_views = lambda user_id: fetch_user_page_views(user_id, SETTINGS['start_time'], SETTINGS['end_time'])
+    try:
+        for index, (user_id, result) in enumerate(api_client().map(fetch_page_views, user_set, concurrency=SETTINGS['concurrency'])):
+            logger.info("=> Fetched %d of %d user page views [user_id=%s]" % (index+1, num_users, user_id))
+            if result is None:
+                result = []
+            else:
+                num_page_view_objects += len(result)
+            page_views_by_user[user_id] = result
+    finally:
+        # Save the cache as early as possible (after all the data has been fetched),
+        # or when fetching was interrupted so the next run picks up where this one stopped
+        save_cache()
+        save_metrics()
+
+    logger.info("=> Fetched %d of %d user page views with %d total objects" % (len(page_views_by_user), num_users, num_page_view_objects))
+
+    num_incomplete = len([e for e in _CACHE.values() if not e.get("complete", True)])
+    if num_incomplete > 0:
+        logger.warning("=> %d requests returned incomplete results. Run the script again to resume them." % num_incomplete)
+
+    if entity_store is not None:
+        update_entity_store(entity_store, course, enrollment, page_views_by_user)
+
+    return page_views_by_user
+
+def read_page_views_by_user(entity_store=None):
+    '''
+    Reads the page views of each user in the course from Canvas Data requests
+    files, and saves them to the entity store, if given. URLs in the files
+    are relative, so they're made absolute with the host of the API base URL.
+    '''
+    parsed_url = urlparse.urlparse(SETTINGS['api_base_url'])
+    base_url = "%s://%s" % (parsed_url.scheme, parsed_url.netloc)
+    logger.info("=> Reading page views for course %s from %s" % (cid(), SETTINGS['canvas_data']))
+    page_views_by_user = {}
+    for user_id, page_views in canvasdata.page_views_by_user(SETTINGS['canvas_data'], course_id=cid(),
+            start_time=SETTINGS['start_time'], end_time=SETTINGS['end_time'], base_url=base_url).iteritems():
+        page_views_by_user[user_id] = reduce_user_page_views([page_views])
+    logger.info("=> Read page views of %d users with %d total objects" % (len(page_views_by_user), sum([len(v) for v in page_views_by_user.values()])))
+    if entity_store is not None:
+        update_entity_store(entity_store, None, None, page_views_by_user)
+    return page_views_by_user
+
+def update_entity_store(entity_store, course, enrollment, page_views_by_user):
+    '''
+    Saves the course, its enrollments by type (if given) and the page views
+    of each user over the date range to the entity store.
+    '''
+    course_id = cid()
+    if course is not None:
+        entity_store.upsert_courses([course])
+    if enrollment is not None:
+        user_ids_by_type = {}
+        for e in enrollment:
+            if e['user_id'] is not None:
+                user_ids_by_type.setdefault(e.get('type') or '', set()).add(e['user_id'])
+        for enrollment_type, user_ids in user_ids_by_type.iteritems():
+            entity_store.replace_enrollments({course_id: user_ids}, enrollment_type)
+    entity_store.replace_page_views(page_views_by_user, SETTINGS['start_time'], SETTINGS['end_time'])
+
+def in_date_range(timestamp):
+    '''Returns true if the day of a timestamp is between the start time (inclusive) and end time (exclusive).'''
+    return SETTINGS['start_time'] <= timestamp[:10] < SETTINGS['end_time']
+
+def utc_hour(timestamp):
+    '''Returns the UTC hour of an ISO 8601 timestamp, e.g. "2016-02-01T13:00:00Z".'''
+    seconds = epoch_seconds(timestamp)
+    return format_timestamp(seconds - seconds % 3600)
+
+def save_analytics_reports():
+    '''
+    Saves the analytics reports from the course analytics endpoints: the page
+    views and participations of each student, the course activity by day,
+    and each student's page views by hour (if requested).
 
-    # Save the cache as early as possible (after all the data has been fetched0
-    save_cache()
+    Returns False if the course analytics aren't available.
+    '''
+    from canvasutils.client import CanvasClientError
+    try:
+        summaries = fetch_student_summaries()
+        activity = fetch_course_activity()
+    except CanvasClientError as e:
+        logger.warning("=> Course analytics aren't available (%s)" % e)
+        return False
+    logger.info("=> Fetched the analytics of %d students" % len(summaries))
+
+    store_summaries = [[s['id'], s.get('page_views'), s.get('participations')] for s in summaries]
+    store_activity = [[a['date'][:10], a.get('views'), a.get('participations')] for a in activity if in_date_range(a['date'])]
+    store_hourly = None
+    if SETTINGS['analytics_user_activity']:
+        def fetch_activity(user_id):
+            try:
+                return fetch_user_activity(user_id)
+            except CanvasClientError as e:
+                logger.warning("Could not fetch the activity of user %s: %s" % (user_id, e))
+                return None
+
+        store_hourly = []
+        user_ids = [s['id'] for s in summaries]
+        for index, (user_id, result) in enumerate(api_client().map(fetch_activity, user_ids, concurrency=SETTINGS['concurrency'])):
+            logger.info("=> Fetched %d of %d user activities [user_id=%s]" % (index+1, len(user_ids), user_id))
+            if result is None:
+                continue
+            views_by_hour = Counter()
+            for hour, views in (result.get('page_views') or {}).iteritems():
+                if in_date_range(utc_hour(hour)):
+                    views_by_hour[utc_hour(hour)] += views
+            store_hourly.extend([[user_id, hour, views] for hour, views in views_by_hour.iteritems()])
+    save_metrics()
+    save_analytics_data(store_summaries, store_activity, store_hourly)
+    return True
+
+def save_analytics_from_page_views(page_views_by_user):
+    '''
+    Saves the analytics reports computed from each user's page views of
+    course URLs in the date range, when course analytics aren't available.
+    Participations aren't known, so they're left empty.
+    '''
+    course_id = cid()
+    store_summaries = []
+    views_by_day = Counter()
+    store_hourly = [] if SETTINGS['analytics_user_activity'] else None
+    for user_id in sorted(page_views_by_user):
+        views_by_hour = Counter()
+        for url, created_at in iter_fields(page_views_by_user[user_id], 'url', 'created_at'):
+            if is_course_url(course_id, url):
+                views_by_hour[utc_hour(created_at)] += 1
+        for hour, views in views_by_hour.iteritems():
+            views_by_day[hour[:10]] += views
+        store_summaries.append([user_id, sum(views_by_hour.values()), None])
+        if store_hourly is not None:
+            store_hourly.extend([[user_id, hour, views] for hour, views in views_by_hour.iteritems()])
+    store_activity = [[day, views, None] for day, views in sorted(views_by_day.iteritems())]
+    save_analytics_data(store_summaries, store_activity, store_hourly)
+
+def save_analytics_data(store_summaries, store_activity, store_hourly=None):
+    '''Saves the analytics reports (the hourly report only if it's given).'''
+    if store_hourly is not None:
+        store_hourly = sorted(store_hourly)
+    items = [{
+        "format": "csv",
+        "name": "student-summaries",
+        "labels":  ["User ID", "Page Views", "Participations"],
+        "items": store_summaries
+    },{
+        "format": "json",
+        "name": "student-summaries",
+        "labels":  ["user_id", "page_views", "participations"],
+        "items": store_summaries
+    },{
+        "format": "csv",
+        "name": "course-activity",
+        "labels":  ["Date", "Page Views", "Participations"],
+        "items": store_activity
+    },{
+        "format": "json",
+        "name": "course-activity",
+        "labels":  ["date", "page_views", "participations"],
+        "items": store_activity
+    }]
+    if store_hourly is not None:
+        items.extend([{
+            "format": "csv",
+            "name": "user-hourly-activity",
+            "labels":  ["User ID", "Hour", "Page Views"],
+            "items": store_hourly
+        },{
+            "format": "json",
+            "name": "user-hourly-activity",
+            "labels":  ["user_id", "hour", "page_views"],
+            "items": store_hourly
+        }])
+    save_data(items)
+
+def count_page_views(course_id, page_views_by_user, page_view_rows=None):
+    '''
+    Counts the page views of course URLs.
 
-    # Now process the data and count page views across the Course URL namespace
+    Returns a tuple of:
+    - a Counter of page views by URL
+    - a dict mapping each user ID to a Counter of their page views by URL
+    - a list of [user_id, url, created_at] rows, one per page view (or
+      page_view_rows, e.g. an ExternalSorter, with the rows appended)
+    '''
     total_page_views_by_url = Counter()
     total_page_views_by_user = {}
-    logger.info("=> Counting total page views across users")
+    if page_view_rows is None:
+        page_view_rows = []
     for user_id, page_views in page_views_by_user.iteritems():
         if not (user_id in total_page_views_by_user):
             total_page_views_by_user[user_id] = Counter()
-        for page_view in page_views:
-            url = page_view['url']
+        for url, created_at in iter_fields(page_views, 'url', 'created_at'):
             if is_course_url(course_id, url):
                 page_count = total_page_views_by_url.setdefault(url, 0)
                 user_page_count = total_page_views_by_user[user_id].setdefault(url, 0)
                 total_page_views_by_url[url] = page_count + 1
                 total_page_views_by_user[user_id][url] = user_page_count + 1
+                page_view_rows.append([user_id, url, created_at])
+    return total_page_views_by_url, total_page_views_by_user, page_view_rows
 
-    logger.info("=> Finished counting page views")
-    logger.debug("=> Page views by URL: %s" % jsonpp(total_page_views_by_url))
+# Page views of the users being counted, set in the workers of
+# count_page_views_sharded() (see _init_shard_worker())
+_SHARD_PAGE_VIEWS = None
 
-    # Transform the data to save in different output formats
-    logger.info("=> Preparing data for saving")
-    store_total_page_views_by_url = []
-    for url, count in total_page_views_by_url.iteritems():
-        store_total_page_views_by_url.append([url,count])
+def _init_shard_worker(page_views_by_user):
+    '''
+    Initializer of the workers of count_page_views_sharded(). The pool forks
+    the workers, so page_views_by_user is the parent's dict, shared copy-on-
+    write rather than pickled or read again from the cache file.
+    '''
+    global _SHARD_PAGE_VIEWS
+    _SHARD_PAGE_VIEWS = page_views_by_user
 
-    store_total_page_views_by_user = []
-    for user_id, page_views in total_page_views_by_user.iteritems():
-        for url, count in page_views.iteritems():
-            store_total_page_views_by_user.append([user_id, url, count])
+def _count_shard(shard):
+    '''
+    Worker of count_page_views_sharded(): counts the page views of the users
+    in the shard.
+    '''
+    settings, user_ids = shard
+    page_views_by_user = dict([(user_id, _SHARD_PAGE_VIEWS[user_id]) for user_id in user_ids])
+    if settings['approximate']:
+        return sketch_page_views(settings['course_id'], page_views_by_user, settings['top_urls'])
+    return count_page_views(settings['course_id'], page_views_by_user)
 
-    store_page_views_by_user = []
+def counting_processes():
+    '''
+    Returns the number of processes to count page views with: --processes,
+    but no more than the number of CPUs. The workers only add the cost of
+    returning their counts when they can't run in parallel.
+    '''
+    processes = SETTINGS['processes']
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        return processes
+    if processes > cpus:
+        logger.info("=> Limiting --processes %d to the number of CPUs (%d)" % (processes, cpus))
+        return cpus
+    return processes
+
+def count_page_views_sharded(page_views_by_user, processes, approximate=False, page_view_rows=None):
+    '''
+    Counts page views like count_page_views() with a pool of processes. The
+    users are split into one shard per process. The workers are forked after
+    the page views are loaded, so they read them from the parent's memory
+    rather than receiving a pickled copy or parsing the cache file. The
+    partial counts are merged as the shards complete (the rows are appended
+    to page_view_rows if it's given). With approximate=True, the workers
+    return sketches (see sketch_page_views()), which are merged instead.
+    '''
+    settings = dict([(k, SETTINGS[k]) for k in ('course_id', 'top_urls')])
+    settings['approximate'] = approximate
+    user_ids = sorted(page_views_by_user.keys())
+    num_shards = min(len(user_ids), processes) or 1
+    shards = [(settings, user_ids[i::num_shards]) for i in range(num_shards)]
+    logger.info("=> Counting page views of %d users in %d shards with %d processes" % (len(user_ids), num_shards, processes))
+
+    total_page_views_by_url = Counter()
+    total_page_views_by_user = {}
+    if page_view_rows is None:
+        page_view_rows = []
+    sketches = None
+    pool = multiprocessing.Pool(num_shards, _init_shard_worker, (page_views_by_user,))
+    try:
+        for index, result in enumerate(pool.imap_unordered(_count_shard, shards)):
+            if approximate:
+                sketches = merge_page_view_sketches(sketches, result)
+            else:
+                by_url, by_user, rows = result
+                total_page_views_by_url.update(by_url)
+                total_page_views_by_user.update(by_user)
+                page_view_rows.extend(rows)
+            logger.debug("=> Counted shard %d of %d", index + 1, num_shards)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if approximate:
+        return sketches
+    return total_page_views_by_url, total_page_views_by_user, page_view_rows
+
+def sketch_page_views(course_id, page_views_by_user, top_urls):
+    '''
+    Summarizes the page views of course URLs in bounded memory. Returns a
+    dict of sketches (see canvasutils/sketches.py):
+    - top_urls: a SpaceSaving of page views by URL
+    - users: a HyperLogLog of the users with page views
+    - users_by_category: a HyperLogLog of users for each URL category
+    - views_by_category: the number of page views of each URL category (exact)
+    '''
+    sketches = {
+        "top_urls": SpaceSaving(top_urls),
+        "users": HyperLogLog(),
+        "users_by_category": {},
+        "views_by_category": Counter(),
+    }
     for user_id, page_views in page_views_by_user.iteritems():
-        for page_view in page_views:
-            url = page_view['url']
-            created_at = page_view['created_at']
+        for url, in iter_fields(page_views, 'url'):
             if is_course_url(course_id, url):
-                store_page_views_by_user.append([user_id, url, created_at])
+                category = url_category(url)
+                sketches["top_urls"].add(url)
+                sketches["users"].add(user_id)
+                if category not in sketches["users_by_category"]:
+                    sketches["users_by_category"][category] = HyperLogLog()
+                sketches["users_by_category"][category].add(user_id)
+                sketches["views_by_category"][category] += 1
+    return sketches
+
+def merge_page_view_sketches(sketches, other):
+    '''Merges the sketches returned by sketch_page_views() (either may be None).'''
+    if sketches is None:
+        return other
+    if other is None:
+        return sketches
+    sketches["top_urls"].merge(other["top_urls"])
+    sketches["users"].merge(other["users"])
+    for category, users in other["users_by_category"].iteritems():
+        if category in sketches["users_by_category"]:
+            sketches["users_by_category"][category].merge(users)
+        else:
+            sketches["users_by_category"][category] = users
+    sketches["views_by_category"].update(other["views_by_category"])
+    return sketches
+
+def save_sketches(file_name, sketches):
+    '''Saves the sketches returned by sketch_page_views() to a JSON file.'''
+    logger.info("Saving sketches to file %s..." % file_name)
+    with open(file_name, 'w') as f:
+        json.dump({
+            "top_urls": sketches["top_urls"].to_dict(),
+            "users": sketches["users"].to_dict(),
+            "users_by_category": dict([(k, v.to_dict()) for k, v in sketches["users_by_category"].iteritems()]),
+            "views_by_category": sketches["views_by_category"],
+        }, f, separators=(',',':'))
+
+def load_sketches(file_name):
+    '''Loads sketches saved with save_sketches().'''
+    logger.info("Loading sketches from file %s" % file_name)
+    with open(file_name, 'r') as f:
+        data = json.load(f)
+    return {
+        "top_urls": sketch_from_dict(data["top_urls"]),
+        "users": sketch_from_dict(data["users"]),
+        "users_by_category": dict([(k, sketch_from_dict(v)) for k, v in data["users_by_category"].iteritems()]),
+        "views_by_category": Counter(data["views_by_category"]),
+    }
+
+def update_rollups(page_views_by_user):
+    '''
+    Adds the page views of course URLs to the rollups database, by hour, day
+    and week, user and URL category. Views in date ranges that were already
+    added for a user are skipped.
+    '''
+    course_id = cid()
+    # Users whose fetch is incomplete are left out until a run fetches all of
+    # their page views: their date range would otherwise be marked as added,
+    # and the missing views skipped when they're fetched
+    incomplete = incomplete_user_ids(page_views_by_user)
+    if incomplete:
+        logger.warning("=> Not adding the page views of %d users with incomplete results to the rollups" % len(incomplete))
+        page_views_by_user = dict([(user_id, page_views) for user_id, page_views in page_views_by_user.iteritems() if user_id not in incomplete])
+    store = RollupStore(SETTINGS['rollups'])
+    try:
+        store.add_page_views(course_id, page_views_by_user, SETTINGS['start_time'], SETTINGS['end_time'],
+            category=url_category, include=lambda url: is_course_url(course_id, url))
+    finally:
+        store.close()
+
+def save_session_reports(page_views_by_user):
+    '''
+    Saves reports of the study sessions of each user, overall and by week.
+    A session ends when the user has no page views of course URLs for more
+    than session_gap minutes, and lasts from its first to its last page view.
+    '''
+    course_id = cid()
+    user_ids, timestamps = sessions.page_view_times(page_views_by_user, include=lambda url: is_course_url(course_id, url))
+    user_sessions = sessions.find_sessions(user_ids, timestamps, gap=SETTINGS['session_gap'] * 60)
+    logger.info("=> Found %d sessions in %d page views" % (len(user_sessions[0]), len(timestamps)))
+
+    store_sessions_by_user = []
+    for user_id, num_sessions, seconds, pages in sessions.sessions_by_user(user_sessions):
+        store_sessions_by_user.append([user_id, num_sessions, round(seconds / 60.0, 1), round(seconds / 60.0 / num_sessions, 1), round(float(pages) / num_sessions, 1)])
+    store_sessions_by_week = []
+    for user_id, week, num_sessions, seconds, pages in sessions.sessions_by_user_week(user_sessions):
+        store_sessions_by_week.append([user_id, week, num_sessions, round(seconds / 60.0, 1), pages])
+
+    save_data([{
+        "format": "csv",
+        "name": "user-sessions",
+        "labels":  ["User ID", "Sessions", "Total Minutes", "Average Minutes", "Average Page Views"],
+        "items": store_sessions_by_user
+    },{
+        "format": "json",
+        "name": "user-sessions",
+        "labels":  ["user_id", "sessions", "total_minutes", "average_minutes", "average_page_views"],
+        "items": store_sessions_by_user
+    },{
+        "format": "csv",
+        "name": "user-weekly-sessions",
+        "labels":  ["User ID", "Week", "Sessions", "Total Minutes", "Page Views"],
+        "items": store_sessions_by_week
+    },{
+        "format": "json",
+        "name": "user-weekly-sessions",
+        "labels":  ["user_id", "week", "sessions", "total_minutes", "page_views"],
+        "items": store_sessions_by_week
+    }])
+
+def save_approximate_reports(page_views_by_user):
+    '''
+    Saves the approximate reports: the top URLs by page views, and the page
+    views and unique users of each URL category. The sketches are saved too,
+    so they can be merged into the reports of other runs or courses.
+    '''
+    course_id = cid()
+    processes = counting_processes()
+    if processes > 1:
+        sketches = count_page_views_sharded(page_views_by_user, processes, approximate=True)
+    else:
+        sketches = sketch_page_views(course_id, page_views_by_user, SETTINGS['top_urls'])
+    for file_name in SETTINGS['merge_sketches']:
+        sketches = merge_page_view_sketches(sketches, load_sketches(file_name))
+    save_sketches(SETTINGS['sketch_file'].format(**SETTINGS), sketches)
+
+    top_urls = sketches["top_urls"]
+    users = sketches["users"]
+    logger.info("=> About %d unique users (+/- %.1f%% at 95%% confidence) viewed %d course pages" % (users.count(), 200 * users.relative_error, top_urls.n))
+    logger.info("=> Top URL counts are overestimated by at most %d page views" % top_urls.min_count)
+
+    store_top_urls = [[url, count, error] for url, count, error in top_urls.top()]
+    store_categories = []
+    for category, views in sorted(sketches["views_by_category"].iteritems()):
+        store_categories.append([category, views, sketches["users_by_category"][category].count()])
+
+    save_data([{
+        "format": "csv",
+        "name": "top-pageviews",
+        "labels":  ["Course URL", "Page Views", "Max Overcount"],
+        "items": store_top_urls
+    },{
+        "format": "json",
+        "name": "top-pageviews",
+        "labels":  ["course_url", "page_views", "max_overcount"],
+        "items": store_top_urls
+    },{
+        "format": "csv",
+        "name": "category-pageviews",
+        "labels":  ["URL Category", "Page Views", "Unique Users"],
+        "items": store_categories
+    },{
+        "format": "json",
+        "name": "category-pageviews",
+        "labels":  ["url_category", "page_views", "unique_users"],
+        "items": store_categories
+    }])
+
+def main():
+    '''Main script.'''
+    # Log to stderr when run as a script (the report service, which imports
+    # the script, sets up logging itself)
+    #logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
+    load_settings()
+    run()
+    sys.exit()
+
+def run():
+    '''Generates the reports for the loaded settings.'''
+    entity_store = SETTINGS['entity_store'] and EntityStore(SETTINGS['entity_store']) or None
+    try:
+        run_reports(entity_store)
+    finally:
+        if entity_store is not None:
+            entity_store.close()
+
+def run_reports(entity_store=None):
+    '''Generates the reports, saving the data to the entity store if it's given.'''
+    course_id = cid()
+
+    # The analytics reports only need a few requests. User page views are
+    # only fetched if the other reports need them, or if the course
+    # analytics aren't available (the reports are computed from them then)
+    analytics_saved = False
+    if SETTINGS['analytics'] and not SETTINGS['canvas_data']:
+        logger.info("=> Fetching course analytics")
+        analytics_saved = save_analytics_reports()
+        if analytics_saved and not (SETTINGS['url_reports'] or SETTINGS['approximate'] or SETTINGS['sessions'] or SETTINGS['rollups']):
+            logger.info("=> Done.")
+            return
+
+    if SETTINGS['canvas_data']:
+        page_views_by_user = read_page_views_by_user(entity_store)
+    else:
+        page_views_by_user = fetch_page_views_by_user(entity_store)
+    logger.debug("=> Page views by user=%s", LazyJSON(page_views_by_user, max_items=5))
+
+    if SETTINGS['analytics'] and not analytics_saved:
+        logger.info("=> Computing the analytics reports from the page views")
+        save_analytics_from_page_views(page_views_by_user)
+
+    if SETTINGS['rollups']:
+        logger.info("=> Updating rollups in %s" % SETTINGS['rollups'])
+        update_rollups(page_views_by_user)
+
+    if SETTINGS['sessions']:
+        logger.info("=> Reconstructing study sessions")
+        save_session_reports(page_views_by_user)
+
+    if SETTINGS['approximate']:
+        logger.info("=> Summarizing page views with sketches")
+        save_approximate_reports(page_views_by_user)
+        logger.info("=> Done.")
+        return
+
+    if SETTINGS['analytics'] and not SETTINGS['url_reports']:
+        logger.info("=> Done.")
+        return
+
+    # Now process the data and count page views across the Course URL namespace
+    logger.info("=> Counting total page views across users")
+    # The user page view rows are sorted by user and date, spilling sorted
+    # runs to temporary files when there are more than fit in the buffer
+    store_page_views_by_user = ExternalSorter(key=lambda row: (row[0], row[2], row[1]), buffer_size=SETTINGS['sort_buffer_rows'])
+    try:
+        save_page_view_reports(course_id, page_views_by_user, store_page_views_by_user, entity_store=entity_store)
+    finally:
+        store_page_views_by_user.close()
+
+    logger.info("=> Done.")
+
+def save_page_view_reports(course_id, page_views_by_user, store_page_views_by_user, entity_store=None):
+    '''
+    Counts the page views and saves the exact reports. With an entity store,
+    the page views are counted and sorted by queries of the store instead.
+    '''
+    if entity_store is not None:
+        store_total_page_views_by_url, store_total_page_views_by_user, store_page_views_by_user = query_page_view_reports(entity_store, course_id, page_views_by_user.keys())
+    else:
+        store_total_page_views_by_url, store_total_page_views_by_user, store_page_views_by_user = count_page_view_reports(course_id, page_views_by_user, store_page_views_by_user)
 
     # Save the data
     logger.info("=> Saving data to files")
@@ -480,9 +1235,49 @@ def main():
         "items": store_page_views_by_user
     }])
 
-    logger.info("=> Done.")
+def count_page_view_reports(course_id, page_views_by_user, store_page_views_by_user):
+    '''
+    Counts the page views of course URLs, appending the user page view rows
+    to store_page_views_by_user (an ExternalSorter). Returns the rows of the
+    total page views by URL, by user and URL, and the user page view rows.
+    '''
+    processes = counting_processes()
+    if processes > 1:
+        total_page_views_by_url, total_page_views_by_user, store_page_views_by_user = count_page_views_sharded(page_views_by_user, processes, page_view_rows=store_page_views_by_user)
+    else:
+        total_page_views_by_url, total_page_views_by_user, store_page_views_by_user = count_page_views(course_id, page_views_by_user, page_view_rows=store_page_views_by_user)
+    if store_page_views_by_user.runs:
+        logger.info("=> Sorted %d user page view rows in %d runs" % (len(store_page_views_by_user), len(store_page_views_by_user.runs)))
 
-    sys.exit()
+    logger.info("=> Finished counting page views")
+    logger.debug("=> Page views by URL: %s", LazyJSON(total_page_views_by_url))
+
+    # Transform the data to save in different output formats
+    logger.info("=> Preparing data for saving")
+    store_total_page_views_by_url = []
+    for url, count in total_page_views_by_url.iteritems():
+        store_total_page_views_by_url.append([url,count])
+
+    store_total_page_views_by_user = []
+    for user_id, page_views in total_page_views_by_user.iteritems():
+        for url, count in page_views.iteritems():
+            store_total_page_views_by_user.append([user_id, url, count])
+    return store_total_page_views_by_url, store_total_page_views_by_user, store_page_views_by_user
+
+def query_page_view_reports(entity_store, course_id, user_ids):
+    '''
+    Counts the page views of the users in the course with indexed queries of
+    the entity store. Returns the report rows like count_page_view_reports(),
+    with the user page view rows sorted by the database.
+    '''
+    logger.info("=> Counting page views with queries of %s" % entity_store.path)
+    start_time, end_time = SETTINGS['start_time'], SETTINGS['end_time']
+    entity_store.select_ids(user_ids)
+    store_total_page_views_by_url = entity_store.page_view_counts_by_url(course_id, start_time, end_time)
+    store_total_page_views_by_user = entity_store.page_view_counts_by_user_url(course_id, start_time, end_time)
+    store_page_views_by_user = entity_store.page_view_rows(course_id, start_time, end_time)
+    logger.info("=> Finished counting page views")
+    return store_total_page_views_by_url, store_total_page_views_by_user, store_page_views_by_user
 
 # Execute the main function if this script is being called directly instead of imported
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Answers questions about page views from the rollups database updated by
+canvas_page_views.py --rollups, e.g. daily views per tool in a course:
+
+    $ ./query_rollups.py rollups.db day --course_id 1693 --group_by bucket category --start 2016-02-01 --end 2016-03-01
+'''
+import os
+import sys
+import csv
+import time
+import argparse
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.rollups import RollupStore, GRANULARITIES, GROUP_BY
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+def main():
+    parser = argparse.ArgumentParser(description='Queries the page view rollups saved by canvas_page_views.py --rollups. Prints CSV.')
+    parser.add_argument('database', type=str, help="The rollups database")
+    parser.add_argument('granularity', choices=GRANULARITIES, help="Size of the time buckets")
+    parser.add_argument('--group_by', nargs='*', default=['bucket'], choices=GROUP_BY, help="Columns to group the page views by. Defaults to bucket.")
+    parser.add_argument('--course_id', type=int, help="Only count page views in this course")
+    parser.add_argument('--user_id', type=int, help="Only count page views of this user")
+    parser.add_argument('--category', type=str, help="Only count page views of this URL category (e.g. assignments, quizzes, home)")
+    parser.add_argument('--start', type=str, help="Only count buckets starting at or after this date or time (YYYY-MM-DD or YYYY-MM-DDTHH)")
+    parser.add_argument('--end', type=str, help="Only count buckets starting before this date or time (YYYY-MM-DD or YYYY-MM-DDTHH)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error("Rollups database %s does not exist" % args.database)
+
+    started_at = time.time()
+    store = RollupStore(args.database)
+    try:
+        rows = store.query(args.granularity, group_by=args.group_by, course_id=args.course_id, user_id=args.user_id,
+                           category=args.category, start=args.start, end=args.end)
+    finally:
+        store.close()
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(args.group_by + ['views'])
+    writer.writerows(rows)
+    logger.info("%d rows in %.3fs" % (len(rows), time.time() - started_at))
+
+if __name__ == "__main__":
+    main()
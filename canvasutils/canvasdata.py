@@ -0,0 +1,155 @@
+'''
+Page views from Canvas Data "requests" flat files.
+
+Canvas Data exports the requests table as gzipped TSV files (no header row,
+"\N" for nulls), one row per web or API request. Reading them is much faster
+than crawling /users/:id/page_views for every user, so the scripts can use a
+local copy of the export (e.g. the dataFiles/requests directory written by
+the canvasDataCli tool) as their source of page views.
+
+The files are parsed as a stream, one line at a time, and rows are filtered
+by course, user and date before they're turned into dicts. Matching rows are
+returned in the same shape as the page view objects of the API, with Canvas
+IDs (Canvas Data IDs include a shard prefix, which is removed).
+
+Example:
+
+    for page_view in iter_page_views('dataFiles/requests', course_id=1693, start_time='2016-01-25', end_time='2016-05-14',
+                                     base_url='https://canvas.harvard.edu'):
+        print page_view['links']['user'], page_view['url']
+
+See also: https://portal.inshosteddata.com/docs (the requests table)
+'''
+import os
+import gzip
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Columns of the requests table, in file order
+REQUESTS_COLUMNS = [
+    'id', 'timestamp', 'timestamp_year', 'timestamp_month', 'timestamp_day',
+    'user_id', 'course_id', 'root_account_id', 'course_account_id', 'quiz_id',
+    'discussion_id', 'conversation_id', 'assignment_id', 'url', 'user_agent',
+    'http_method', 'remote_ip', 'interaction_micros', 'web_application_controller',
+    'web_application_action', 'web_application_context_type', 'web_application_context_id',
+    'real_user_id', 'session_id', 'user_agent_id', 'http_status', 'http_version',
+    'developer_key_id',
+]
+COLUMN = dict([(name, index) for index, name in enumerate(REQUESTS_COLUMNS)])
+
+NULL = '\\N'
+
+# Canvas Data IDs are shard_id * 10^13 + the Canvas ID
+SHARD_FACTOR = 10 ** 13
+
+def canvas_id(data_id):
+    '''Returns the Canvas ID of a Canvas Data ID (or None for nulls).'''
+    if data_id is None or data_id == NULL or data_id == '':
+        return None
+    return int(data_id) % SHARD_FACTOR
+
+def request_files(path):
+    '''
+    Returns the request files to read: the file itself, or all the .gz and
+    .tsv files under a directory (sorted by name, which is by date for
+    Canvas Data exports).
+    '''
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        files.extend([os.path.join(dirpath, f) for f in filenames if f.endswith('.gz') or f.endswith('.tsv')])
+    return sorted(files)
+
+def _open(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+def _value(value):
+    if value == NULL:
+        return None
+    return value.decode('utf-8', 'replace')
+
+def to_page_view(row, base_url=''):
+    '''
+    Converts a row of the requests table (a list of column values) to a dict
+    in the shape of a page view returned by the API.
+    '''
+    url = _value(row[COLUMN['url']]) or ''
+    if url.startswith('/'):
+        url = base_url.rstrip('/') + url
+    timestamp = row[COLUMN['timestamp']]
+    interaction_micros = row[COLUMN['interaction_micros']]
+    return {
+        'id': _value(row[COLUMN['id']]),
+        'url': url,
+        'created_at': timestamp[:10] + 'T' + timestamp[11:19] + 'Z',
+        'user_agent': _value(row[COLUMN['user_agent']]),
+        'http_method': _value(row[COLUMN['http_method']]),
+        'remote_ip': _value(row[COLUMN['remote_ip']]),
+        'interaction_seconds': int(interaction_micros) / 1000000.0 if interaction_micros != NULL else None,
+        'controller': _value(row[COLUMN['web_application_controller']]),
+        'action': _value(row[COLUMN['web_application_action']]),
+        'context_type': _value(row[COLUMN['web_application_context_type']]),
+        'links': {
+            'user': canvas_id(row[COLUMN['user_id']]),
+            'context': canvas_id(row[COLUMN['course_id']]),
+            'real_user': canvas_id(row[COLUMN['real_user_id']]),
+        },
+    }
+
+def iter_page_views(path, course_id=None, user_ids=None, start_time=None, end_time=None, base_url=''):
+    '''
+    Generator that yields the page views in the request files under `path`.
+
+    Parameters:
+    - course_id: only page views in this course (Canvas ID)
+    - user_ids: only page views of these users (a set of Canvas IDs)
+    - start_time, end_time: only page views in this date range, as ISO 8601
+      dates or times in UTC (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS). Like the
+      API, the start time is inclusive and the end time exclusive.
+    - base_url: prepended to URLs that are only a path, e.g. https://canvas.harvard.edu
+    '''
+    course_column, user_column, timestamp_column = COLUMN['course_id'], COLUMN['user_id'], COLUMN['timestamp']
+    course_suffix = course_id is not None and str(course_id) or None
+    if start_time is not None:
+        start_time = start_time.replace('T', ' ')
+    if end_time is not None:
+        end_time = end_time.replace('T', ' ')
+
+    num_rows, num_page_views = 0, 0
+    for filename in request_files(path):
+        logger.info("Reading requests from %s", filename)
+        with _open(filename) as f:
+            for line in f:
+                num_rows += 1
+                row = line.rstrip('\r\n').split('\t')
+                if len(row) < len(REQUESTS_COLUMNS) - 1:
+                    continue
+                # Compare the raw values first so most rows are skipped without converting anything
+                if course_id is not None and not (row[course_column].endswith(course_suffix) and canvas_id(row[course_column]) == course_id):
+                    continue
+                timestamp = row[timestamp_column]
+                if start_time is not None and timestamp < start_time:
+                    continue
+                if end_time is not None and timestamp >= end_time:
+                    continue
+                if user_ids is not None and canvas_id(row[user_column]) not in user_ids:
+                    continue
+                num_page_views += 1
+                yield to_page_view(row, base_url=base_url)
+    logger.info("Read %d requests, %d matched", num_rows, num_page_views)
+
+def page_views_by_user(path, **kwargs):
+    '''
+    Returns a dict mapping each user ID to the list of their page views
+    (rows without a user are skipped). Takes the same arguments as iter_page_views().
+    '''
+    result = {}
+    for page_view in iter_page_views(path, **kwargs):
+        user_id = page_view['links']['user']
+        if user_id is not None:
+            result.setdefault(user_id, []).append(page_view)
+    return result
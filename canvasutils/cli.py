@@ -0,0 +1,76 @@
+'''
+The canvas-utils command, which runs the scripts as subcommands:
+
+    $ ./canvas-utils due-dates 39 --enrollment_term_id 39 --workload
+    $ ./canvas-utils rubric 1693 --pipeline
+    $ ./canvas-utils page-views --help
+
+Only the script of the subcommand is imported (see canvasutils/tools.py),
+and the scripts import the Canvas SDK, requests, xlwt and dateutil when
+they first use them (see canvasutils/imports.py), so `--help` and runs
+served from the caches start quickly. Add --profile_imports before the
+subcommand to print how long each module took to import.
+'''
+import sys
+import time
+
+# Subcommand => (tool directory, script, description)
+COMMANDS = {
+    'page-views': ('canvas_page_views', 'canvas_page_views', "Page view reports for a course."),
+    'query-rollups': ('canvas_page_views', 'query_rollups', "Query the page view rollups saved by page-views --rollups."),
+    'assignment-views': ('assignmentviews', 'assignmentviews', "Page views of the assignments of a course."),
+    'rubric': ('rubricassessments', 'rubricassessments', "Rubric assessments of the assignments of a course."),
+    'due-dates': ('find_due_dates', 'find_due_dates', "Due dates of the courses of an account, and student workload."),
+    'user-emails': ('skeleton', 'get_users_emails', "Names and email addresses of the users of a course."),
+    'bulk-fetch': ('bulk_fetch', 'bulk_fetch', "Fetch an endpoint for each ID in a file, as newline-delimited JSON."),
+    'report-service': ('report_service', 'report_service', "Run the local report service."),
+}
+
+def usage():
+    lines = ['usage: canvas-utils [-h] [--profile_imports] COMMAND [ARGS...]', '', 'commands:']
+    width = max([len(command) for command in COMMANDS])
+    for command in sorted(COMMANDS):
+        lines.append('  %s  %s' % (command.ljust(width), COMMANDS[command][2]))
+    lines += ['', 'Run "canvas-utils COMMAND --help" for the arguments of a command.',
+              '--profile_imports prints how long each module took to import to stderr.']
+    return '\n'.join(lines) + '\n'
+
+def main(argv=None):
+    '''
+    Runs a subcommand. The arguments are parsed by hand rather than with
+    argparse subparsers, which would need every script's parser (and
+    therefore every script) to be loaded.
+    '''
+    started_at = time.time()
+    argv = list(sys.argv[1:] if argv is None else argv)
+    profile = None
+    if argv and argv[0] == '--profile_imports':
+        argv.pop(0)
+        from canvasutils.imports import ImportProfile
+        profile = ImportProfile()
+        profile.start()
+    if not argv or argv[0] in ('-h', '--help'):
+        sys.stdout.write(usage())
+        sys.exit(0 if argv else 2)
+    command = argv.pop(0)
+    if command not in COMMANDS:
+        sys.stderr.write(usage())
+        sys.stderr.write('canvas-utils: error: unknown command %s\n' % command)
+        sys.exit(2)
+
+    from canvasutils.tools import load_tool
+    tool, script, description = COMMANDS[command]
+    loaded_at = None
+    # The scripts parse sys.argv. It's set before the script is loaded since
+    # some build their parser then, and its program name is used in --help.
+    sys.argv = ['canvas-utils %s' % command] + argv
+    try:
+        module = load_tool(tool, script)
+        loaded_at = time.time()
+        module.main()
+    finally:
+        if profile is not None:
+            profile.stop()
+            profile.report(sys.stderr)
+            if loaded_at is not None:
+                sys.stderr.write('import time: %s loaded %.1f ms after canvas-utils started\n' % (script, (loaded_at - started_at) * 1000))
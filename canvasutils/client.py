@@ -0,0 +1,291 @@
+'''
+Concurrent Canvas API client shared by the canvas-utils scripts.
+
+The client handles the OAuth header, follows the "Link" header to walk
+paginated results one page at a time, and fans requests out over a pool of
+threads while limiting the number of connections open to each host.
+
+Example:
+
+    client = CanvasClient('https://canvas.harvard.edu/api/v1', OAUTH_TOKEN, max_connections=8)
+    course = client.get_one('/courses/1693')
+    for page in client.iter_pages('/courses/1693/enrollments'):
+        print len(page.data)
+    for user_id, page_views in client.map(lambda user_id: client.get_all('/users/%s/page_views' % user_id), user_ids):
+        print user_id, len(page_views)
+
+See also: https://canvas.instructure.com/doc/api/file.pagination.html
+'''
+import re
+import time
+import logging
+import threading
+import urlparse
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import requests
+import requests.adapters
+
+from canvasutils.ratelimit import RateLimiter, is_throttled
+from canvasutils.metrics import METRICS, instrument_session
+from canvasutils.projection import project_items
+from canvasutils.httpcache import ConditionalCacheAdapter
+
+logger = logging.getLogger(__name__)
+
+# One page of results: the URL requested, the response status and headers,
+# the decoded JSON data and the URL of the next page (None on the last page).
+Page = namedtuple('Page', ['url', 'status_code', 'headers', 'data', 'next_url'])
+
+class CanvasClientError(Exception):
+    '''
+    Raised when the API responds with an unexpected status code, or when the
+    request failed without a response (status_code is then None).
+    '''
+    def __init__(self, url, status_code, text=''):
+        super(CanvasClientError, self).__init__("Canvas API request failed [url=%s] [response_code=%s]" % (url, status_code))
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def retriable(self):
+        '''True if the same request may succeed later (server errors and connection problems).'''
+        return self.status_code is None or self.status_code >= 500 or self.status_code == 429
+
+def extract_header_links(link_header):
+    '''
+    Extracts the "Link:" header from the response and returns a dictionary mapping rel => url.
+
+    Parameters:
+    - link_header: a string containing the value of the "Link" header
+
+    Returns:
+    - a dictionary mapping each link relationship to its corresponding URL
+    '''
+    if not link_header:
+        return {}
+    matches = re.findall(r'<([^<>]+)>;\s*rel="([^"]+)",?', link_header)
+    return dict([(m[1], m[0]) for m in matches])
+
+def api_base_url(canvas_url):
+    '''
+    Returns the versioned API URL given the CANVAS_URL setting used with the
+    canvas_sdk (i.e. https://canvas.localhost/api => https://canvas.localhost/api/v1).
+    '''
+    canvas_url = canvas_url.rstrip('/')
+    if canvas_url.endswith('/v1'):
+        return canvas_url
+    return canvas_url + '/v1'
+
+class CanvasClient(object):
+    '''
+    Thread-safe client for the Canvas API.
+
+    Parameters:
+    - base_url: the API base URL, e.g. https://canvas.harvard.edu/api/v1
+    - oauth_token: the OAuth access token
+    - per_page: the page size requested for paginated results
+    - max_connections: the maximum number of requests in flight to one host
+    - rate_limiter: a RateLimiter to share with other clients using the same
+      token (by default each client gets its own)
+    - max_retries: how many times a throttled request is retried
+    - metrics: the Metrics that requests are recorded in (defaults to the
+      shared METRICS)
+    - http_cache: a ConditionalCache for sending conditional requests and
+      answering 304 responses from it (see httpcache.py)
+    '''
+    def __init__(self, base_url, oauth_token, per_page=100, max_connections=8, rate_limiter=None, max_retries=5, metrics=None, http_cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.per_page = per_page
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(max_concurrency=max_connections)
+        self.rate_limiter = rate_limiter
+        if metrics is None:
+            metrics = METRICS
+        self.metrics = metrics
+        self.session = instrument_session(requests.Session(), metrics)
+        self.session.headers['Authorization'] = 'Bearer %s' % oauth_token
+        if http_cache is not None:
+            adapter = ConditionalCacheAdapter(http_cache, pool_maxsize=max_connections, pool_block=True)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def url(self, url):
+        '''Returns the full URL to request, assuming it's not already an absolute URL.'''
+        if url.startswith('http'):
+            return url
+        return self.base_url + url
+
+    def _host_slot(self, url):
+        '''Returns the semaphore limiting the number of requests in flight to the URL's host.'''
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_connections)
+            return self._host_slots[host]
+
+    def request(self, url, params=None, headers=None, stream=False):
+        '''
+        Sends a GET request and returns the response (whatever its status code).
+        Requests are paced by the rate limiter, and requests rejected because
+        the rate limit was exceeded are retried after a delay. With stream=True,
+        the body is left unread so it can be parsed from response.raw.
+        '''
+        request_url = self.url(url)
+        attempt = 0
+        while True:
+            with self._host_slot(request_url):
+                waiting_since = time.time()
+                self.rate_limiter.acquire()
+                self.metrics.waited('rate_limit', time.time() - waiting_since)
+                response = None
+                try:
+                    response = self.session.get(request_url, params=params, headers=headers, stream=stream)
+                finally:
+                    self.rate_limiter.release(response)
+            logger.debug("Request [request_url=%s] [response_code=%s]", response.url, response.status_code)
+            if not is_throttled(response) or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            delay = self.rate_limiter.throttled()
+            self.metrics.throttled(request_url)
+            self.metrics.waited('throttled', delay)
+            time.sleep(delay)
+
+    def get_page(self, url, params=None, headers=None, fields=None):
+        '''
+        Fetches a single page and returns a Page.
+
+        If fields is a list of field names, the page must be a list of
+        objects, and only those fields of each object are kept. The body is
+        then parsed as it's read from the connection (see projection.py).
+
+        Raises CanvasClientError unless the response status is 200.
+        '''
+        response = self.request(url, params=params, headers=headers, stream=fields is not None)
+        try:
+            if response.status_code != 200:
+                raise CanvasClientError(response.url, response.status_code, response.text)
+            links = extract_header_links(response.headers.get('link'))
+            if fields is not None:
+                response.raw.decode_content = True
+                data = project_items(response.raw, fields)
+            else:
+                data = response.json()
+        finally:
+            response.close()
+        return Page(response.url, response.status_code, response.headers, data, links.get('next'))
+
+    def iter_pages(self, url, params=None, fields=None):
+        '''
+        Generator that fetches a paginated resource and yields each Page as
+        soon as it arrives, following the "next" link until the last page.
+        See get_page() for the fields argument.
+        '''
+        params = dict(params or {})
+        params.setdefault('per_page', self.per_page)
+        next_url = url
+        num_pages = 0
+        while next_url is not None:
+            page = self.get_page(next_url, params=params, fields=fields)
+            num_pages += 1
+            yield page
+            next_url = page.next_url
+            params = None # the next link already includes the query string
+        self.metrics.observe_page_chain(self.url(url), num_pages)
+
+    def iter_pages_checkpointed(self, url, params=None, checkpoint=None, max_attempts=3, fields=None):
+        '''
+        Generator like iter_pages() that records its progress in the
+        `checkpoint` dict, so that a chain of pages that failed part way can
+        be resumed from the page that failed instead of the first page:
+
+        - checkpoint['next_url']: the URL of the next page to fetch
+        - checkpoint['complete']: True once the last page has been fetched
+
+        If the checkpoint already has a next_url, fetching starts from there.
+        A page that fails with a retriable error is retried up to max_attempts
+        times before CanvasClientError is raised, and the checkpoint then
+        still points at the failed page.
+        '''
+        if checkpoint is None:
+            checkpoint = {}
+        next_url = checkpoint.get('next_url')
+        if next_url is None:
+            params = dict(params or {})
+            params.setdefault('per_page', self.per_page)
+            next_url = requests.Request('GET', self.url(url), params=params).prepare().url
+            checkpoint['next_url'] = next_url
+        checkpoint['complete'] = False
+
+        num_pages = 0
+        while next_url is not None:
+            attempt = 1
+            while True:
+                try:
+                    page = self.get_page(next_url, fields=fields)
+                    break
+                except requests.exceptions.RequestException as e:
+                    error = CanvasClientError(next_url, None, str(e))
+                except CanvasClientError as e:
+                    error = e
+                if not error.retriable or attempt >= max_attempts:
+                    raise error
+                logger.warning("Retrying page %s after error (attempt %d of %d): %s" % (next_url, attempt + 1, max_attempts, error))
+                self.metrics.retried(next_url)
+                self.metrics.waited('retry', 2 ** (attempt - 1))
+                time.sleep(2 ** (attempt - 1))
+                attempt += 1
+            num_pages += 1
+            yield page
+            next_url = page.next_url
+            checkpoint['next_url'] = next_url
+        checkpoint['complete'] = True
+        self.metrics.observe_page_chain(self.url(url), num_pages)
+
+    def iter_items(self, url, params=None, fields=None):
+        '''
+        Generator that yields the individual objects of a paginated list resource.
+        '''
+        for page in self.iter_pages(url, params=params, fields=fields):
+            for item in page.data:
+                yield item
+
+    def get_all(self, url, params=None, fields=None):
+        '''
+        Returns all the objects of a paginated list resource as one list.
+        '''
+        return list(self.iter_items(url, params=params, fields=fields))
+
+    def get_one(self, url, params=None):
+        '''
+        Returns a single (non-paginated) object.
+        '''
+        return self.get_page(url, params=params).data
+
+    def map(self, func, items, concurrency=None):
+        '''
+        Calls func(item) for each item using up to `concurrency` threads
+        (defaults to max_connections) and yields (item, result) tuples in the
+        order they complete. Exceptions raised by func are re-raised here.
+        '''
+        concurrency = concurrency or self.max_connections
+        if concurrency <= 1:
+            for item in items:
+                yield item, func(item)
+            return
+
+        pool = ThreadPool(concurrency)
+        try:
+            for item_result in pool.imap_unordered(lambda item: (item, func(item)), items):
+                yield item_result
+        finally:
+            pool.terminate()
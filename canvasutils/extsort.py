@@ -0,0 +1,107 @@
+'''
+External merge sort for exports larger than memory.
+
+An ExternalSorter collects items (e.g. spreadsheet rows) and returns them
+sorted, holding at most `buffer_size` items in memory. When the buffer is
+full it is sorted and spilled to a temporary file as a "run"; iterating over
+the sorter merges the runs (and whatever is left in the buffer) with a k-way
+merge, reading one item at a time from each run:
+
+    with ExternalSorter(key=lambda row: (row[1], row[4])) as rows:
+        for page_view in page_views:
+            rows.append(to_row(page_view))
+        for row in rows:
+            writer.writerow(row)
+
+Items are written with marshal, so they must be built from simple types
+(tuples, lists, dicts, strings, numbers, None). The sort is stable, and the
+sorted items can be iterated more than once until the sorter is closed,
+which deletes the temporary files.
+'''
+import os
+import heapq
+import marshal
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 100000
+
+def _read_run(path):
+    '''Generator that yields the (key, item) pairs of a run file.'''
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+def _tag(pairs, index):
+    '''Generator that turns (key, item) pairs into ((key, index, position), item).'''
+    for position, (key, item) in enumerate(pairs):
+        yield (key, index, position), item
+
+class ExternalSorter(object):
+    def __init__(self, key=None, buffer_size=DEFAULT_BUFFER_SIZE, tmpdir=None):
+        self.key = key or (lambda item: item)
+        self.buffer_size = max(1, buffer_size)
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.buffer.append(item)
+        self.count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self._spill()
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def _sorted_buffer(self):
+        key = self.key
+        return sorted([(key(item), item) for item in self.buffer], key=lambda pair: pair[0])
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix='extsort-', suffix='.run', dir=self.tmpdir)
+        with os.fdopen(fd, 'wb') as f:
+            for pair in self._sorted_buffer():
+                marshal.dump(pair, f)
+        self.runs.append(path)
+        self.buffer = []
+        logger.debug("Spilled sorted run %d to %s", len(self.runs), path)
+
+    def __iter__(self):
+        if not self.runs:
+            for key, item in self._sorted_buffer():
+                yield item
+            return
+        # Tag each item with its run and position so ties keep their order
+        # and the items themselves are never compared
+        sources = [_read_run(path) for path in self.runs] + [iter(self._sorted_buffer())]
+        tagged = [_tag(source, index) for index, source in enumerate(sources)]
+        for sort_key, item in heapq.merge(*tagged):
+            yield item
+
+    def close(self):
+        '''Deletes the temporary files.'''
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.buffer = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,191 @@
+'''
+Conditional request cache for Canvas API GET requests.
+
+Canvas (like any Rails app) sends an ETag with its responses and answers
+304 Not Modified when a request carries an If-None-Match header with the
+current ETag. The ConditionalCache keeps the ETag, Last-Modified date,
+headers and body of each response on disk. A transport adapter mounted on a
+requests session adds If-None-Match / If-Modified-Since to requests for URLs
+it has seen before, and turns a 304 response back into the stored 200
+response, so re-running a report mostly exchanges headers instead of bodies.
+
+The store is keyed by URL (including the page and per_page parameters) and
+a hash of the access token, since different users may see different data.
+
+Example:
+
+    cache = ConditionalCache('.http_cache')
+    client = CanvasClient(api_base_url(CANVAS_URL), OAUTH_TOKEN, http_cache=cache)
+    install(request_context.session, cache)  # canvas_sdk requests
+
+Streamed responses (see projection.py) are stored too: the body is copied to
+the cache as the caller reads it, and stored once it has been read to the
+end. A 304 answer to a streamed request is read from the stored body.
+'''
+import io
+import os
+import json
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+from canvasutils.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Response headers kept with the body, so a response rebuilt from a 304 works like the original
+STORED_HEADERS = ['Content-Type', 'Link', 'ETag', 'Last-Modified']
+
+class ConditionalCache(object):
+    '''
+    On-disk store of GET responses that have an ETag or Last-Modified header,
+    one JSON file per URL under `directory`.
+    '''
+    def __init__(self, directory, metrics=None):
+        self.directory = directory
+        self.metrics = metrics or METRICS
+        self._lock = threading.Lock()
+
+    def key(self, url, authorization=None):
+        return hashlib.sha1('%s %s' % (hashlib.sha1(authorization or '').hexdigest(), url)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        '''Returns the stored entry for the key, or None.'''
+        try:
+            with open(self._path(key), 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Could not read cached response %s: %s", key, e)
+        except ValueError:
+            logger.warning("Ignoring corrupt cached response %s", key)
+        return None
+
+    def set(self, key, url, headers, body):
+        '''Stores a response (written to a temporary file and renamed, so readers never see a partial entry).'''
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            logger.debug("Not caching %s: the body isn't UTF-8", url)
+            return
+        entry = {
+            'url': url,
+            'headers': dict([(name, headers[name]) for name in STORED_HEADERS if name in headers]),
+            'body': body,
+        }
+        path = self._path(key)
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+class _TeeReader(object):
+    '''
+    File-like wrapper of the raw body of a streamed response that keeps a copy
+    of what is read (decoded, like response.content), and stores it in the
+    cache when the body has been read to the end. A body that isn't read to
+    the end (e.g. the connection fails) isn't stored.
+    '''
+    def __init__(self, raw, store):
+        self.raw = raw
+        self.decode_content = True
+        self._store = store
+        self._chunks = []
+
+    def read(self, amt=None, *args, **kwargs):
+        data = self.raw.read(amt, decode_content=True)
+        if data:
+            self._chunks.append(data)
+        # read(0) (which parsers use to check the type of the data) doesn't
+        # mean the end of the body
+        if (amt is None or (amt and not data)) and self._store is not None:
+            store, self._store = self._store, None
+            store(b''.join(self._chunks))
+            self._chunks = None
+        return data
+
+    def close(self):
+        self.raw.close()
+
+    def release_conn(self):
+        self.raw.release_conn()
+
+class ConditionalCacheAdapter(requests.adapters.HTTPAdapter):
+    '''
+    Transport adapter that sends conditional GET requests for URLs in the
+    cache and answers 304 responses from it.
+    '''
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super(ConditionalCacheAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        # Requests that are already conditional (e.g. due date snapshots) are
+        # left alone
+        conditional = 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+        if request.method != 'GET' or conditional:
+            return super(ConditionalCacheAdapter, self).send(request, stream=stream, **kwargs)
+
+        key = self.cache.key(request.url, request.headers.get('Authorization'))
+        entry = self.cache.get(key)
+        if entry is not None:
+            if 'ETag' in entry['headers']:
+                request.headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                request.headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        response = super(ConditionalCacheAdapter, self).send(request, stream=stream, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.metrics.cache_hit('http_conditional')
+            response.content # releases the connection
+            response.status_code = 200
+            response.reason = 'OK'
+            headers = CaseInsensitiveDict(entry['headers'])
+            headers.update(response.headers)
+            headers.pop('Content-Length', None)
+            response.headers = headers
+            response._content = entry['body'].encode('utf-8')
+            # Streamed responses are read from response.raw
+            response.raw = io.BytesIO(response._content)
+            response.from_cache = True
+        elif response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            self.cache.metrics.cache_miss('http_conditional')
+            store = lambda body: self.cache.set(key, request.url, response.headers, body)
+            if stream:
+                response.raw = _TeeReader(response.raw, store)
+            else:
+                store(response.content)
+        return response
+
+def install(session, cache, **kwargs):
+    '''
+    Mounts a ConditionalCacheAdapter on a requests session (e.g. the session
+    of a canvas_sdk RequestContext) for http and https URLs.
+    '''
+    adapter = ConditionalCacheAdapter(cache, **kwargs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def install_request_context(request_context, cache):
+    '''Makes the requests of a canvas_sdk RequestContext go through the cache (if there is one).'''
+    if cache is None:
+        return request_context
+    session = getattr(request_context, 'session', None)
+    if session is None:
+        logger.warning("Request context has no session: canvas_sdk requests won't use the HTTP cache")
+        return request_context
+    install(session, cache)
+    return request_context
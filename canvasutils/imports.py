@@ -0,0 +1,158 @@
+'''
+Deferred imports and an import time profile, for fast startup.
+
+The scripts only need the Canvas SDK, requests, xlwt or dateutil when they
+fetch data or write a spreadsheet, so `--help` and runs served from the cache
+shouldn't pay for importing them. lazy_import() returns a stand-in for a
+module that imports it the first time one of its attributes is used:
+
+    xlwt = lazy_import('xlwt')
+    dateutil = lazy_import('dateutil')
+    accounts = lazy_import('canvas_sdk.methods.accounts')
+
+    wb = xlwt.Workbook()                     # imports xlwt
+    dateutil.parser.parse(due_at)            # imports dateutil and dateutil.parser
+
+Submodules of a package (dateutil.parser above) are imported when they're
+used as attributes. Import errors are raised at first use instead of when
+the script loads.
+
+ImportProfile records how long each module took to import, including the
+modules it imported, and prints a report like `python3 -X importtime`:
+
+    profile = ImportProfile()
+    profile.start()
+    import rubricassessments
+    profile.stop()
+    profile.report(sys.stderr)
+'''
+import sys
+import time
+import importlib
+import __builtin__
+
+class LazyModule(object):
+    '''Stand-in for a module that is imported on first use (see lazy_import()).'''
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = self.__dict__['_lazy_module'] = importlib.import_module(self._lazy_name)
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = self._lazy_load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            # A submodule that the package doesn't import itself
+            return importlib.import_module('%s.%s' % (self._lazy_name, attr))
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+
+    def __repr__(self):
+        state = self.__dict__['_lazy_module'] is None and 'not imported yet' or 'imported'
+        return '<lazy module %r (%s)>' % (self._lazy_name, state)
+
+def lazy_import(name):
+    '''Returns a stand-in for the module `name` that imports it on first use.'''
+    return LazyModule(name)
+
+def is_imported(module):
+    '''Returns True if a module (or a lazy module) has been imported.'''
+    if isinstance(module, LazyModule):
+        return module.__dict__['_lazy_module'] is not None
+    return True
+
+class ImportProfile(object):
+    '''
+    Times the imports made while it's started (see the module docstring).
+    Only the imports that load new modules are recorded, by the names of
+    the modules they loaded, with their cumulative time and their own time
+    (without the nested imports that loaded modules).
+    '''
+    def __init__(self):
+        self.entries = []   # (depth, module names, self seconds, cumulative seconds), in the order the imports finished
+        self.started_at = None
+        self.stopped_at = None
+        self._original_import = None
+        self._known = set()
+        self._num_known = 0
+        self._stack = []    # [nested import seconds, modules loaded] of each import in progress
+
+    def start(self):
+        self._new_modules()
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+        self.started_at = time.time()
+
+    def stop(self):
+        if self._original_import is not None:
+            __builtin__.__import__ = self._original_import
+            self._original_import = None
+            self.stopped_at = time.time()
+
+    def _new_modules(self):
+        '''
+        Returns the names of the modules loaded since the last call. Python 2
+        also adds None to sys.modules for each failed implicit relative
+        import, which aren't modules.
+        '''
+        if len(sys.modules) == self._num_known:
+            return []
+        new = [name for name in sys.modules if name not in self._known]
+        self._known.update(new)
+        self._num_known = len(sys.modules)
+        return [name for name in new if sys.modules[name] is not None]
+
+    def _import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        # A module is in sys.modules while it runs, so the modules that
+        # appeared since the last import were loaded by the enclosing one.
+        # Imports run one at a time (under the import lock), so one stack
+        # is enough.
+        new = self._new_modules()
+        if self._stack:
+            self._stack[-1][1].extend(new)
+        self._stack.append([0.0, []])
+        started_at = time.time()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            seconds = time.time() - started_at
+            nested_seconds, modules = self._stack.pop()
+            modules.extend(self._new_modules())
+            # Imports of modules that are already loaded don't get an entry,
+            # so their (small) time stays in the importer's own time
+            if modules:
+                self.entries.append((len(self._stack), sorted(modules), seconds - nested_seconds, seconds))
+                if self._stack:
+                    self._stack[-1][0] += seconds
+
+    def total_seconds(self):
+        '''Returns the time spent in the top level imports.'''
+        return sum([cumulative for depth, names, own, cumulative in self.entries if depth == 0])
+
+    def report(self, out, min_seconds=0.001):
+        '''
+        Writes the imports in the order they finished (nested imports before
+        the import that made them, indented), skipping the ones that took
+        less than min_seconds in total.
+        '''
+        out.write('import time:   self [ms] | cumulative [ms] | module\n')
+        for depth, names, own, cumulative in self.entries:
+            if cumulative >= min_seconds:
+                name = ', '.join(names[:3])
+                if len(names) > 3:
+                    name += ' (and %d more)' % (len(names) - 3)
+                out.write('import time: %11.1f | %15.1f | %s%s\n' % (own * 1000, cumulative * 1000, '  ' * depth, name))
+        num_modules = sum([len(names) for depth, names, own, cumulative in self.entries])
+        out.write('import time: %d modules imported in %.1f ms' % (num_modules, self.total_seconds() * 1000))
+        if self.started_at is not None and self.stopped_at is not None:
+            out.write(' (%.1f ms until the command finished)' % ((self.stopped_at - self.started_at) * 1000))
+        out.write('\n')
@@ -0,0 +1,193 @@
+'''
+Logging helpers that keep verbose diagnostics cheap.
+
+- LazyJSON and LazyRepr wrap an object so it is only formatted when a log
+  record is actually emitted, and cap the formatted size: lists and dicts are
+  cut to their first `max_items` items at every level, containers nested more
+  than `max_depth` levels deep are summarized by their size, and the text is
+  cut to `max_length` characters.
+  Pass them as logging arguments instead of formatting with `%` first:
+
+      logger.debug("Page views for user_id=%s: %s", user_id, LazyJSON(page_views))
+
+- EventLogger logs structured events ("name key=value ...") and can sample
+  frequent events, e.g. only log every 100th page fetched:
+
+      events = EventLogger(logger)
+      events.info('page_fetched', sample_every=100, url=page.url, status=page.status_code)
+
+- configure_logging() replaces the per-script logging setup, which used to
+  put the root logger and urllib3 at DEBUG.
+'''
+import re
+import json
+import heapq
+import logging
+import threading
+
+MAX_LENGTH = 1000
+MAX_ITEMS = 20
+MAX_DEPTH = 3
+
+def truncate(text, max_length=MAX_LENGTH):
+    '''Returns the text cut to max_length characters, noting how much was dropped.'''
+    if max_length is None or len(text) <= max_length:
+        return text
+    return '%s... (%d more characters)' % (text[:max_length], len(text) - max_length)
+
+def _head(value, max_items):
+    '''
+    Returns (a copy of the first max_items items of a list, set or dict, number
+    of items dropped). The smallest keys of a dict and items of a set are
+    kept, without sorting all of them.
+    '''
+    if isinstance(value, (set, frozenset)):
+        if max_items is None or len(value) <= max_items:
+            return sorted(value), 0
+        return heapq.nsmallest(max_items, value), len(value) - max_items
+    if max_items is None:
+        return value, 0
+    if isinstance(value, dict) and len(value) > max_items:
+        keys = heapq.nsmallest(max_items, value)
+        return dict([(k, value[k]) for k in keys]), len(value) - max_items
+    if isinstance(value, (list, tuple)) and len(value) > max_items:
+        return list(value[:max_items]), len(value) - max_items
+    return value, 0
+
+def _limit(value, max_items, max_depth):
+    '''
+    Returns (a copy of the value with _head() applied to it and to the lists,
+    sets and dicts it contains, number of items dropped at the top level).
+    The nested containers that were cut note how many items were dropped, and
+    the ones nested more than max_depth levels deep are replaced by their size.
+    '''
+    value, dropped = _head(value, max_items)
+    if isinstance(value, dict):
+        items = value.items()
+        value = {}
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+        value = [None] * len(value)
+    else:
+        return value, dropped
+    nested_depth = max_depth is not None and max_depth - 1 or None
+    for key, item in items:
+        if isinstance(item, (list, tuple, set, frozenset, dict)):
+            if max_depth is not None and max_depth <= 1:
+                item = '<%d items>' % len(item)
+            else:
+                item, item_dropped = _limit(item, max_items, nested_depth)
+                if item_dropped:
+                    if isinstance(item, dict):
+                        item['...'] = '%d more items' % item_dropped
+                    else:
+                        item.append('... (%d more items)' % item_dropped)
+        value[key] = item
+    return value, dropped
+
+class LazyRepr(object):
+    '''
+    Formats an object with repr() when (and only when) it's logged.
+    '''
+    def __init__(self, value, max_length=MAX_LENGTH, max_items=MAX_ITEMS, max_depth=MAX_DEPTH):
+        self.value = value
+        self.max_length = max_length
+        self.max_items = max_items
+        self.max_depth = max_depth
+
+    def format(self, value):
+        return repr(value)
+
+    def __str__(self):
+        value, dropped = _limit(self.value, self.max_items, self.max_depth)
+        text = self.format(value)
+        if dropped:
+            text = '%s (%d more items)' % (text, dropped)
+        return truncate(text, self.max_length)
+
+class LazyJSON(LazyRepr):
+    '''
+    Formats an object as JSON when (and only when) it's logged.
+    '''
+    def format(self, value):
+        return json.dumps(value, sort_keys=True, default=str)
+
+def _logfmt(value, max_length):
+    if isinstance(value, LazyRepr):
+        value = str(value)
+    elif isinstance(value, (dict, list, tuple)):
+        value = str(LazyJSON(value, max_length=max_length))
+    elif not isinstance(value, basestring):
+        value = str(value)
+    value = truncate(value, max_length)
+    if value == '' or re.search(r'[\s="]', value):
+        value = json.dumps(value)
+    return value
+
+class Event(object):
+    '''
+    A structured log message, formatted as "name key=value ..." when emitted.
+    '''
+    def __init__(self, name, fields, max_length=MAX_LENGTH):
+        self.name = name
+        self.fields = fields
+        self.max_length = max_length
+
+    def __str__(self):
+        fields = ' '.join(['%s=%s' % (k, _logfmt(v, self.max_length)) for k, v in sorted(self.fields.items())])
+        return ('%s %s' % (self.name, fields)).strip()
+
+class EventLogger(object):
+    '''
+    Logs structured events through a standard logger.
+
+    Nothing is formatted unless the logger is enabled for the level. With
+    sample_every=N, only the 1st, (N+1)th, ... occurrence of an event name is
+    logged, with the occurrence number and sampling rate added to its fields.
+    '''
+    def __init__(self, logger, max_length=200):
+        self.logger = logger
+        self.max_length = max_length
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def event(self, level, name, sample_every=1, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample_every > 1:
+            with self._lock:
+                count = self._counts.get(name, 0) + 1
+                self._counts[name] = count
+            if (count - 1) % sample_every != 0:
+                return
+            fields['occurrence'] = count
+            fields['sample_every'] = sample_every
+        self.logger.log(level, '%s', Event(name, fields, self.max_length))
+
+    def debug(self, name, sample_every=1, **fields):
+        self.event(logging.DEBUG, name, sample_every, **fields)
+
+    def info(self, name, sample_every=1, **fields):
+        self.event(logging.INFO, name, sample_every, **fields)
+
+    def warning(self, name, sample_every=1, **fields):
+        self.event(logging.WARNING, name, sample_every, **fields)
+
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+def configure_logging(level='INFO', http_debug=False):
+    '''
+    Sends log records to stderr at the given level. The HTTP connection
+    logging of urllib3 (one or more lines per request) is only turned on
+    with http_debug.
+    '''
+    logging.basicConfig()
+    logging.getLogger().setLevel(level)
+    http_level = http_debug and logging.DEBUG or logging.WARNING
+    for name in ('urllib3', 'requests.packages.urllib3'):
+        logging.getLogger(name).setLevel(http_level)
+
+def add_logging_arguments(parser):
+    '''Adds the --log_level and --debug_http options to an argparse parser.'''
+    parser.add_argument('--log_level', default='INFO', choices=LOG_LEVELS, help="Level of the messages to log. Default: INFO")
+    parser.add_argument('--debug_http', action='store_true', help="Log every HTTP connection and request (very verbose).")
@@ -0,0 +1,348 @@
+'''
+Request-level metrics for Canvas API traffic.
+
+Every response received through an instrumented requests session (the
+CanvasClient session, or the session of a canvas_sdk RequestContext) is
+recorded against its endpoint template, i.e. the API path with the IDs
+replaced by ":id" (/api/v1/users/123/page_views => /users/:id/page_views):
+
+- latency histogram (time until the response headers arrived)
+- number of requests by status code, and bytes of response bodies (as read,
+  after decompression)
+- pages per chain of paginated requests
+- retries and throttled requests
+
+plus the time spent waiting on the rate limiter and before retries, and the
+hits and misses of the scripts' caches. At the end of a run the metrics can
+be saved as a JSON summary and as a Prometheus textfile (for the node
+exporter textfile collector).
+
+Example:
+
+    from canvasutils.metrics import METRICS, instrument_request_context
+
+    instrument_request_context(request_context)
+    ...
+    METRICS.log_summary()
+    METRICS.save('metrics/find_due_dates')  # metrics/find_due_dates.json and .prom
+'''
+import os
+import re
+import json
+import time
+import bisect
+import logging
+import datetime
+import threading
+import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PAGES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+ID_SEGMENT = re.compile(r'^(?:\d+|sis_[a-z_]+_id:.+|self)$')
+
+def endpoint_template(url):
+    '''
+    Returns the endpoint template of an API URL: the path after the API
+    version, without the query string and with IDs replaced by ":id".
+    '''
+    path = urlparse.urlparse(url).path
+    match = re.search(r'/api/v\d+(/.*)$', path)
+    if match:
+        path = match.group(1)
+    segments = [ID_SEGMENT.match(s) and ':id' or s for s in path.rstrip('/').split('/')]
+    return '/'.join(segments) or '/'
+
+class Histogram(object):
+    '''
+    Cumulative histogram with fixed buckets (in the style of Prometheus).
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''Returns the upper bound of the bucket holding the q-quantile (None above the last bucket).'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def cumulative(self):
+        '''Returns a list of (upper bound, cumulative count) with "+Inf" last.'''
+        result = []
+        seen = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            seen += count
+            result.append((bound, seen))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': [[str(bound), count] for bound, count in self.cumulative()],
+        }
+
+class Metrics(object):
+    '''
+    Thread-safe collection of request metrics for one run of a script.
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started_at = clock()
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.page_chains = {}
+        self.waits = {}
+        self.caches = {}
+
+    def _endpoint(self, url):
+        template = endpoint_template(url)
+        if template not in self.endpoints:
+            self.endpoints[template] = {
+                'latency': Histogram(LATENCY_BUCKETS),
+                'statuses': {},
+                'bytes': 0,
+                'retries': 0,
+                'throttled': 0,
+            }
+        return self.endpoints[template]
+
+    def observe_request(self, url, status_code, seconds, num_bytes):
+        '''Records one response.'''
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint['latency'].observe(seconds)
+            status = str(status_code)
+            endpoint['statuses'][status] = endpoint['statuses'].get(status, 0) + 1
+            endpoint['bytes'] += num_bytes
+
+    def observe_bytes(self, url, num_bytes):
+        '''Adds to the bytes received from an endpoint, as a response body is read.'''
+        with self._lock:
+            self._endpoint(url)['bytes'] += num_bytes
+
+    def observe_page_chain(self, url, num_pages):
+        '''Records the number of pages fetched by a chain of paginated requests.'''
+        with self._lock:
+            template = endpoint_template(url)
+            if template not in self.page_chains:
+                self.page_chains[template] = Histogram(PAGES_BUCKETS)
+            self.page_chains[template].observe(num_pages)
+
+    def retried(self, url):
+        '''Records a request sent again after it failed.'''
+        with self._lock:
+            self._endpoint(url)['retries'] += 1
+
+    def throttled(self, url):
+        '''Records a request rejected because the rate limit was exceeded.'''
+        with self._lock:
+            self._endpoint(url)['throttled'] += 1
+
+    def waited(self, reason, seconds):
+        '''Adds to the time spent waiting for a reason (e.g. "rate_limit", "throttled" or "retry").'''
+        with self._lock:
+            self.waits[reason] = self.waits.get(reason, 0.0) + seconds
+
+    def cache_hit(self, cache):
+        with self._lock:
+            self.caches.setdefault(cache, {'hits': 0, 'misses': 0})['hits'] += 1
+
+    def cache_miss(self, cache):
+        with self._lock:
+            self.caches.setdefault(cache, {'hits': 0, 'misses': 0})['misses'] += 1
+
+    def summary(self):
+        '''Returns the metrics as a dict that can be serialized to JSON.'''
+        with self._lock:
+            endpoints = {}
+            for template, endpoint in self.endpoints.iteritems():
+                endpoints[template] = {
+                    'requests': endpoint['latency'].count,
+                    'statuses': dict(endpoint['statuses']),
+                    'bytes': endpoint['bytes'],
+                    'retries': endpoint['retries'],
+                    'throttled': endpoint['throttled'],
+                    'latency_seconds': endpoint['latency'].to_dict(),
+                }
+            caches = {}
+            for cache, counts in self.caches.iteritems():
+                total = counts['hits'] + counts['misses']
+                caches[cache] = dict(counts, hit_ratio=round(float(counts['hits']) / total, 4) if total else None)
+            return {
+                'started_at': datetime.datetime.utcfromtimestamp(self.started_at).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'duration_seconds': round(self.clock() - self.started_at, 3),
+                'requests': sum([e['requests'] for e in endpoints.values()]),
+                'bytes': sum([e['bytes'] for e in endpoints.values()]),
+                'endpoints': endpoints,
+                'pages_per_chain': dict([(t, h.to_dict()) for t, h in self.page_chains.iteritems()]),
+                'wait_seconds': dict([(r, round(s, 3)) for r, s in self.waits.iteritems()]),
+                'caches': caches,
+            }
+
+    def prometheus_text(self, labels=None):
+        '''
+        Returns the metrics in the Prometheus text exposition format. The
+        labels (a dict) are added to every sample, e.g. {'script': 'find_due_dates'}.
+        '''
+        def sample(name, value, sample_labels=None):
+            all_labels = dict(labels or {})
+            all_labels.update(sample_labels or {})
+            label_str = ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(all_labels.items())])
+            return '%s{%s} %s' % (name, label_str, value) if label_str else '%s %s' % (name, value)
+
+        def histogram(name, help_text, histograms, label_name):
+            lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s histogram' % name]
+            for key, h in sorted(histograms.items()):
+                for bound, count in h.cumulative():
+                    lines.append(sample(name + '_bucket', count, {label_name: key, 'le': bound}))
+                lines.append(sample(name + '_sum', repr(h.sum), {label_name: key}))
+                lines.append(sample(name + '_count', h.count, {label_name: key}))
+            return lines
+
+        def counter(name, help_text, values):
+            lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s counter' % name]
+            for sample_labels, value in values:
+                lines.append(sample(name, value, sample_labels))
+            return lines
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = histogram('canvas_api_request_duration_seconds', 'Time until the response headers arrived, by endpoint.',
+                dict([(t, e['latency']) for t, e in endpoints]), 'endpoint')
+            lines += counter('canvas_api_requests_total', 'Responses received, by endpoint and status code.',
+                [({'endpoint': t, 'status': s}, n) for t, e in endpoints for s, n in sorted(e['statuses'].items())])
+            lines += counter('canvas_api_response_bytes_total', 'Bytes of response bodies read (after decompression), by endpoint.',
+                [({'endpoint': t}, e['bytes']) for t, e in endpoints])
+            lines += counter('canvas_api_retries_total', 'Requests sent again after they failed, by endpoint.',
+                [({'endpoint': t}, e['retries']) for t, e in endpoints])
+            lines += counter('canvas_api_throttled_total', 'Requests rejected because the rate limit was exceeded, by endpoint.',
+                [({'endpoint': t}, e['throttled']) for t, e in endpoints])
+            lines += histogram('canvas_api_pages_per_chain', 'Pages fetched by each chain of paginated requests, by endpoint.',
+                self.page_chains, 'endpoint')
+            lines += counter('canvas_api_wait_seconds_total', 'Time spent waiting before sending requests, by reason.',
+                [({'reason': r}, repr(s)) for r, s in sorted(self.waits.items())])
+            lines += counter('canvas_cache_hits_total', 'Cache lookups that found the data, by cache.',
+                [({'cache': c}, n['hits']) for c, n in sorted(self.caches.items())])
+            lines += counter('canvas_cache_misses_total', 'Cache lookups that had to fetch the data, by cache.',
+                [({'cache': c}, n['misses']) for c, n in sorted(self.caches.items())])
+            lines += ['# HELP canvas_run_duration_seconds Duration of the run.', '# TYPE canvas_run_duration_seconds gauge',
+                sample('canvas_run_duration_seconds', repr(self.clock() - self.started_at))]
+        return '\n'.join(lines) + '\n'
+
+    def save(self, prefix, labels=None):
+        '''
+        Saves the JSON summary to PREFIX.json and the Prometheus textfile to
+        PREFIX.prom. The textfile is written to a temporary file first and
+        then renamed, so a collector never reads a partial file.
+        '''
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(prefix + '.json', 'w') as f:
+            json.dump(self.summary(), f, sort_keys=True, indent=2, separators=(',', ': '))
+        with open(prefix + '.prom.tmp', 'w') as f:
+            f.write(self.prometheus_text(labels=labels))
+        os.rename(prefix + '.prom.tmp', prefix + '.prom')
+        logger.info("Saved request metrics to %s.json and %s.prom" % (prefix, prefix))
+
+    def log_summary(self, log=None):
+        '''Logs the busiest endpoints and the cache hit ratios (to the given logger, if any).'''
+        log = log or logger
+        summary = self.summary()
+        log.info("API requests: %d in %.1fs, %d bytes, waits %s" % (summary['requests'], summary['duration_seconds'], summary['bytes'], summary['wait_seconds']))
+        endpoints = sorted(summary['endpoints'].items(), key=lambda item: -item[1]['latency_seconds']['sum'])
+        for template, endpoint in endpoints[:10]:
+            log.info("  %-40s %6d requests %8.1fs p50<=%ss p95<=%ss %d retries %d throttled" % (template, endpoint['requests'],
+                endpoint['latency_seconds']['sum'], endpoint['latency_seconds']['p50'], endpoint['latency_seconds']['p95'],
+                endpoint['retries'], endpoint['throttled']))
+        for cache, counts in sorted(summary['caches'].items()):
+            log.info("  cache %-34s %6d hits %6d misses" % (cache, counts['hits'], counts['misses']))
+
+# Metrics shared by everything in the process
+METRICS = Metrics()
+
+class _CountingBody(object):
+    '''
+    Wraps the raw body of a response (a urllib3 response) and calls
+    count(number of bytes) as it's read, whether requests reads it for
+    response.content or the caller streams it. The bytes are counted after
+    decompression, like len(response.content).
+    '''
+    def __init__(self, raw, count):
+        self.__dict__['_raw'] = raw
+        self.__dict__['_count'] = count
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        if data:
+            self._count(len(data))
+        return data
+
+    def _stream(self, *args, **kwargs):
+        for chunk in self._raw.stream(*args, **kwargs):
+            self._count(len(chunk))
+            yield chunk
+
+    def __getattr__(self, name):
+        # requests only uses stream() if the body has one
+        if name == 'stream':
+            getattr(self._raw, 'stream')
+            return self._stream
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+def instrument_session(session, metrics=None):
+    '''
+    Adds a response hook to a requests.Session that records every response
+    in the metrics (by default the shared METRICS).
+    '''
+    if metrics is None:
+        metrics = METRICS
+    def record_response(response, *args, **kwargs):
+        # Hooks run before requests reads the body (unless an adapter already
+        # read it), so the bytes are counted as the body is read
+        num_bytes = 0
+        if getattr(response, 'from_cache', False):
+            pass # rebuilt from a 304 Not Modified (see httpcache.py)
+        elif getattr(response, '_content', False) is not False:
+            num_bytes = len(response._content or '')
+        elif response.raw is not None:
+            url = response.url
+            response.raw = _CountingBody(response.raw, lambda n: metrics.observe_bytes(url, n))
+        metrics.observe_request(response.url, response.status_code, response.elapsed.total_seconds(), num_bytes)
+    session.hooks.setdefault('response', []).append(record_response)
+    return session
+
+def instrument_request_context(request_context, metrics=None):
+    '''
+    Instruments the requests session used by a canvas_sdk RequestContext, so
+    the requests sent through the SDK are recorded too.
+    '''
+    session = getattr(request_context, 'session', None)
+    if session is None:
+        logger.warning("Request context has no session: canvas_sdk requests won't be recorded in the metrics")
+        return request_context
+    instrument_session(session, metrics)
+    return request_context
@@ -0,0 +1,100 @@
+'''
+Producer/consumer pipeline that overlaps fetching with processing.
+
+pipeline() calls a function (e.g. one that fetches the submissions of an
+assignment) for each item in a pool of worker threads, and yields the
+results to the calling thread as they're ready, so the caller can transform
+and write the results of finished items while the next ones download:
+
+    fetch = lambda course: client.get_all('/courses/%s/assignments' % course['id'])
+    for course, assignments in pipeline(fetch, courses, concurrency=4, ordered=True):
+        write_rows(course, assignments)
+
+At most `window` items are fetched and not yet consumed at any time: the
+workers wait when the consumer falls behind, so memory is bounded by the
+window rather than by the number of items. With ordered=True the results are
+yielded in the order of the items (results that finish early wait in the
+window), otherwise in the order they finish.
+
+Unlike CanvasClient.map(), the fetching happens in worker threads even with
+concurrency=1, so one download is always in flight while the consumer works.
+'''
+import sys
+import Queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def _get(queue):
+    '''Queue.get() that can be interrupted with Ctrl-C (a get without a timeout can't be in Python 2).'''
+    while True:
+        try:
+            return queue.get(True, 1)
+        except Queue.Empty:
+            pass
+
+def pipeline(func, items, concurrency=1, window=None, ordered=False):
+    '''
+    Generator that calls func(item) for each item in `concurrency` worker
+    threads and yields (item, result) tuples (see the module docstring).
+    `window` defaults to twice the concurrency. Exceptions raised by func
+    are re-raised here, and the items that haven't started are skipped.
+    '''
+    items = list(items)
+    concurrency = max(1, concurrency)
+    window = max(window or 2 * concurrency, concurrency)
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    slots = threading.Semaphore(window)
+    stopped = threading.Event()
+
+    def feed():
+        for index, item in enumerate(items):
+            slots.acquire()
+            if stopped.is_set():
+                break
+            tasks.put((index, item))
+        for i in range(concurrency):
+            tasks.put(None)
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            if stopped.is_set():
+                continue
+            try:
+                results.put((index, item, func(item), None))
+            except Exception:
+                results.put((index, item, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = {}
+    next_index = 0
+    try:
+        for i in xrange(len(items)):
+            index, item, result, error = _get(results)
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if not ordered:
+                yield item, result
+                slots.release()
+                continue
+            pending[index] = (item, result)
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+                slots.release()
+    finally:
+        # Stop feeding (waking the feeder if it's waiting for a slot) and
+        # let the workers finish the items they started
+        stopped.set()
+        for i in range(window):
+            slots.release()
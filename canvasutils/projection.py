@@ -0,0 +1,201 @@
+'''
+Field projection of JSON list responses.
+
+Most scripts only use a few fields of each object in a list (e.g. the URL and
+date of a page view, not its user agent, links or controller).
+project_items() parses the response as it's read from the connection and
+keeps only the projected fields of each object, without keeping a copy of the
+raw bytes and of the decoded text as response.json() does.
+
+By default the body is read in chunks, and the items of the array are decoded
+one at a time with the json module and projected. Only one whole object is in
+memory at a time. This takes about 1.4x the CPU time of json.load() for
+page view pages, for the loop over the items.
+
+When the optional "ijson" library is installed, the body is parsed as a
+stream of events and only the projected fields are built; the rest of each
+object is skipped without creating Python objects for it. That saves memory
+for objects with large unused fields, but it's slower (about 2-3x the CPU
+time of json.load() with the C backend), so it's only worth installing for
+such endpoints:
+
+    $ pip install ijson
+'''
+import re
+import json
+import codecs
+import decimal
+import importlib
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Size of the reads of the json module parser
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+def _ijson_backend():
+    '''Returns the fastest ijson backend available.'''
+    for name in ('yajl2_c', 'yajl2_cffi', 'yajl2'):
+        try:
+            return importlib.import_module('ijson.backends.' + name)
+        except Exception:
+            pass
+    return ijson
+
+def project(obj, fields):
+    '''Returns a dict with only the given fields of obj (missing fields are left out).'''
+    return dict([(k, obj[k]) for k in fields if k in obj])
+
+def _number(value):
+    '''ijson returns numbers as Decimal; the json module returns int or float.'''
+    if isinstance(value, decimal.Decimal):
+        if value.as_tuple().exponent >= 0:
+            return int(value)
+        return float(value)
+    return value
+
+class _Builder(object):
+    '''Builds a nested value from ijson events (like ijson.common.ObjectBuilder, with json-style numbers).'''
+    def __init__(self):
+        self.stack = []
+        self.keys = []
+        self.value = None
+
+    def event(self, event, value):
+        if event == 'map_key':
+            self.keys[-1] = value
+            return
+        if event in ('start_map', 'start_array'):
+            container = {} if event == 'start_map' else []
+            self._add(container)
+            self.stack.append(container)
+            self.keys.append(None)
+        elif event in ('end_map', 'end_array'):
+            self.stack.pop()
+            self.keys.pop()
+        else:
+            self._add(_number(value))
+
+    def _add(self, value):
+        if not self.stack:
+            self.value = value
+        elif isinstance(self.stack[-1], dict):
+            self.stack[-1][self.keys[-1]] = value
+        else:
+            self.stack[-1].append(value)
+
+    @property
+    def done(self):
+        return not self.stack
+
+def _iter_projected_ijson(fileobj, fields):
+    fields = set(fields)
+    item = None
+    field = None
+    builder = None
+    for prefix, event, value in _ijson_backend().parse(fileobj):
+        if builder is not None:
+            builder.event(event, value)
+            if builder.done:
+                item[field] = builder.value
+                builder = None
+                field = None
+        elif prefix == 'item':
+            if event == 'start_map':
+                item = {}
+            elif event == 'end_map':
+                yield item
+                item = None
+            elif event == 'map_key':
+                field = value in fields and value or None
+            elif event in ('string', 'number', 'boolean', 'null'):
+                # A list of scalars: nothing to project
+                yield _number(value)
+        elif field is not None and item is not None and prefix == 'item.' + field:
+            if event in ('start_map', 'start_array'):
+                builder = _Builder()
+                builder.event(event, value)
+            else:
+                item[field] = _number(value)
+                field = None
+
+def _read_more(fileobj, decoder, text, pos, chunk_size):
+    '''
+    Returns (the text from pos with the next chunk of the body decoded and
+    appended, whether the end of the body was reached). It reads at least as
+    much as is left, so an item larger than a chunk takes a few reads.
+    '''
+    data = fileobj.read(max(chunk_size, len(text) - pos))
+    return text[pos:] + decoder.decode(data, not data), not data
+
+def _iter_projected_json(fileobj, fields, chunk_size=CHUNK_SIZE):
+    '''
+    Decodes the items of a JSON array one at a time with the json module,
+    reading the body in chunks, and yields the projected fields of each.
+    Only the item being decoded and the rest of the last chunk are in
+    memory. The body is read to the end, so it's complete when it's cached
+    (see httpcache.py).
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    text = u''
+    pos = 0
+    eof = False
+    state = 'start'         # start, first (an item or "]"), item, separator, end
+    while True:
+        pos = _WHITESPACE.match(text, pos).end()
+        if pos == len(text):
+            if eof:
+                if state == 'end':
+                    return
+                raise ValueError("Unexpected end of the JSON array")
+            text, eof = _read_more(fileobj, utf8, text, pos, chunk_size)
+            pos = 0
+            continue
+        char = text[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError("Expected a JSON array, found %r" % char)
+            state = 'first'
+            pos += 1
+        elif state in ('first', 'separator') and char == ']':
+            state = 'end'
+            pos += 1
+        elif state == 'separator':
+            if char != ',':
+                raise ValueError("Expected , or ] in the JSON array, found %r" % char)
+            state = 'item'
+            pos += 1
+        elif state in ('first', 'item'):
+            try:
+                item, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            # An item cut at the end of the text doesn't decode, except a
+            # number (e.g. "12" of "12.5"), so both are decoded again with
+            # more of the body
+            if end is None or (not eof and _NUMBER_TAIL.match(text, end).end() == len(text)):
+                text, eof = _read_more(fileobj, utf8, text, pos, chunk_size)
+                pos = 0
+                continue
+            pos = end
+            state = 'separator'
+            yield isinstance(item, dict) and project(item, fields) or item
+        else:
+            raise ValueError("Unexpected %r after the JSON array" % char)
+
+def project_items(fileobj, fields):
+    '''
+    Reads a JSON array of objects from a file-like object and returns a list
+    with the projected fields of each object.
+    '''
+    if ijson is None:
+        return list(_iter_projected_json(fileobj, fields))
+    return list(_iter_projected_ijson(fileobj, fields))
@@ -0,0 +1,160 @@
+'''
+Adaptive throttling for Canvas API requests.
+
+Canvas meters API usage with a leaky bucket per access token. Every response
+says how much quota the request cost (X-Request-Cost) and how much is left
+(X-Rate-Limit-Remaining). When the bucket is empty, requests are rejected with
+403 Forbidden (Rate Limit Exceeded).
+
+The RateLimiter mirrors that bucket on the client side: each request takes the
+average request cost out of a local token bucket that is reset from the
+remaining quota reported by the server and refilled at a steady rate while
+waiting. On top of that, the number of requests in flight is adjusted with
+additive increase / multiplicative decrease: it grows while the remaining
+quota is healthy and shrinks when it gets low or a request is throttled, so
+throughput settles just under the server's quota.
+
+See also: https://canvas.instructure.com/doc/api/file.throttling.html
+'''
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def is_throttled(response):
+    '''
+    Returns true if the response was rejected because the rate limit was exceeded.
+    '''
+    return response is not None and response.status_code == 403 and 'Rate Limit Exceeded' in response.text
+
+def _header_float(headers, name):
+    '''Returns the value of a numeric header, or None if missing or invalid.'''
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class RateLimiter(object):
+    '''
+    Thread-safe adaptive rate limiter. One instance can be shared by several
+    clients that use the same access token.
+
+    Parameters:
+    - max_concurrency: the most requests allowed in flight at the same time
+    - reserve: quota to leave unused in the bucket, so other users of the same
+      token (or a slow estimate of the request cost) don't hit the limit
+    - refill_rate: quota units per second assumed to leak out of the
+      server's bucket while waiting for more quota
+    - max_backoff: the longest delay in seconds before retrying a throttled request
+    '''
+    def __init__(self, max_concurrency=8, reserve=50.0, refill_rate=10.0, max_backoff=30.0, clock=time.time):
+        self.max_concurrency = max_concurrency
+        self.reserve = reserve
+        self.refill_rate = refill_rate
+        self.max_backoff = max_backoff
+        self.clock = clock
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.tokens = None # unknown until the first response
+        self.capacity = None
+        self.avg_cost = 1.0
+        self.refilled_at = clock()
+        self.consecutive_throttles = 0
+
+        self.num_throttled = 0
+        self.wait_seconds = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        '''Adds the quota that leaked out of the server's bucket since the last refill.'''
+        now = self.clock()
+        if self.tokens is not None and self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.refill_rate)
+        self.refilled_at = now
+
+    def _reserve(self):
+        '''
+        Returns the quota to leave unused: at most half of the largest
+        remaining quota seen, so a token whose quota is small (or mostly used
+        by other jobs) can still reach it.
+        '''
+        if self.capacity is None:
+            return self.reserve
+        return min(self.reserve, self.capacity / 2)
+
+    def _can_send(self):
+        if self.in_flight >= max(int(self.limit), 1):
+            return False
+        # With nothing in flight no response will refill the bucket, so let
+        # a request through to make progress (throttled requests back off in
+        # the client)
+        if self.in_flight == 0:
+            return True
+        return self.tokens is None or self.tokens - self.avg_cost >= self._reserve()
+
+    def acquire(self):
+        '''
+        Blocks until another request may be sent.
+        '''
+        started_at = self.clock()
+        with self._cond:
+            self._refill()
+            while not self._can_send():
+                self._cond.wait(0.1)
+                self._refill()
+            self.in_flight += 1
+            if self.tokens is not None:
+                self.tokens -= self.avg_cost
+            self.wait_seconds += self.clock() - started_at
+
+    def release(self, response=None):
+        '''
+        Marks a request as done and adapts to the rate limit headers of its
+        response (if there is one).
+        '''
+        with self._cond:
+            self.in_flight -= 1
+            if response is not None:
+                self._update(response.headers, throttled=is_throttled(response))
+            self._cond.notify_all()
+
+    def _update(self, headers, throttled=False):
+        '''
+        Adapts to the rate limit headers of a response. The backoff of
+        throttled requests (see throttled()) only starts over after a response
+        that wasn't throttled, whether or not it had the headers.
+        '''
+        cost = _header_float(headers, 'X-Request-Cost')
+        remaining = _header_float(headers, 'X-Rate-Limit-Remaining')
+        if cost is not None:
+            self.avg_cost = 0.8 * self.avg_cost + 0.2 * cost
+        if remaining is not None:
+            self.capacity = max(self.capacity or 0, remaining)
+            self.tokens = remaining - self.in_flight * self.avg_cost
+            self.refilled_at = self.clock()
+
+        if throttled:
+            return
+        if remaining is not None and remaining < 2 * self._reserve():
+            self.limit = max(1.0, self.limit * 0.75)
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.consecutive_throttles = 0
+
+    def throttled(self):
+        '''
+        Records that a request was throttled and returns how long to wait
+        before retrying it. Each consecutive throttled request doubles the delay.
+        '''
+        with self._cond:
+            self.num_throttled += 1
+            self.consecutive_throttles += 1
+            self.limit = max(1.0, self.limit / 2)
+            if self.capacity is not None:
+                self.tokens = 0.0
+                self.refilled_at = self.clock()
+            delay = min(self.max_backoff, 2 ** (self.consecutive_throttles - 1))
+        logger.warning("Rate limit exceeded: retrying in %s seconds with up to %d requests in flight" % (delay, int(self.limit)))
+        return delay
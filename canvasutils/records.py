@@ -0,0 +1,221 @@
+'''
+Compact in-memory storage for page views.
+
+A list of page view dicts repeats the same keys, URLs, user agents and
+timestamp strings for every page view. A PageViewTable keeps the page views
+as parallel columns instead:
+
+- id: the page view IDs (ASCII strings are kept as byte strings)
+- created_at: Unix times in an array of integers
+- interaction_seconds: an array of floats (whole numbers come back as floats)
+- any other field (url, user_agent, context_type, links...): indexes into a
+  table of the distinct values, which can be shared by many tables
+
+The page views are converted from and to dicts at the edges: append() and
+extend() take dicts, and iterating over a table yields dicts, so it can
+stand in for a list of page views. Code that only needs a few fields should
+use iter_fields() and the `timestamps` column instead, which don't build a
+dict per page view:
+
+    interned = {}
+    table = PageViewTable(['id', 'url', 'created_at'], interned=interned)
+    table.extend(page_views)
+    for url, created_at in iter_fields(table, 'url', 'created_at'):
+        ...
+
+Use to_json() as the `default` of json.dump() to save tables as lists of
+dicts.
+'''
+import time
+import array
+import calendar
+import itertools
+import threading
+
+NAN = float('nan')
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_DAY_SECONDS = {}
+
+def epoch_seconds(created_at):
+    '''
+    Returns the Unix time of an ISO 8601 timestamp like the created_at of a
+    page view ("2016-02-01T13:45:10Z" or "2016-02-01T08:45:10-05:00").
+    '''
+    day = created_at[:10]
+    seconds = _DAY_SECONDS.get(day)
+    if seconds is None:
+        seconds = _DAY_SECONDS[day] = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+    seconds += int(created_at[11:13]) * 3600 + int(created_at[14:16]) * 60 + int(created_at[17:19])
+    offset = created_at[19:].lstrip('.0123456789')
+    if offset[:1] in ('+', '-'):
+        sign = offset[0] == '-' and 1 or -1
+        seconds += sign * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+    return seconds
+
+def format_timestamp(seconds):
+    '''Returns the ISO 8601 UTC timestamp ("2016-02-01T13:45:10Z") of a Unix time.'''
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+def _freeze(value):
+    '''Returns a hashable version of a value (dicts and lists become tuples).'''
+    if isinstance(value, dict):
+        return (dict, tuple(sorted([(k, _freeze(v)) for k, v in value.iteritems()])))
+    if isinstance(value, list):
+        return (list, tuple([_freeze(v) for v in value]))
+    return value
+
+def _compact_string(value):
+    '''Returns ASCII unicode strings as byte strings, which take a quarter of the memory.'''
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
+
+class ValueTable(object):
+    '''
+    A table of distinct values, each stored once and referred to by its
+    index. Values can be added from several threads.
+    '''
+    def __init__(self):
+        self.values = []
+        self.index_of = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def index(self, value):
+        '''Returns the index of a value, adding it to the table if needed.'''
+        key = _freeze(value)
+        index = self.index_of.get(key)
+        if index is None:
+            with self.lock:
+                index = self.index_of.get(key)
+                if index is None:
+                    self.values.append(_compact_string(value))
+                    index = self.index_of[key] = len(self.values) - 1
+        return index
+
+class PageViewTable(object):
+    '''
+    Page views with the given fields, stored as parallel columns (see the
+    module docstring). `interned` is a dict of ValueTables by field, shared
+    by the tables that should store each distinct value once.
+    '''
+    __slots__ = ('fields', 'columns', 'interned', 'timestamps', 'odd_timestamps', 'length')
+
+    def __init__(self, fields, interned=None):
+        self.fields = list(fields)
+        self.interned = interned if interned is not None else {}
+        self.columns = {}
+        for field in self.fields:
+            if field == 'id':
+                self.columns[field] = []
+            elif field == 'created_at':
+                self.columns[field] = self.timestamps = array.array('l')
+            elif field == 'interaction_seconds':
+                self.columns[field] = array.array('d')
+            else:
+                self.columns[field] = array.array('i')
+                self.interned.setdefault(field, ValueTable())
+        if 'created_at' not in self.fields:
+            self.timestamps = None
+        # Timestamps that aren't in TIMESTAMP_FORMAT (e.g. with a time zone
+        # offset) by row, so they're returned unchanged
+        self.odd_timestamps = {}
+        self.length = 0
+
+    @classmethod
+    def from_dicts(cls, page_views, fields, interned=None):
+        table = cls(fields, interned=interned)
+        table.extend(page_views)
+        return table
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '<PageViewTable of %d page views>' % self.length
+
+    def append(self, page_view):
+        '''Adds a page view dict (missing fields are stored as None).'''
+        for field in self.fields:
+            value = page_view.get(field)
+            column = self.columns[field]
+            if field == 'id':
+                column.append(_compact_string(value))
+            elif field == 'created_at':
+                seconds = epoch_seconds(value) if value else 0
+                column.append(seconds)
+                if not value or len(value) != 20 or value[19] != 'Z':
+                    self.odd_timestamps[self.length] = value
+            elif field == 'interaction_seconds':
+                column.append(NAN if value is None else value)
+            else:
+                column.append(self.interned[field].index(value))
+        self.length += 1
+
+    def extend(self, page_views):
+        for page_view in page_views:
+            self.append(page_view)
+
+    def value(self, field, row):
+        '''Returns the value of a field of the page view in a row.'''
+        stored = self.columns[field][row]
+        if field == 'id':
+            return stored
+        if field == 'created_at':
+            if row in self.odd_timestamps:
+                return self.odd_timestamps[row]
+            return format_timestamp(stored)
+        if field == 'interaction_seconds':
+            return None if stored != stored else stored
+        return self.interned[field].values[stored]
+
+    def column(self, field):
+        '''Returns an iterator over the values of a field.'''
+        column = self.columns[field]
+        if field == 'id':
+            return iter(column)
+        if field in ('created_at', 'interaction_seconds'):
+            return (self.value(field, row) for row in xrange(self.length))
+        values = self.interned[field].values
+        return (values[index] for index in column)
+
+    def __iter__(self):
+        fields = self.fields
+        for values in itertools.izip(*[self.column(field) for field in fields]):
+            yield dict(itertools.izip(fields, values))
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.length
+        if not (0 <= row < self.length):
+            raise IndexError(row)
+        return dict([(field, self.value(field, row)) for field in self.fields])
+
+    def to_dicts(self):
+        '''Returns the page views as a list of dicts.'''
+        return list(self)
+
+def iter_fields(page_views, *fields):
+    '''
+    Yields a tuple with the values of the fields of each page view, from a
+    PageViewTable or a list of page view dicts.
+    '''
+    if isinstance(page_views, PageViewTable):
+        return itertools.izip(*[page_views.column(field) for field in fields])
+    return (tuple([page_view.get(field) for field in fields]) for page_view in page_views)
+
+def to_json(value):
+    '''The `default` of json.dump() for saving PageViewTables as lists of dicts.'''
+    if isinstance(value, PageViewTable):
+        return value.to_dicts()
+    raise TypeError("%r is not JSON serializable" % (value,))
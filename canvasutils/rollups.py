@@ -0,0 +1,183 @@
+'''
+Time-bucketed rollups of page views in a SQLite database.
+
+The page views are counted by hour, day and week (starting on Monday), for
+each course, user and URL category, so questions like "daily views per tool"
+or "weekly views per student" are answered from a few thousand rows instead
+of another pass over the raw page views:
+
+    store = RollupStore('rollups.db')
+    store.add_page_views(1693, page_views_by_user, '2016-01-25', '2016-05-14', category=url_category)
+    for row in store.query('day', group_by=['category'], course_id=1693, start='2016-02-01', end='2016-03-01'):
+        print row
+
+Buckets are labeled with the UTC time they start at, e.g. "2016-02-01T13"
+for an hour, "2016-02-01" for a day or the week starting that Monday.
+
+The store remembers the date ranges it has counted for each course and
+user, and page views inside those ranges are skipped, so running a report
+again over the same or an overlapping range doesn't count views twice.
+'''
+import sqlite3
+import logging
+import datetime
+from collections import Counter
+
+from canvasutils.records import iter_fields
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ['hour', 'day', 'week']
+GROUP_BY = ['bucket', 'course_id', 'user_id', 'category']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS page_view_rollups (
+    granularity TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    course_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    views INTEGER NOT NULL,
+    PRIMARY KEY (granularity, bucket, course_id, user_id, category)
+);
+CREATE INDEX IF NOT EXISTS page_view_rollups_user ON page_view_rollups (granularity, course_id, user_id, bucket);
+CREATE TABLE IF NOT EXISTS page_view_rollups_ingested (
+    course_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS page_view_rollups_ingested_user ON page_view_rollups_ingested (course_id, user_id);
+'''
+
+def _timestamp(created_at):
+    '''Returns the "YYYY-MM-DDTHH:MM:SS" part of an ISO 8601 UTC timestamp.'''
+    return created_at[:10] + 'T' + created_at[11:19]
+
+def _normalize_time(value):
+    '''Returns a date or time from the command line in the same format as the timestamps.'''
+    value = value.replace(' ', 'T')
+    if len(value) == 10:
+        value += 'T00:00:00'
+    return value
+
+class RollupStore(object):
+    '''
+    Page view counts by hour, day and week, for each course, user and URL
+    category (see the module docstring).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._weeks = {}
+
+    def close(self):
+        self.connection.close()
+
+    def week(self, day):
+        '''Returns the Monday of the week of a "YYYY-MM-DD" day.'''
+        week = self._weeks.get(day)
+        if week is None:
+            date = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            week = self._weeks[day] = (date - datetime.timedelta(days=date.weekday())).isoformat()
+        return week
+
+    def buckets(self, timestamp):
+        '''Returns the (granularity, bucket) pairs a "YYYY-MM-DDTHH:MM:SS" timestamp falls in.'''
+        day = timestamp[:10]
+        return [('hour', timestamp[:13]), ('day', day), ('week', self.week(day))]
+
+    def ingested_ranges(self, course_id):
+        '''Returns a dict mapping each user ID to the (start, end) ranges already counted for the course.'''
+        ranges = {}
+        cursor = self.connection.execute('SELECT user_id, start_time, end_time FROM page_view_rollups_ingested WHERE course_id = ?', (course_id,))
+        for user_id, start_time, end_time in cursor:
+            ranges.setdefault(user_id, []).append((start_time, end_time))
+        return ranges
+
+    def add_page_views(self, course_id, page_views_by_user, start_time, end_time, category=None, include=None):
+        '''
+        Counts the page views of each user into the rollups, and records that
+        the range from start_time (inclusive) to end_time (exclusive) has been
+        counted for those users. Page views in ranges that were already
+        counted are skipped.
+
+        Parameters:
+        - page_views_by_user: a dict of the page views of each user (lists of
+          dicts or PageViewTables)
+        - category: a function returning the category of a page view URL
+        - include: a function returning whether a page view URL is counted
+
+        Returns the number of page views counted.
+        '''
+        start_time, end_time = _normalize_time(start_time), _normalize_time(end_time)
+        ingested = self.ingested_ranges(course_id)
+        counts = Counter()
+        num_counted = 0
+        for user_id, page_views in page_views_by_user.iteritems():
+            user_ranges = ingested.get(user_id, [])
+            for url, created_at in iter_fields(page_views, 'url', 'created_at'):
+                if include is not None and not include(url):
+                    continue
+                timestamp = _timestamp(created_at)
+                if not (start_time <= timestamp < end_time):
+                    continue
+                if any([r[0] <= timestamp < r[1] for r in user_ranges]):
+                    continue
+                url_category = category is not None and category(url) or ''
+                for granularity, bucket in self.buckets(timestamp):
+                    counts[(granularity, bucket, course_id, user_id, url_category)] += 1
+                num_counted += 1
+
+        with self.connection:
+            rows = [key + (views,) for key, views in counts.iteritems()]
+            self.connection.executemany('INSERT OR IGNORE INTO page_view_rollups VALUES (?, ?, ?, ?, ?, 0)', [key for key in counts])
+            self.connection.executemany(
+                'UPDATE page_view_rollups SET views = views + ? '
+                'WHERE granularity = ? AND bucket = ? AND course_id = ? AND user_id = ? AND category = ?',
+                [(row[5],) + row[:5] for row in rows])
+            self.connection.executemany('INSERT INTO page_view_rollups_ingested VALUES (?, ?, ?, ?)',
+                [(course_id, user_id, start_time, end_time) for user_id in page_views_by_user])
+        logger.info("Counted %d page views into %d rollup rows in %s" % (num_counted, len(counts), self.path))
+        return num_counted
+
+    def query(self, granularity, group_by=None, course_id=None, user_id=None, category=None, start=None, end=None):
+        '''
+        Returns a list of tuples with the values of the group_by columns (a
+        list of "bucket", "course_id", "user_id" and "category") and the
+        number of page views, sorted by the group_by columns. The start
+        (inclusive) and end (exclusive) times are dates or times, and select
+        the buckets that start in that range.
+        '''
+        if granularity not in GRANULARITIES:
+            raise ValueError("Unknown granularity %s (expected one of %s)" % (granularity, ', '.join(GRANULARITIES)))
+        group_by = group_by or []
+        for column in group_by:
+            if column not in GROUP_BY:
+                raise ValueError("Can't group by %s (expected one of %s)" % (column, ', '.join(GROUP_BY)))
+
+        where, params = ['granularity = ?'], [granularity]
+        for column, value in (('course_id', course_id), ('user_id', user_id), ('category', category)):
+            if value is not None:
+                where.append('%s = ?' % column)
+                params.append(value)
+        if start is not None:
+            where.append('bucket >= ?')
+            params.append(self._bucket_bound(granularity, start))
+        if end is not None:
+            where.append('bucket < ?')
+            params.append(self._bucket_bound(granularity, end))
+
+        columns = ', '.join(group_by + ['SUM(views)'])
+        sql = 'SELECT %s FROM page_view_rollups WHERE %s' % (columns, ' AND '.join(where))
+        if group_by:
+            sql += ' GROUP BY %s ORDER BY %s' % (', '.join(group_by), ', '.join(group_by))
+        return self.connection.execute(sql, params).fetchall()
+
+    def _bucket_bound(self, granularity, value):
+        '''Returns a date or time in the format of the buckets of the granularity, for range comparisons.'''
+        value = _normalize_time(value)
+        if granularity == 'hour':
+            return value[:13]
+        return value[:10]
@@ -0,0 +1,174 @@
+'''
+Study sessions reconstructed from page views.
+
+A session is a run of a user's page views where no two consecutive views are
+more than `gap` seconds apart. Its duration is the time from its first to
+its last page view (so a session with a single page view lasts 0 seconds).
+
+numpy is optional (it isn't in requirements.txt), and the two paths give the
+same results:
+
+- Without numpy (the default), the page views are grouped by user in a
+  dict, and each user's times are sorted and compared with the previous
+  one in lists.
+- When numpy is installed, the page views of all users are sorted once with
+  argsort on a combined (user index, time) key (lexsort on (user, time) if
+  the key would overflow 64 bits), session boundaries are found with diff,
+  and the per user and per week sums are done with reduceat. This keeps up
+  with account-sized inputs:
+
+    $ pip install numpy
+
+Example:
+
+    user_ids, timestamps = page_view_times(page_views_by_user)
+    sessions = find_sessions(user_ids, timestamps, gap=30 * 60)
+    for user_id, num_sessions, seconds, pages in sessions_by_user(sessions):
+        print user_id, num_sessions, seconds, pages
+'''
+import datetime
+import itertools
+
+from canvasutils.records import PageViewTable, epoch_seconds
+
+# numpy takes a while to import, so it's imported the first time sessions are
+# found (see _numpy())
+numpy = None
+_numpy_checked = False
+
+DEFAULT_GAP = 30 * 60
+
+def _numpy():
+    '''Returns the numpy module, or None if it isn't installed.'''
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_checked = True
+    return numpy
+
+def page_view_times(page_views_by_user, include=None):
+    '''
+    Returns two parallel lists with the user ID and Unix time of every page
+    view (the page views of a user are a list of dicts or a PageViewTable).
+    If include is given, only the page views whose URL it returns true
+    for are listed.
+    '''
+    user_ids, timestamps = [], []
+    for user_id, page_views in page_views_by_user.iteritems():
+        if isinstance(page_views, PageViewTable):
+            # The times are already stored as Unix times
+            pairs = itertools.izip(page_views.column('url'), page_views.timestamps)
+            times = [t for url, t in pairs if include is None or include(url)]
+        else:
+            times = [epoch_seconds(pv['created_at']) for pv in page_views if include is None or include(pv['url'])]
+        user_ids.extend([user_id] * len(times))
+        timestamps.extend(times)
+    return user_ids, timestamps
+
+def week_start(seconds):
+    '''Returns the Monday (YYYY-MM-DD, in UTC) of the week of a Unix time.'''
+    days = seconds // 86400
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=days - (days + 3) % 7)).isoformat()
+
+def find_sessions(user_ids, timestamps, gap=DEFAULT_GAP):
+    '''
+    Splits the page views (parallel lists of user IDs and Unix times, in any
+    order) into sessions. Returns four parallel lists with the user ID,
+    start time, end time and number of page views of each session, sorted
+    by user and start time.
+    '''
+    if not timestamps:
+        return [], [], [], []
+    if _numpy() is not None:
+        return _find_sessions_numpy(user_ids, timestamps, gap)
+
+    times_of = {}
+    for user_id, timestamp in zip(user_ids, timestamps):
+        times_of.setdefault(user_id, []).append(timestamp)
+    session_users, starts, ends, pages = [], [], [], []
+    for user_id in sorted(times_of):
+        times = sorted(times_of[user_id])
+        # Indexes of the first view of each session
+        firsts = [0] + [i for i, (a, b) in enumerate(zip(times, times[1:]), 1) if b - a > gap]
+        lasts = [i - 1 for i in firsts[1:]] + [len(times) - 1]
+        session_users.extend([user_id] * len(firsts))
+        starts.extend([times[i] for i in firsts])
+        ends.extend([times[i] for i in lasts])
+        pages.extend([last - first + 1 for first, last in zip(firsts, lasts)])
+    return session_users, starts, ends, pages
+
+def _find_sessions_numpy(user_ids, timestamps, gap):
+    users = numpy.asarray(user_ids, dtype=numpy.int64)
+    times = numpy.asarray(timestamps, dtype=numpy.int64)
+    # Sorting one combined (user index, time) key is about twice as fast as lexsort
+    unique_users, user_index = numpy.unique(users, return_inverse=True)
+    first_time = times.min()
+    span = int(times.max() - first_time) + 1
+    if len(unique_users) * span < 2 ** 62:
+        order = numpy.argsort(user_index.astype(numpy.int64) * span + (times - first_time))
+    else:
+        order = numpy.lexsort((times, users))
+    users, times = users[order], times[order]
+    is_first = numpy.empty(len(times), dtype=bool)
+    is_first[0] = True
+    is_first[1:] = (users[1:] != users[:-1]) | (numpy.diff(times) > gap)
+    firsts = numpy.flatnonzero(is_first)
+    lasts = numpy.append(firsts[1:], len(times)) - 1
+    return (users[firsts].tolist(), times[firsts].tolist(), times[lasts].tolist(), (lasts - firsts + 1).tolist())
+
+def sessions_by_user(sessions):
+    '''
+    Returns a list of (user ID, number of sessions, total seconds, total page
+    views) for each user, from the lists returned by find_sessions().
+    '''
+    session_users, starts, ends, pages = sessions
+    return _sum_runs([session_users], starts, ends, pages)
+
+def sessions_by_user_week(sessions):
+    '''
+    Returns a list of (user ID, week, number of sessions, total seconds,
+    total page views) for each user and week (the Monday a session started
+    on), from the lists returned by find_sessions().
+    '''
+    session_users, starts, ends, pages = sessions
+    if _numpy() is not None:
+        days = numpy.asarray(starts, dtype=numpy.int64) // 86400
+        mondays = (days - (days + 3) % 7).tolist()
+    else:
+        mondays = [d - (d + 3) % 7 for d in [s // 86400 for s in starts]]
+    rows = _sum_runs([session_users, mondays], starts, ends, pages)
+    return [(r[0], week_start(r[1] * 86400)) + tuple(r[2:]) for r in rows]
+
+def _sum_runs(keys, starts, ends, pages):
+    '''
+    Returns (key values..., number of sessions, total seconds, total page
+    views) for each run of sessions with the same keys (a list of parallel
+    key lists). Sessions are sorted by user and time, so the sessions of a
+    user or a user's week are consecutive.
+    '''
+    if not starts:
+        return []
+    if _numpy() is not None:
+        keys = [numpy.asarray(k) for k in keys]
+        changed = numpy.zeros(len(starts) - 1, dtype=bool)
+        for k in keys:
+            changed |= k[1:] != k[:-1]
+        firsts = numpy.append(0, numpy.flatnonzero(changed) + 1)
+        counts = numpy.diff(numpy.append(firsts, len(starts)))
+        seconds = numpy.add.reduceat(numpy.asarray(ends, dtype=numpy.int64) - numpy.asarray(starts, dtype=numpy.int64), firsts)
+        page_totals = numpy.add.reduceat(numpy.asarray(pages, dtype=numpy.int64), firsts)
+        columns = [k[firsts].tolist() for k in keys] + [counts.tolist(), seconds.tolist(), page_totals.tolist()]
+        return zip(*columns)
+
+    rows = []
+    key_rows = zip(*keys)
+    first = 0
+    for i in range(1, len(starts) + 1):
+        if i == len(starts) or key_rows[i] != key_rows[first]:
+            seconds = sum([e - s for s, e in zip(starts[first:i], ends[first:i])])
+            rows.append(key_rows[first] + (i - first, seconds, sum(pages[first:i])))
+            first = i
+    return rows
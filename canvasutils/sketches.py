@@ -0,0 +1,182 @@
+'''
+Mergeable sketches for approximate counting in bounded memory.
+
+- HyperLogLog estimates the number of distinct values added to it (e.g. the
+  unique users who viewed a page) with 2^p one-byte registers. The relative
+  standard error is 1.04 / sqrt(2^p): about 1.6% for the default p=12 (4 KB).
+- SpaceSaving keeps the approximate top k items by count (e.g. the most
+  viewed URLs) with k counters. Every reported count is an overestimate by
+  at most its recorded error, and the error is at most n / k, where n is the
+  total count added. Any item whose true count is above n / k is reported.
+
+Sketches of the same kind (and size) can be merged, e.g. the sketches of
+several courses or of several runs over different date ranges, and saved as
+JSON with to_dict() / sketch_from_dict():
+
+    uniques = HyperLogLog()
+    for page_view in page_views:
+        uniques.add(page_view['links']['user'])
+    print uniques.count()
+
+Merging the HyperLogLog of two runs that overlap doesn't count a user twice,
+but merging SpaceSaving counts of overlapping runs counts views twice.
+'''
+import math
+import heapq
+import base64
+import struct
+import hashlib
+
+def _hash64(value):
+    '''Returns a 64-bit hash of a value (strings hash the same whether they're str or unicode).'''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+class HyperLogLog(object):
+    '''
+    Estimates the number of distinct values added, with a relative standard
+    error of 1.04 / sqrt(2^p).
+    '''
+    def __init__(self, p=12, registers=None):
+        if not 4 <= p <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18: %s" % p)
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else bytearray(self.m)
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value):
+        h = _hash64(value)
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        '''Returns the estimated number of distinct values.'''
+        m = self.m
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        if estimate <= 2.5 * m:
+            # Small range correction (linear counting)
+            zeros = self.registers.count('\x00')
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        '''Adds the values of another HyperLogLog with the same precision to this one.'''
+        if other.p != self.p:
+            raise ValueError("Can't merge HyperLogLogs of precision %s and %s" % (self.p, other.p))
+        self.registers = bytearray([max(a, b) for a, b in zip(self.registers, other.registers)])
+        return self
+
+    def to_dict(self):
+        return {'type': 'hyperloglog', 'p': self.p, 'registers': base64.b64encode(bytes(self.registers))}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(p=data['p'], registers=bytearray(base64.b64decode(data['registers'])))
+
+class SpaceSaving(object):
+    '''
+    Approximate top k items by count ("Space-Saving" algorithm of Metwally
+    et al.). When an untracked item arrives and all k counters are in use,
+    the item with the smallest count is replaced, and the new item starts
+    from that count, which is recorded as its error.
+    '''
+    def __init__(self, k=1000):
+        self.k = k
+        self.n = 0
+        self.counters = {} # item => [count, error]
+        self._heap = []    # (count, item), possibly stale (counts only grow)
+
+    def add(self, item, count=1):
+        self.n += count
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+            return
+        error = 0
+        if len(self.counters) >= self.k:
+            error = self._evict_min()
+        self.counters[item] = [error + count, error]
+        heapq.heappush(self._heap, (error + count, item))
+
+    def _evict_min(self):
+        '''Removes the item with the smallest count and returns its count.'''
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters.get(item)
+            if counter is None:
+                continue
+            if counter[0] == count:
+                del self.counters[item]
+                return count
+            heapq.heappush(self._heap, (counter[0], item))
+
+    @property
+    def min_count(self):
+        '''The count an untracked item may have had at most.'''
+        if len(self.counters) < self.k:
+            return 0
+        return min([c[0] for c in self.counters.itervalues()])
+
+    def top(self, n=None):
+        '''
+        Returns a list of (item, count, error) with the n items that have the
+        highest counts. The true count of each item is between count - error
+        and count.
+        '''
+        items = sorted(self.counters.iteritems(), key=lambda x: (-x[1][0], x[0]))
+        return [(item, c[0], c[1]) for item, c in items[:n]]
+
+    def merge(self, other):
+        '''
+        Adds the counts of another SpaceSaving to this one. Items tracked by
+        only one of them get the smallest count of the other (an item that
+        isn't tracked may have had that many), so counts stay overestimates
+        and the error stays below n / k.
+        '''
+        min_self, min_other = self.min_count, other.min_count
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count1, error1 = self.counters.get(item, (min_self, min_self))
+            count2, error2 = other.counters.get(item, (min_other, min_other))
+            merged[item] = [count1 + count2, error1 + error2]
+        k = max(self.k, other.k)
+        top = sorted(merged.iteritems(), key=lambda x: -x[1][0])[:k]
+        self.k = k
+        self.n += other.n
+        self.counters = dict(top)
+        self._heap = [(c[0], item) for item, c in top]
+        heapq.heapify(self._heap)
+        return self
+
+    def to_dict(self):
+        return {'type': 'space_saving', 'k': self.k, 'n': self.n, 'items': [list(x) for x in self.top()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(k=data['k'])
+        sketch.n = data['n']
+        sketch.counters = dict([(item, [count, error]) for item, count, error in data['items']])
+        sketch._heap = [(c[0], item) for item, c in sketch.counters.iteritems()]
+        heapq.heapify(sketch._heap)
+        return sketch
+
+SKETCH_TYPES = {
+    'hyperloglog': HyperLogLog,
+    'space_saving': SpaceSaving,
+}
+
+def sketch_from_dict(data):
+    '''Returns the sketch saved with to_dict().'''
+    return SKETCH_TYPES[data['type']].from_dict(data)
@@ -0,0 +1,254 @@
+'''
+Local SQLite store of the Canvas entities fetched by the scripts.
+
+Each script keeps its own JSON cache of API responses, so a new report has
+to parse those files or crawl the API again. The scripts can also upsert
+what they fetch into one database, with the join keys (course_id, user_id,
+assignment_id, created_at) as indexed columns, and reports can then join and
+filter the entities with SQL:
+
+    store = EntityStore('canvas.db')
+    store.upsert_courses(courses)
+    store.replace_assignments({1693: assignments})
+    for row in store.query('SELECT user_id, COUNT(*) FROM submissions WHERE course_id = ? GROUP BY user_id', (1693,)):
+        print row
+
+Courses, users, assignments and submissions keep the whole API object as
+JSON in a `data` column, next to the columns that are indexed. Page views
+only keep the fields the reports use, with created_at as a UTC timestamp
+("2016-02-01T13:45:10Z") so ranges of them can be compared as strings, and
+the course ID found in their URL.
+
+Lists that are fetched in full (the assignments of a course, the students of
+a course, the submissions of an assignment, a user's page views over a date
+range) replace what the store held for the same course, assignment or range,
+so objects deleted in Canvas don't linger.
+'''
+import re
+import json
+import sqlite3
+import logging
+
+from canvasutils.records import iter_fields, epoch_seconds, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY,
+    account_id INTEGER,
+    enrollment_term_id INTEGER,
+    name TEXT,
+    workflow_state TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS courses_account ON courses (account_id, enrollment_term_id);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    sortable_name TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS enrollments (
+    course_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (course_id, user_id, type)
+);
+CREATE INDEX IF NOT EXISTS enrollments_user ON enrollments (user_id, course_id);
+CREATE TABLE IF NOT EXISTS assignments (
+    id INTEGER PRIMARY KEY,
+    course_id INTEGER NOT NULL,
+    name TEXT,
+    due_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assignments_course ON assignments (course_id, due_at);
+CREATE INDEX IF NOT EXISTS assignments_due_at ON assignments (due_at);
+CREATE TABLE IF NOT EXISTS submissions (
+    assignment_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    course_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (assignment_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS submissions_user ON submissions (user_id, course_id);
+CREATE INDEX IF NOT EXISTS submissions_course ON submissions (course_id, assignment_id);
+CREATE TABLE IF NOT EXISTS page_views (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    course_id INTEGER,
+    url TEXT,
+    context_type TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS page_views_course ON page_views (course_id, user_id, created_at);
+CREATE INDEX IF NOT EXISTS page_views_user ON page_views (user_id, created_at);
+CREATE INDEX IF NOT EXISTS page_views_created_at ON page_views (created_at);
+'''
+
+_COURSE_URL = re.compile(r'^https?://[^/]+/(?:api/v1/)?courses/(\d+)(?:[/?#]|$)', re.IGNORECASE)
+
+def url_course_id(url):
+    '''Returns the course ID in a course URL like https://canvas.harvard.edu/courses/1693/assignments, or None.'''
+    match = url and _COURSE_URL.match(url)
+    return match and int(match.group(1)) or None
+
+def _utc_timestamp(created_at):
+    '''Returns an ISO 8601 timestamp in UTC, e.g. "2016-02-01T13:45:10Z".'''
+    if len(created_at) == 20 and created_at[19] == 'Z':
+        return created_at
+    return format_timestamp(epoch_seconds(created_at))
+
+def _json(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+class QueryRows(object):
+    '''
+    The rows of a query, which runs again each time it's iterated over (e.g.
+    to save the same rows as CSV and JSON without holding them in memory).
+    '''
+    def __init__(self, connection, sql, params=()):
+        self.connection = connection
+        self.sql = sql
+        self.params = params
+
+    def __iter__(self):
+        return self.connection.execute(self.sql, self.params)
+
+class EntityStore(object):
+    '''
+    Courses, users, enrollments, assignments, submissions and page views in
+    a SQLite database (see the module docstring).
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_ids (id PRIMARY KEY)')
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, sql, params=()):
+        '''Returns a cursor over the rows of a query.'''
+        return self.connection.execute(sql, params)
+
+    def upsert_courses(self, courses):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO courses VALUES (?, ?, ?, ?, ?, ?)', [
+                (int(c['id']), c.get('account_id'), c.get('enrollment_term_id'), c.get('name'), c.get('workflow_state'), _json(c))
+                for c in courses])
+        logger.debug("Stored %d courses in %s", len(courses), self.path)
+
+    def upsert_users(self, users):
+        '''Adds or updates users (e.g. students or profiles with "id" and "sortable_name").'''
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', [
+                (int(u['id']), u.get('sortable_name', u.get('name')), _json(u)) for u in users])
+
+    def replace_enrollments(self, user_ids_by_course, enrollment_type):
+        '''Sets the users with an enrollment type (e.g. StudentEnrollment) in each course.'''
+        with self.connection:
+            for course_id, user_ids in user_ids_by_course.iteritems():
+                self.connection.execute('DELETE FROM enrollments WHERE course_id = ? AND type = ?', (int(course_id), enrollment_type))
+                self.connection.executemany('INSERT OR IGNORE INTO enrollments VALUES (?, ?, ?)', [
+                    (int(course_id), int(user_id), enrollment_type) for user_id in user_ids])
+
+    def replace_assignments(self, assignments_by_course):
+        '''Sets the assignments of each course.'''
+        with self.connection:
+            for course_id, assignments in assignments_by_course.iteritems():
+                self.connection.execute('DELETE FROM assignments WHERE course_id = ?', (int(course_id),))
+                self.connection.executemany('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?)', [
+                    (int(a['id']), int(course_id), a.get('name'), a.get('due_at'), _json(a)) for a in assignments])
+        logger.debug("Stored the assignments of %d courses in %s", len(assignments_by_course), self.path)
+
+    def replace_submissions(self, course_id, submissions_by_assignment):
+        '''Sets the submissions of each assignment of a course.'''
+        with self.connection:
+            for assignment_id, submissions in submissions_by_assignment.iteritems():
+                self.connection.execute('DELETE FROM submissions WHERE assignment_id = ?', (int(assignment_id),))
+                self.connection.executemany('INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?)', [
+                    (int(assignment_id), int(s['user_id']), int(course_id), _json(s)) for s in submissions])
+
+    def replace_page_views(self, page_views_by_user, start_time, end_time):
+        '''
+        Sets the page views of each user from start_time (inclusive) to
+        end_time (exclusive), given as dates or UTC timestamps. The page
+        views of a user can be a list of dicts or a PageViewTable.
+
+        Returns the number of page views stored.
+        '''
+        num_page_views = 0
+        with self.connection:
+            for user_id, page_views in page_views_by_user.iteritems():
+                rows = []
+                for page_view_id, url, context_type, created_at in iter_fields(page_views, 'id', 'url', 'context_type', 'created_at'):
+                    rows.append((page_view_id, int(user_id), url_course_id(url), url, context_type, _utc_timestamp(created_at)))
+                self.connection.execute('DELETE FROM page_views WHERE user_id = ? AND created_at >= ? AND created_at < ?', (int(user_id), start_time, end_time))
+                self.connection.executemany('INSERT OR REPLACE INTO page_views VALUES (?, ?, ?, ?, ?, ?)', rows)
+                num_page_views += len(rows)
+        logger.info("Stored %d page views of %d users in %s" % (num_page_views, len(page_views_by_user), self.path))
+        return num_page_views
+
+    def select_ids(self, ids):
+        '''
+        Sets the IDs in the temporary table "selected_ids", for queries
+        restricted to many users or courses (more than fit in an IN list).
+        '''
+        with self.connection:
+            self.connection.execute('DELETE FROM selected_ids')
+            self.connection.executemany('INSERT OR IGNORE INTO selected_ids VALUES (?)', [(int(i),) for i in ids])
+
+    def page_view_counts_by_url(self, course_id, start_time, end_time):
+        '''
+        Returns a list of (url, page views) of the URLs in a course, counting
+        the page views of the selected users (see select_ids()) between
+        start_time (inclusive) and end_time (exclusive).
+        '''
+        return self.query(
+            'SELECT url, COUNT(*) FROM page_views '
+            'WHERE course_id = ? AND user_id IN (SELECT id FROM selected_ids) AND created_at >= ? AND created_at < ? '
+            'GROUP BY url ORDER BY url', (int(course_id), start_time, end_time)).fetchall()
+
+    def page_view_counts_by_user_url(self, course_id, start_time, end_time):
+        '''Like page_view_counts_by_url(), returning a list of (user ID, url, page views).'''
+        return self.query(
+            'SELECT user_id, url, COUNT(*) FROM page_views '
+            'WHERE course_id = ? AND user_id IN (SELECT id FROM selected_ids) AND created_at >= ? AND created_at < ? '
+            'GROUP BY user_id, url ORDER BY user_id, url', (int(course_id), start_time, end_time)).fetchall()
+
+    def page_view_rows(self, course_id, start_time, end_time):
+        '''
+        Returns the (user ID, url, created_at) of each page view counted by
+        page_view_counts_by_url(), sorted by user, time and URL, as
+        QueryRows.
+        '''
+        return QueryRows(self.connection,
+            'SELECT user_id, url, created_at FROM page_views '
+            'WHERE course_id = ? AND user_id IN (SELECT id FROM selected_ids) AND created_at >= ? AND created_at < ? '
+            'ORDER BY user_id, created_at, url', (int(course_id), start_time, end_time))
+
+    def student_courses(self, course_ids):
+        '''
+        Returns a tuple (student ID => list of course IDs, student ID =>
+        sortable name) of the students enrolled in the courses. Course IDs
+        are strings, like the keys of the find_due_dates data.
+        '''
+        self.select_ids(course_ids)
+        student_courses, student_names = {}, {}
+        cursor = self.query(
+            'SELECT e.user_id, e.course_id, u.sortable_name FROM enrollments e JOIN users u ON u.id = e.user_id '
+            "WHERE e.course_id IN (SELECT id FROM selected_ids) AND e.type = 'StudentEnrollment' "
+            'ORDER BY e.user_id, e.course_id')
+        for user_id, course_id, sortable_name in cursor:
+            student_courses.setdefault(user_id, []).append(str(course_id))
+            student_names[user_id] = sortable_name
+        return student_courses, student_names
+
+    def due_dates(self, course_ids):
+        '''Returns a list of (course ID, due_at) of the assignments with due dates in the courses.'''
+        self.select_ids(course_ids)
+        return self.query(
+            'SELECT course_id, due_at FROM assignments '
+            'WHERE course_id IN (SELECT id FROM selected_ids) AND due_at IS NOT NULL ORDER BY course_id, due_at').fetchall()
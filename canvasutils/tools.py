@@ -0,0 +1,46 @@
+'''
+Imports the canvas-utils scripts as modules, e.g. to run several reports in
+one process.
+
+Each tool directory has its own settings/secure.py, imported as
+"settings.secure", so the settings modules of the previously loaded tool are
+dropped before the next one is imported. A script keeps the settings values
+it imported, so tools with different settings can be loaded side by side:
+
+    rubricassessments = load_tool('rubricassessments')
+    data = rubricassessments.load_rubric_data(1693)
+'''
+import os
+import imp
+import sys
+import threading
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+TOOLS = ['canvas_page_views', 'assignmentviews', 'rubricassessments', 'find_due_dates']
+
+_loaded = {}
+_lock = threading.Lock()
+
+def load_tool(tool, script=None):
+    '''
+    Imports a script (by default the one named like the tool directory) and
+    returns the module. Later calls return the same module.
+    '''
+    script = script or tool
+    with _lock:
+        key = (tool, script)
+        if key not in _loaded:
+            tool_dir = os.path.join(REPO_DIR, tool)
+            for name in ('settings', 'settings.secure'):
+                sys.modules.pop(name, None)
+            sys.path.insert(0, tool_dir)
+            try:
+                name = script == tool and tool or '%s_%s' % (tool, script)
+                _loaded[key] = imp.load_source(name, os.path.join(tool_dir, script + '.py'))
+            finally:
+                sys.path.remove(tool_dir)
+        return _loaded[key]
+
+def is_loaded(tool, script=None):
+    return (tool, script or tool) in _loaded
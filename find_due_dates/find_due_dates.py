@@ -1,23 +1,26 @@
 from settings.secure import OAUTH_TOKEN, CANVAS_URL
-from canvas_sdk.methods import accounts, assignments
-from canvas_sdk.utils import get_all_list_data
-from canvas_sdk import RequestContext
 import logging
 import argparse
 import json
 import datetime
-import dateutil.parser
-import dateutil.tz
 import os.path
-import xlwt
+import sys
+import snapshots
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.imports import lazy_import
+from canvasutils.metrics import METRICS, instrument_request_context
+from canvasutils.logs import configure_logging, add_logging_arguments
+from canvasutils.store import EntityStore
+from canvasutils.pipeline import pipeline
+
+# Imported on first use (see canvasutils/imports.py)
+canvas_sdk = lazy_import('canvas_sdk')
+accounts = lazy_import('canvas_sdk.methods.accounts')
+dateutil = lazy_import('dateutil')
+xlwt = lazy_import('xlwt')
 
-logging.basicConfig() # you need to initialize logging, otherwise you will not see anything from requests
-logging.getLogger().setLevel(logging.DEBUG)
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.DEBUG)
-requests_log.propagate = True
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
 parser = argparse.ArgumentParser(description='Find due dates set during a given period.')
 parser.add_argument('account_id', help="Account ID used to find courses")
@@ -26,32 +29,77 @@ parser.add_argument('--reading_period_start', help="Start date for reading perio
 parser.add_argument('--reading_period_end', help="end date for reading period. Example: 2016-05-04")
 parser.add_argument('--exam_period_start', help="Start date for exam period. Example: 2016-05-05")
 parser.add_argument('--exam_period_end', help="end date for exam period. Example: 2016-05-14")
-args = parser.parse_args()
-logger.debug("Arguments: %s" % args)
+parser.add_argument('--workload', action='store_true', help="Fetch student enrollments and report students with too many deadlines on a day or in a week.")
+parser.add_argument('--max_per_day', type=int, default=3, help="Maximum number of deadlines a student may have on one day before being reported. Default: 3")
+parser.add_argument('--max_per_week', type=int, default=8, help="Maximum number of deadlines a student may have in one week before being reported. Default: 8")
+parser.add_argument('--snapshot', action='store_true', help="Take a new snapshot of the due dates, only downloading assignment pages that changed since the latest snapshot, and report the changes.")
+parser.add_argument('--concurrency', type=int, default=1, help="Number of courses whose assignments or enrollments are fetched at the same time. Defaults to 1.")
+parser.add_argument('--pipeline', action='store_true', help="Write the spreadsheet rows of each course as soon as its assignments are fetched, while the next courses download.")
+parser.add_argument('--metrics', metavar='PREFIX', help="Save request metrics as a JSON summary to PREFIX.json and a Prometheus textfile to PREFIX.prom.")
+parser.add_argument('--http_cache', metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags).")
+parser.add_argument('--entity_store', metavar='DB', help="Save the courses, assignments and student enrollments to the SQLite entity store DB (created if needed), shared with the other scripts, and join them for the workload report with queries of it.")
+add_logging_arguments(parser)
+parser.add_argument('--diff', nargs=2, metavar=('OLD_SNAPSHOT', 'NEW_SNAPSHOT'), help="Report the changes between two snapshot files and exit.")
+
+_TIME_ZONES = {}
+
+# Parsed arguments and entity store, set up in main(), and API clients, set
+# up by connect()
+args = None
+request_context = None
+client = None
+entity_store = None
+
+def utc_tz():
+    return _time_zone('UTC')
 
-UTC_TZ = dateutil.tz.gettz('UTC')
-EST_TZ = dateutil.tz.gettz('America/New_York')
+def est_tz():
+    return _time_zone('America/New_York')
 
-request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)
+def _time_zone(name):
+    if name not in _TIME_ZONES:
+        _TIME_ZONES[name] = dateutil.tz.gettz(name)
+    return _TIME_ZONES[name]
 
-def load_data():
+def connect():
+    '''
+    Sets up the API clients, unless they're already set (e.g. by the report
+    service). Runs that only read the cache don't call it, so they don't
+    import the Canvas SDK and requests.
+    '''
+    global request_context, client
+    if client is not None:
+        return
+    from canvasutils.client import CanvasClient, api_base_url
+    from canvasutils.httpcache import ConditionalCache, install_request_context
+    http_cache = args.http_cache and ConditionalCache(args.http_cache) or None
+    request_context = install_request_context(instrument_request_context(canvas_sdk.RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)), http_cache)
+    client = CanvasClient(api_base_url(CANVAS_URL), OAUTH_TOKEN, max_connections=args.concurrency, http_cache=http_cache)
+
+def load_data(spreadsheet=None):
+    '''
+    Loads the courses, assignments and (for the workload report) enrollments
+    from the cache, fetching what isn't cached. If a DueDateSpreadsheet is
+    given, the rows of each course are written to it as soon as its
+    assignments are fetched.
+    '''
     cache_file = 'cache.json'
     data = {}
     if os.path.isfile(cache_file):
-        logger.debug("Loading data from cache %s..." % cache_file)
+        logger.debug("Loading data from cache %s...", cache_file)
         with open(cache_file, 'r') as f:
             data = json.loads(f.read().strip())
     
+    for key in ('courses', 'assignments', 'enrollments'):
+        if key in data:
+            METRICS.cache_hit(cache_file)
+        elif key != 'enrollments' or args.workload:
+            METRICS.cache_miss(cache_file)
+
     # Fetch All Courses in Account
     if 'courses' not in data:
         logger.debug("Courses not in cache, so fetching from API")
-        extra_kwargs = {"include": "term"}
-        if args.enrollment_term_id:
-            extra_kwargs.update({'enrollment_term_id': args.enrollment_term_id})
-        result = get_all_list_data(request_context, accounts.list_active_courses_in_account, args.account_id, **extra_kwargs)
-        courses = sorted(result, key=lambda c: c['name'])
-        courses = [c for c in courses if c['workflow_state'] != 'unpublished']
-        data['courses'] = courses
+        data['courses'] = get_courses()
         with open(cache_file, 'w') as f:
             logger.debug("Writing courses to cache")
             f.write(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
@@ -60,120 +108,408 @@ def load_data():
     if 'assignments' not in data:
         logger.debug("Assignments not in cache, so fetching from API")
         data['assignments'] = {}
-        for course in data['courses']:
-            course_id = course['id']
-            result = get_all_list_data(request_context, assignments.list_assignments, course_id, include="")
-            data['assignments'][course_id] = result
+        connect()
+        fetch_assignments = lambda course: client.get_all('/courses/%s/assignments' % course['id'])
+        if spreadsheet is not None:
+            results = pipeline(fetch_assignments, data['courses'], concurrency=args.concurrency, ordered=True)
+        else:
+            results = client.map(fetch_assignments, data['courses'])
+        for course, result in results:
+            data['assignments'][str(course['id'])] = result
+            if spreadsheet is not None:
+                spreadsheet.write_course(course, result)
         with open(cache_file, 'w') as f:
             logger.debug("Writing assignments to cache")
             f.write(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
+
+    # Fetch Student Enrollments for Each Course (only needed for the workload report)
+    if args.workload and 'enrollments' not in data:
+        logger.debug("Enrollments not in cache, so fetching from API")
+        data['enrollments'] = get_enrollments(data['courses'])
+        with open(cache_file, 'w') as f:
+            logger.debug("Writing enrollments to cache")
+            f.write(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
     
     return data
 
-def save_spreadsheet(filename=None, data=None):
+def load_snapshot_data():
+    '''
+    Fetches the courses and takes a new snapshot of their due dates, only
+    downloading the assignment pages that changed since the latest snapshot.
+    Returns the data in the same shape as load_data(), plus the list of
+    changes since the latest snapshot.
+    '''
+    name = snapshots.snapshot_name(args.account_id, args.enrollment_term_id)
+    previous_file = snapshots.latest_snapshot_file(name)
+    previous = None
+    if previous_file is not None:
+        previous = snapshots.load_snapshot(previous_file)
+
+    connect()
+    data = {}
+    data['courses'] = get_courses()
+    snapshot = snapshots.take_snapshot(client, data['courses'], previous=previous)
+    snapshots.save_snapshot(snapshot, name)
+    data['assignments'] = snapshots.snapshot_assignments(snapshot)
+    data['changes'] = []
+    if previous is not None:
+        data['changes'] = snapshots.diff_snapshots(previous, snapshot)
+    if args.workload:
+        data['enrollments'] = get_enrollments(data['courses'])
+    return data
+
+def get_courses():
+    '''
+    Returns the published courses in the account (and term, if given) sorted by name.
+    '''
+    connect()
+    extra_kwargs = {"include": "term"}
+    if args.enrollment_term_id:
+        extra_kwargs.update({'enrollment_term_id': args.enrollment_term_id})
+    result = canvas_sdk.utils.get_all_list_data(request_context, accounts.list_active_courses_in_account, args.account_id, **extra_kwargs)
+    courses = sorted(result, key=lambda c: c['name'])
+    return [c for c in courses if c['workflow_state'] != 'unpublished']
+
+def get_enrollments(course_list):
+    '''
+    Returns a mapping of course ID => list of students enrolled in the course.
+    Course IDs are strings so the mapping looks the same before and after a
+    round trip through the JSON cache.
+    '''
+    connect()
+    url = '/courses/%s/users'
+    params = {'include[]': 'email', 'enrollment_type': 'student'}
+    fetch_students = lambda course: client.get_all(url % course['id'], params=params)
+    enrollments = {}
+    for course, result in client.map(fetch_students, course_list):
+        enrollments[str(course['id'])] = [{"id": u['id'], "sortable_name": u.get('sortable_name', u.get('name'))} for u in result]
+    return enrollments
+
+def update_entity_store(data):
+    '''
+    Saves the courses, their assignments and their student enrollments (if
+    fetched) to the entity store.
+    '''
+    course_ids = [str(course['id']) for course in data['courses']]
+    entity_store.upsert_courses(data['courses'])
+    entity_store.replace_assignments(dict([(course_id, data['assignments'][course_id]) for course_id in course_ids]))
+    if 'enrollments' in data:
+        enrollments = dict([(course_id, data['enrollments'][course_id]) for course_id in course_ids])
+        entity_store.upsert_users([student for students in enrollments.values() for student in students])
+        entity_store.replace_enrollments(dict([(course_id, [s['id'] for s in students]) for course_id, students in enrollments.iteritems()]), 'StudentEnrollment')
+    logger.info("Saved %d courses to %s" % (len(course_ids), entity_store.path))
+
+def build_due_date_index(data):
+    '''
+    Returns a mapping of course ID => {day => number of assignments due that day}.
+    Days are YYYY-MM-DD strings in the EST timezone.
+    '''
+    due_dates = []
+    for course in data['courses']:
+        course_id = str(course['id'])
+        for assignment in data['assignments'][course_id]:
+            due_dates.append((course_id, assignment['due_at']))
+    return index_due_dates(due_dates)
+
+def index_due_dates(due_dates):
+    '''
+    Returns the mapping of build_due_date_index() from a list of (course ID,
+    due_at) pairs.
+    '''
+    due_date_index = {}
+    for course_id, due_at in due_dates:
+        if due_at:
+            day = dateutil.parser.parse(due_at).replace(tzinfo=utc_tz()).astimezone(est_tz()).strftime('%Y-%m-%d')
+            day_counts = due_date_index.setdefault(str(course_id), {})
+            day_counts[day] = day_counts.get(day, 0) + 1
+    return due_date_index
+
+def build_student_index(enrollments):
+    '''
+    Returns a tuple (student ID => list of course IDs, student ID => sortable name)
+    built from the course enrollments. A student enrolled in several sections of
+    the same course is only counted once for that course.
+    '''
+    student_courses = {}
+    student_names = {}
+    for course_id, students in enrollments.iteritems():
+        for student in students:
+            course_ids = student_courses.setdefault(student['id'], [])
+            if course_id not in course_ids:
+                course_ids.append(course_id)
+            student_names[student['id']] = student['sortable_name']
+    return student_courses, student_names
+
+def find_workload_collisions(student_courses, due_date_index, max_per_day, max_per_week):
+    '''
+    Joins the student => courses index against the course => day index and
+    returns a tuple (collisions, histogram):
+
+    - collisions: a list of dicts describing each student day or week with
+      more deadlines than allowed.
+    - histogram: a mapping of day => {number of deadlines => number of students}.
+
+    Each student's load is the sum of the per-day counts of their courses, so
+    the work is proportional to the number of enrollments times the number of
+    distinct due days per course, rather than students times assignments.
+    '''
+    week_of = {}
+    collisions = []
+    histogram = {}
+    for student_id, course_ids in student_courses.iteritems():
+        day_load = {}
+        for course_id in course_ids:
+            for day, count in due_date_index.get(course_id, {}).iteritems():
+                day_load[day] = day_load.get(day, 0) + count
+
+        week_load = {}
+        for day, count in day_load.iteritems():
+            day_histogram = histogram.setdefault(day, {})
+            day_histogram[count] = day_histogram.get(count, 0) + 1
+            if day not in week_of:
+                year, week, weekday = datetime.datetime.strptime(day, '%Y-%m-%d').isocalendar()
+                week_of[day] = '%d-W%02d' % (year, week)
+            week_load[week_of[day]] = week_load.get(week_of[day], 0) + count
+
+        for day, count in day_load.iteritems():
+            if count > max_per_day:
+                collisions.append(_collision(student_id, course_ids, due_date_index, 'day', day, count, lambda d: d == day))
+        for week, count in week_load.iteritems():
+            if count > max_per_week:
+                collisions.append(_collision(student_id, course_ids, due_date_index, 'week', week, count, lambda d: week_of[d] == week))
+
+    collisions.sort(key=lambda c: (-c['count'], c['period'], c['student_id']))
+    return collisions, histogram
+
+def _collision(student_id, course_ids, due_date_index, period_type, period, count, in_period):
+    '''
+    Helper function that describes a single collision, including which of the
+    student's courses have deadlines in the period.
+    '''
+    period_courses = []
+    for course_id in course_ids:
+        if any(in_period(day) for day in due_date_index.get(course_id, {})):
+            period_courses.append(course_id)
+    return {
+        'student_id': student_id,
+        'period_type': period_type,
+        'period': period,
+        'count': count,
+        'course_ids': sorted(period_courses),
+    }
+
+def save_spreadsheet(filename=None, data=None, spreadsheet=None):
+    '''
+    Saves the due dates spreadsheet. The rows of the courses that weren't
+    written to the spreadsheet (a DueDateSpreadsheet) while they were
+    fetched are written first.
+    '''
     if filename is None:
         raise Exception("Filename is required")
     if data is None:
         raise Exception("Data is required")
 
-    courses = data['courses']
-    assignments = data['assignments']
+    # Worksheets 1 and 2
+    if spreadsheet is None:
+        spreadsheet = DueDateSpreadsheet()
+    spreadsheet.write_courses(data['courses'], data['assignments'])
+    wb = spreadsheet.wb
 
-    # Formats/Styles
-    bold_style = xlwt.easyxf('font: bold 1')
-    right_align = xlwt.easyxf("align: horiz right")
+    # Worksheets 3 and 4
+    if args.workload:
+        save_workload_sheets(wb, data)
+
+    # Worksheet 5
+    if 'changes' in data:
+        save_changes_sheet(wb, data['changes'])
+
+    # Save workbook
+    logger.info("Saving spreadsheet to %s" % filename)
+    wb.save(filename)
+
+class DueDateSpreadsheet(object):
+    '''
+    The due dates workbook, with the courses that have due dates during the
+    reading period (if the reading and exam periods are given) and the due
+    dates of all courses. The rows of each course can be written as soon as
+    its assignments are fetched, in the order of the courses.
+    '''
+    # Formats
     course_name_fmt = u'{name} ({id})'
     assignment_name_fmt = u'{name} ({id})'
     due_at_fmt = u'{due_at}'
-    
-    # Create workbook
-    wb = xlwt.Workbook(encoding="utf-8")
-    
-    # Worksheet 1   
-    if args.reading_period_start and args.reading_period_end:
-        reading_period_start = datetime.datetime.strptime(args.reading_period_start, "%Y-%m-%d").replace(tzinfo=EST_TZ)
-        reading_period_end = datetime.datetime.strptime(args.reading_period_end, "%Y-%m-%d").replace(tzinfo=EST_TZ)
-        reading_period_delta = reading_period_end - reading_period_start + datetime.timedelta(1)
-        reading_period_dates = [reading_period_start + datetime.timedelta(i) for i in range(reading_period_delta.days)]
-        reading_period_date_col = {d.strftime('%Y-%m-%d'):4+idx for idx, d in enumerate(reading_period_dates)}
-        reading_period_str_range = '%s - %s' % (reading_period_start.strftime('%m/%d/%Y'), reading_period_end.strftime('%m/%d/%Y'))
-
-        exam_period_start = datetime.datetime.strptime(args.exam_period_start, "%Y-%m-%d").replace(tzinfo=EST_TZ)
-        exam_period_end = datetime.datetime.strptime(args.exam_period_end, "%Y-%m-%d").replace(tzinfo=EST_TZ)
-        exam_period_delta = exam_period_end - exam_period_start + datetime.timedelta(1)
-        exam_period_dates = [exam_period_start + datetime.timedelta(i) for i in range(exam_period_delta.days)]
-        exam_period_date_col = {d.strftime('%Y-%m-%d'):max(reading_period_date_col.values())+1+idx for idx, d in enumerate(exam_period_dates)}
-        exam_period_str_range = '%s - %s' % (exam_period_start.strftime('%m/%d/%Y'), exam_period_end.strftime('%m/%d/%Y'))
-
-        ws = wb.add_sheet('Reading Period Sheet', cell_overwrite_ok=True)
-        ws.write(0,0, u'Courses with assignment due dates during Reading Period: {reading_period}'.format(reading_period=reading_period_str_range).encode('utf-8'), bold_style)
+
+    def __init__(self):
+        # Styles
+        self.bold_style = bold_style = xlwt.easyxf('font: bold 1')
+        self.right_align = xlwt.easyxf("align: horiz right")
+
+        # Create workbook
+        self.wb = wb = xlwt.Workbook(encoding="utf-8")
+        self.written = set()
+
+        # Worksheet 1   
+        self.reading_ws = None
+        if args.reading_period_start and args.reading_period_end:
+            self.reading_period_start = reading_period_start = datetime.datetime.strptime(args.reading_period_start, "%Y-%m-%d").replace(tzinfo=est_tz())
+            self.reading_period_end = reading_period_end = datetime.datetime.strptime(args.reading_period_end, "%Y-%m-%d").replace(tzinfo=est_tz())
+            reading_period_delta = reading_period_end - reading_period_start + datetime.timedelta(1)
+            reading_period_dates = [reading_period_start + datetime.timedelta(i) for i in range(reading_period_delta.days)]
+            self.reading_period_date_col = reading_period_date_col = {d.strftime('%Y-%m-%d'):4+idx for idx, d in enumerate(reading_period_dates)}
+            reading_period_str_range = '%s - %s' % (reading_period_start.strftime('%m/%d/%Y'), reading_period_end.strftime('%m/%d/%Y'))
+
+            self.exam_period_start = exam_period_start = datetime.datetime.strptime(args.exam_period_start, "%Y-%m-%d").replace(tzinfo=est_tz())
+            self.exam_period_end = exam_period_end = datetime.datetime.strptime(args.exam_period_end, "%Y-%m-%d").replace(tzinfo=est_tz())
+            exam_period_delta = exam_period_end - exam_period_start + datetime.timedelta(1)
+            exam_period_dates = [exam_period_start + datetime.timedelta(i) for i in range(exam_period_delta.days)]
+            self.exam_period_date_col = exam_period_date_col = {d.strftime('%Y-%m-%d'):max(reading_period_date_col.values())+1+idx for idx, d in enumerate(exam_period_dates)}
+            exam_period_str_range = '%s - %s' % (exam_period_start.strftime('%m/%d/%Y'), exam_period_end.strftime('%m/%d/%Y'))
+
+            self.reading_ws = ws = wb.add_sheet('Reading Period Sheet', cell_overwrite_ok=True)
+            ws.write(0,0, u'Courses with assignment due dates during Reading Period: {reading_period}'.format(reading_period=reading_period_str_range).encode('utf-8'), bold_style)
+            ws.write(1,0, u'Term'.encode('utf-8'), bold_style)
+            ws.write(1,1, u'Course'.encode('utf-8'), bold_style)
+            ws.write(1,2, u'Due Dates during Reading Period?'.encode('utf-8'), bold_style)
+            ws.write(1,3, u'Due Dates also during Exam Period?'.encode('utf-8'), bold_style)
+            for (period_dates, period_date_col) in [(reading_period_dates,reading_period_date_col), (exam_period_dates,exam_period_date_col)]:
+                for d in period_dates:
+                    ws.write(1, period_date_col[d.strftime('%Y-%m-%d')], d.strftime('%a %b %d, %Y'), bold_style)
+            self.reading_row = 2
+
+        # Worksheet 2
+        self.courses_ws = ws = wb.add_sheet('Courses Sheet', cell_overwrite_ok=True)
+        ws.write(0,0, u'All course assignment due dates'.encode('utf-8'), bold_style)
         ws.write(1,0, u'Term'.encode('utf-8'), bold_style)
         ws.write(1,1, u'Course'.encode('utf-8'), bold_style)
-        ws.write(1,2, u'Due Dates during Reading Period?'.encode('utf-8'), bold_style)
-        ws.write(1,3, u'Due Dates also during Exam Period?'.encode('utf-8'), bold_style)
-        for (period_dates, period_date_col) in [(reading_period_dates,reading_period_date_col), (exam_period_dates,exam_period_date_col)]:
-            for d in period_dates:
-                ws.write(1, period_date_col[d.strftime('%Y-%m-%d')], d.strftime('%a %b %d, %Y'), bold_style)
+        ws.write(1,2, u'Assignment'.encode('utf-8'), bold_style)
+        ws.write(1,3, u'Due Date (UTC)'.encode('utf-8'), bold_style)
+        ws.write(1,4, u'Due Date (EST)'.encode('utf-8'), bold_style)
+        self.courses_row = 2
 
-        row = 2
-        for course in courses:
-            course_id = str(course['id'])
-            course_assignments = assignments[course_id]
-            has_reading_period_due_date = False
-            has_exam_period_due_date = False
-            reading_dates = []
-            exam_dates = []
-            for assignment in course_assignments:
-                due_at = assignment['due_at']
-                if due_at:
-                    due_date = dateutil.parser.parse(due_at).replace(tzinfo=UTC_TZ).astimezone(EST_TZ)
-                    if (due_date >= reading_period_start and due_date <= reading_period_end):
-                        has_reading_period_due_date = True
-                        reading_dates.append(due_date)
-                    elif (due_date >= exam_period_start and due_date <= exam_period_end):
-                        has_exam_period_due_date = True
-                        exam_dates.append(due_date)
-            if has_reading_period_due_date:
-                ws.write(row, 0, course['term']['name'])
-                ws.write(row, 1, course_name_fmt.format(**course))
-                ws.write(row, 2, 'YES')
-                ws.write(row, 3, 'YES' if has_exam_period_due_date else 'NO')
-                for d in reading_dates:
-                    ws.write(row, reading_period_date_col[d.strftime('%Y-%m-%d')], 'X')
-                for d in exam_dates:
-                    ws.write(row, exam_period_date_col[d.strftime('%Y-%m-%d')], 'X')
-                row += 1
-
-    # Worksheet 2
-    ws = wb.add_sheet('Courses Sheet', cell_overwrite_ok=True)
-    ws.write(0,0, u'All course assignment due dates'.encode('utf-8'), bold_style)
-    ws.write(1,0, u'Term'.encode('utf-8'), bold_style)
-    ws.write(1,1, u'Course'.encode('utf-8'), bold_style)
-    ws.write(1,2, u'Assignment'.encode('utf-8'), bold_style)
-    ws.write(1,3, u'Due Date (UTC)'.encode('utf-8'), bold_style)
-    ws.write(1,4, u'Due Date (EST)'.encode('utf-8'), bold_style)
-    
-    # Write data to worksheet
-    row = 2
-    for course_idx, course in enumerate(courses):
-        course_id = str(course['id'])
-        course_assignments = assignments[course_id]
+    def write_course(self, course, course_assignments):
+        '''Writes the rows of a course (after the rows of the courses written before it).'''
+        self.written.add(str(course['id']))
+        if self.reading_ws is not None:
+            self._write_reading_period_row(course, course_assignments)
+
+        # Write data to worksheet
+        ws = self.courses_ws
+        row = self.courses_row
         for assignment_idx, assignment in enumerate(course_assignments):
             ws.write(row, 0, course['term']['name'])
-            ws.write(row, 1, course_name_fmt.format(**course))
-            ws.write(row, 2, assignment_name_fmt.format(**assignment))
-            ws.write(row, 3, due_at_fmt.format(**assignment))
+            ws.write(row, 1, self.course_name_fmt.format(**course))
+            ws.write(row, 2, self.assignment_name_fmt.format(**assignment))
+            ws.write(row, 3, self.due_at_fmt.format(**assignment))
             due_date = assignment['due_at']
             if due_date:
-                due_date = dateutil.parser.parse(due_date).astimezone(EST_TZ).strftime('%a, %b %d at %I:%M%p')
+                due_date = dateutil.parser.parse(due_date).astimezone(est_tz()).strftime('%a, %b %d at %I:%M%p')
             else:
                 due_date = 'None'
             ws.write(row, 4, due_date)
             row += 1
+        self.courses_row = row
 
-    # Save workbook
-    logger.info("Saving spreadsheet to %s" % filename)
-    wb.save(filename)
+    def write_courses(self, courses, assignments):
+        '''Writes the rows of the courses that haven't been written yet.'''
+        for course in courses:
+            course_id = str(course['id'])
+            if course_id not in self.written:
+                self.write_course(course, assignments[course_id])
+
+    def _write_reading_period_row(self, course, course_assignments):
+        ws = self.reading_ws
+        has_reading_period_due_date = False
+        has_exam_period_due_date = False
+        reading_dates = []
+        exam_dates = []
+        for assignment in course_assignments:
+            due_at = assignment['due_at']
+            if due_at:
+                due_date = dateutil.parser.parse(due_at).replace(tzinfo=utc_tz()).astimezone(est_tz())
+                if (due_date >= self.reading_period_start and due_date <= self.reading_period_end):
+                    has_reading_period_due_date = True
+                    reading_dates.append(due_date)
+                elif (due_date >= self.exam_period_start and due_date <= self.exam_period_end):
+                    has_exam_period_due_date = True
+                    exam_dates.append(due_date)
+        if has_reading_period_due_date:
+            row = self.reading_row
+            ws.write(row, 0, course['term']['name'])
+            ws.write(row, 1, self.course_name_fmt.format(**course))
+            ws.write(row, 2, 'YES')
+            ws.write(row, 3, 'YES' if has_exam_period_due_date else 'NO')
+            for d in reading_dates:
+                ws.write(row, self.reading_period_date_col[d.strftime('%Y-%m-%d')], 'X')
+            for d in exam_dates:
+                ws.write(row, self.exam_period_date_col[d.strftime('%Y-%m-%d')], 'X')
+            self.reading_row = row + 1
+
+def save_workload_sheets(wb, data):
+    '''
+    Adds the student workload collisions and the day-by-day histogram of
+    deadlines per student to the workbook.
+    '''
+    bold_style = xlwt.easyxf('font: bold 1')
+    course_name_of = dict([(str(c['id']), u'{name} ({id})'.format(**c)) for c in data['courses']])
+    if entity_store is not None:
+        # Join the enrollments and due dates of the courses in the store
+        course_ids = [course['id'] for course in data['courses']]
+        student_courses, student_names = entity_store.student_courses(course_ids)
+        due_date_index = index_due_dates(entity_store.due_dates(course_ids))
+    else:
+        student_courses, student_names = build_student_index(data['enrollments'])
+        due_date_index = build_due_date_index(data)
+    collisions, histogram = find_workload_collisions(student_courses, due_date_index, args.max_per_day, args.max_per_week)
+    logger.info("Found %d workload collisions for %d students" % (len(collisions), len(student_courses)))
+
+    ws = wb.add_sheet('Workload Sheet', cell_overwrite_ok=True)
+    ws.write(0,0, u'Students with more than {max_per_day} deadlines in a day or {max_per_week} deadlines in a week'.format(max_per_day=args.max_per_day, max_per_week=args.max_per_week).encode('utf-8'), bold_style)
+    for col, label in enumerate([u'Student', u'Period', u'Day/Week', u'Deadlines', u'Courses']):
+        ws.write(1, col, label.encode('utf-8'), bold_style)
+    row = 2
+    for collision in collisions:
+        ws.write(row, 0, u'{name} ({id})'.format(name=student_names[collision['student_id']], id=collision['student_id']))
+        ws.write(row, 1, collision['period_type'])
+        ws.write(row, 2, collision['period'])
+        ws.write(row, 3, collision['count'])
+        ws.write(row, 4, u', '.join([course_name_of.get(course_id, course_id) for course_id in collision['course_ids']]))
+        row += 1
+
+    ws = wb.add_sheet('Workload Histogram Sheet', cell_overwrite_ok=True)
+    max_load = max([max(h.keys()) for h in histogram.values()] or [0])
+    ws.write(0,0, u'Number of students by number of deadlines per day'.encode('utf-8'), bold_style)
+    ws.write(1,0, u'Day'.encode('utf-8'), bold_style)
+    ws.write(1,1, u'Students over daily limit'.encode('utf-8'), bold_style)
+    for load in range(1, max_load + 1):
+        ws.write(1, 1 + load, u'{load} deadline(s)'.format(load=load), bold_style)
+    for row, day in enumerate(sorted(histogram.keys()), 2):
+        day_histogram = histogram[day]
+        ws.write(row, 0, day)
+        ws.write(row, 1, sum([n for load, n in day_histogram.iteritems() if load > args.max_per_day]))
+        for load, num_students in day_histogram.iteritems():
+            ws.write(row, 1 + load, num_students)
+
+def save_changes_sheet(wb, changes):
+    '''
+    Adds the deadlines that were added, moved or removed since the previous
+    snapshot to the workbook.
+    '''
+    bold_style = xlwt.easyxf('font: bold 1')
+    ws = wb.add_sheet('Changes Sheet', cell_overwrite_ok=True)
+    ws.write(0,0, u'Due dates changed since the previous snapshot'.encode('utf-8'), bold_style)
+    for col, label in enumerate([u'Change', u'Course', u'Assignment', u'Old Due Date (UTC)', u'New Due Date (UTC)']):
+        ws.write(1, col, label.encode('utf-8'), bold_style)
+    for row, change in enumerate(changes, 2):
+        ws.write(row, 0, change['change'])
+        ws.write(row, 1, u'{course_name} ({course_id})'.format(**change))
+        ws.write(row, 2, u'{assignment_name} ({assignment_id})'.format(**change))
+        ws.write(row, 3, change['old_due_at'] or '')
+        ws.write(row, 4, change['new_due_at'] or '')
+
+def print_changes(changes):
+    print "Due date changes: %d" % len(changes)
+    for change in changes:
+        print "\t%(change)s: %(course_name)s (%(course_id)s) -- %(assignment_name)s (%(assignment_id)s): %(old_due_at)s -> %(new_due_at)s" % change
 
 def print_statistics(data):
     # Output data
@@ -186,7 +522,36 @@ def print_statistics(data):
         for assignment in sorted(data['assignments'][course_id], key=lambda a: a['due_at'], reverse=True):
             print "\tDue: %s -- %s" % (assignment['due_at'], assignment['name'])
         
-data = load_data()
-#print_statistics(data)
-save_spreadsheet(filename='duedates.xls', data=data)
-exit(0)
+def main():
+    global args, entity_store
+    args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
+    logger.debug("Arguments: %s", args)
+
+    if args.diff:
+        print_changes(snapshots.diff_snapshots(snapshots.load_snapshot(args.diff[0]), snapshots.load_snapshot(args.diff[1])))
+        exit(0)
+
+    spreadsheet = None
+    if args.snapshot:
+        data = load_snapshot_data()
+        print_changes(data['changes'])
+    else:
+        if args.pipeline:
+            spreadsheet = DueDateSpreadsheet()
+        data = load_data(spreadsheet=spreadsheet)
+    if args.entity_store:
+        entity_store = EntityStore(args.entity_store)
+        update_entity_store(data)
+    #print_statistics(data)
+    save_spreadsheet(filename='duedates.xls', data=data, spreadsheet=spreadsheet)
+    if entity_store is not None:
+        entity_store.close()
+    METRICS.log_summary()
+    if args.metrics:
+        METRICS.save(args.metrics, labels={'script': 'find_due_dates', 'account_id': args.account_id})
+    exit(0)
+
+if __name__ == '__main__':
+    main()
+
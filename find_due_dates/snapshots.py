@@ -0,0 +1,206 @@
+'''
+Content-hashed snapshots of course assignment due dates.
+
+A snapshot records, for each course, the pages of the assignments list as
+they were returned by the API (URL, ETag and the due date records on the
+page) plus a hash of all the due date records in the course. Taking a new
+snapshot sends conditional requests using the ETags from the previous
+snapshot, so pages that have not changed are answered with a 304 and are
+copied over instead of downloaded again. Comparing two snapshots only looks
+inside the courses whose hashes differ.
+'''
+import os
+import json
+import glob
+import hashlib
+import logging
+import datetime
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = 'snapshots'
+SNAPSHOT_FILE = 'duedates-{name}-{timestamp}.json'
+
+def snapshot_name(account_id, enrollment_term_id=None):
+    '''
+    Returns the name used to group snapshots of the same account and term.
+    '''
+    if enrollment_term_id:
+        return '%s-term%s' % (account_id, enrollment_term_id)
+    return '%s' % account_id
+
+def latest_snapshot_file(name, snapshot_dir=SNAPSHOT_DIR):
+    '''
+    Returns the path to the most recent snapshot with the given name, or None.
+    '''
+    files = sorted(glob.glob(os.path.join(snapshot_dir, SNAPSHOT_FILE.format(name=name, timestamp='*'))))
+    if files:
+        return files[-1]
+    return None
+
+def load_snapshot(filename):
+    '''
+    Loads a snapshot from a file.
+    '''
+    logger.info("Loading snapshot %s" % filename)
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save_snapshot(snapshot, name, snapshot_dir=SNAPSHOT_DIR):
+    '''
+    Saves a snapshot to a new timestamped file and returns its path.
+    '''
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    timestamp = snapshot['created_at'].replace('-', '').replace(':', '').replace('T', '')[:14]
+    filename = os.path.join(snapshot_dir, SNAPSHOT_FILE.format(name=name, timestamp=timestamp))
+    logger.info("Saving snapshot %s" % filename)
+    with open(filename, 'w') as f:
+        json.dump(snapshot, f, sort_keys=True, indent=2, separators=(',', ': '))
+    return filename
+
+def hash_records(records):
+    '''
+    Returns a hash of the due date records that does not depend on the order
+    in which the API returned them.
+    '''
+    canonical = json.dumps(sorted(records, key=lambda r: r['id']), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def course_records(entry):
+    '''
+    Returns all the due date records of a course snapshot entry.
+    '''
+    records = []
+    for page in entry['pages']:
+        records.extend(page['records'])
+    return records
+
+def fetch_course_due_dates(client, course, previous=None, per_page=100):
+    '''
+    Fetches the due dates of a course and returns a snapshot entry for it.
+
+    Each page is requested with the ETag of the same page in the previous
+    snapshot entry (if any). A 304 response reuses the stored page.
+
+    Returns a tuple (entry, pages_downloaded, pages_reused).
+    '''
+    url = client.url('/courses/%s/assignments?per_page=%s' % (course['id'], per_page))
+    previous_pages = {}
+    if previous is not None:
+        previous_pages = dict([(p['url'], p) for p in previous['pages']])
+
+    pages = []
+    pages_downloaded, pages_reused = 0, 0
+    while url:
+        headers = {}
+        previous_page = previous_pages.get(url)
+        if previous_page is not None and previous_page.get('etag'):
+            headers['If-None-Match'] = previous_page['etag']
+        r = client.request(url, headers=headers)
+        if r.status_code == 304 and previous_page is not None:
+            page = previous_page
+            pages_reused += 1
+            client.metrics.cache_hit('snapshot_etag')
+        else:
+            r.raise_for_status()
+            page = {
+                'url': url,
+                'etag': r.headers.get('ETag'),
+                'next': r.links.get('next', {}).get('url'),
+                'records': [{'id': a['id'], 'name': a['name'], 'due_at': a['due_at']} for a in r.json()],
+            }
+            pages_downloaded += 1
+            if previous_page is not None:
+                client.metrics.cache_miss('snapshot_etag')
+        pages.append(page)
+        url = page['next']
+
+    entry = {
+        'id': course['id'],
+        'name': course['name'],
+        'term': course.get('term', {}).get('name'),
+        'pages': pages,
+    }
+    entry['hash'] = hash_records(course_records(entry))
+    return entry, pages_downloaded, pages_reused
+
+def take_snapshot(client, courses, previous=None):
+    '''
+    Takes a snapshot of the due dates of the given courses, reusing unchanged
+    pages from the previous snapshot.
+    '''
+    snapshot = {
+        'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'courses': {},
+    }
+    previous_courses = {}
+    if previous is not None:
+        previous_courses = previous['courses']
+
+    fetch_due_dates = lambda course: fetch_course_due_dates(client, course, previous=previous_courses.get(str(course['id'])))
+    total_downloaded, total_reused, changed = 0, 0, 0
+    for course, (entry, pages_downloaded, pages_reused) in client.map(fetch_due_dates, courses):
+        course_id = str(course['id'])
+        previous_entry = previous_courses.get(course_id)
+        snapshot['courses'][course_id] = entry
+        total_downloaded += pages_downloaded
+        total_reused += pages_reused
+        if previous_entry is None or previous_entry['hash'] != entry['hash']:
+            changed += 1
+
+    logger.info("Snapshot of %d courses: %d changed, %d pages downloaded, %d pages not modified" % (len(courses), changed, total_downloaded, total_reused))
+    return snapshot
+
+def snapshot_assignments(snapshot):
+    '''
+    Returns a mapping of course ID => list of assignments in the same shape
+    as the cached 'assignments' data (limited to id, name and due_at).
+    '''
+    return dict([(course_id, course_records(entry)) for course_id, entry in snapshot['courses'].iteritems()])
+
+def diff_snapshots(old, new):
+    '''
+    Compares two snapshots and returns a list of changed deadlines. Each change
+    is a dict with the keys: change ('added', 'moved' or 'removed'), course_id,
+    course_name, assignment_id, assignment_name, old_due_at and new_due_at.
+
+    Courses with the same hash in both snapshots are skipped.
+    '''
+    changes = []
+    course_ids = set(old['courses'].keys()) | set(new['courses'].keys())
+    for course_id in sorted(course_ids):
+        old_entry = old['courses'].get(course_id)
+        new_entry = new['courses'].get(course_id)
+        if old_entry is not None and new_entry is not None and old_entry['hash'] == new_entry['hash']:
+            continue
+
+        old_due = {}
+        if old_entry is not None:
+            old_due = dict([(r['id'], r) for r in course_records(old_entry) if r['due_at']])
+        new_due = {}
+        if new_entry is not None:
+            new_due = dict([(r['id'], r) for r in course_records(new_entry) if r['due_at']])
+        course_name = (new_entry or old_entry)['name']
+
+        for assignment_id in sorted(set(old_due.keys()) | set(new_due.keys())):
+            old_record = old_due.get(assignment_id)
+            new_record = new_due.get(assignment_id)
+            if old_record is None:
+                change = 'added'
+            elif new_record is None:
+                change = 'removed'
+            elif old_record['due_at'] != new_record['due_at']:
+                change = 'moved'
+            else:
+                continue
+            changes.append({
+                'change': change,
+                'course_id': course_id,
+                'course_name': course_name,
+                'assignment_id': assignment_id,
+                'assignment_name': (new_record or old_record)['name'],
+                'old_due_at': old_record and old_record['due_at'],
+                'new_due_at': new_record and new_record['due_at'],
+            })
+    return changes
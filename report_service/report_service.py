@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+'''
+Local report service that keeps data warm between reports.
+
+Running a tool from the command line imports canvas_sdk and xlwt, reloads
+its JSON cache and rebuilds its lookups every time. The service imports each
+tool once and keeps what the reports load in memory:
+
+- page_views: the canvas_page_views cache (reloaded only if the file
+  changes) and its HTTP connection pool
+- rubric: each course's assignment, submission and student data, and the
+  results grouped by student
+- due_dates: each account's courses, assignments and enrollments
+
+API requests of the rubric and due date reports share one connection pool.
+Reports run one at a time (the tools keep their state in module globals),
+and write their files to the working directory.
+
+Usage:
+
+    $ ./report_service.py --port 8080 --workdir reports
+    $ curl -X POST -d '{"args": ["1693", "--start_time", "2016-01-25"]}' http://localhost:8080/reports/page_views
+    $ curl -X POST -d '{"args": ["1693"]}' http://localhost:8080/reports/rubric
+    $ curl -X POST -d '{"args": ["1", "--enrollment_term_id", "24"]}' http://localhost:8080/reports/due_dates
+    $ curl http://localhost:8080/status
+
+The arguments of each report:
+
+- page_views: the command line arguments of canvas_page_views.py
+- rubric: the course ID, and --refresh to fetch the course's data again
+  (the other options of rubricassessments.py aren't supported)
+- due_dates: the command line arguments of find_due_dates.py (except --diff
+  and --entity_store), and --refresh to fetch the account's data again. The
+  data is also loaded again when cache.json changes.
+
+The service only listens on localhost by default and has no
+authentication, so don't expose it.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+import traceback
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.tools import load_tool, is_loaded
+from canvasutils.client import CanvasClient, api_base_url
+from canvasutils.metrics import METRICS, instrument_request_context
+from canvasutils.logs import configure_logging, add_logging_arguments
+from canvasutils.httpcache import ConditionalCache, install_request_context
+
+logger = logging.getLogger(__name__)
+
+# Report name => tool directory
+REPORT_TOOLS = {
+    'page_views': 'canvas_page_views',
+    'rubric': 'rubricassessments',
+    'due_dates': 'find_due_dates',
+}
+
+class ReportError(Exception):
+    '''Raised for report requests with invalid arguments.'''
+    pass
+
+class ReportService(object):
+    '''
+    Runs reports in this process, keeping the data they load in memory
+    between reports.
+    '''
+    def __init__(self, workdir, concurrency=4, http_cache=None):
+        self.workdir = os.path.abspath(workdir)
+        self.concurrency = concurrency
+        self.http_cache = http_cache and ConditionalCache(http_cache) or None
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.clients = {}       # (CANVAS_URL, OAUTH_TOKEN) => (client, request context)
+        self.rubric_data = {}   # course ID => (data, student results)
+        self.due_date_data = {} # (account ID, term ID, workload) => (data, cache.json modification time)
+        self.history = []
+
+    def api(self, module):
+        '''Returns the shared client and canvas_sdk request context for the settings of a tool.'''
+        key = (module.CANVAS_URL, module.OAUTH_TOKEN)
+        if key not in self.clients:
+            client = CanvasClient(api_base_url(module.CANVAS_URL), module.OAUTH_TOKEN, max_connections=self.concurrency, http_cache=self.http_cache)
+            request_context = module.canvas_sdk.RequestContext(module.OAUTH_TOKEN, module.CANVAS_URL, per_page=100)
+            request_context = install_request_context(instrument_request_context(request_context), self.http_cache)
+            self.clients[key] = (client, request_context)
+        return self.clients[key]
+
+    def run(self, report, argv):
+        '''
+        Runs a report with a list of command line arguments, and returns a
+        dict describing the result, including the files written.
+        '''
+        if report not in REPORT_TOOLS:
+            raise ReportError("Unknown report %s (expected one of %s)" % (report, ', '.join(sorted(REPORT_TOOLS))))
+        with self.lock:
+            before = self._files()
+            started_at = time.time()
+            try:
+                getattr(self, 'run_' + report)(argv)
+            except SystemExit as e:
+                # argparse exits on invalid arguments
+                if e.code:
+                    raise ReportError("Invalid arguments for %s: %s" % (report, ' '.join(argv)))
+            seconds = time.time() - started_at
+            after = self._files()
+        result = {
+            'report': report,
+            'args': argv,
+            'seconds': round(seconds, 3),
+            'files': sorted([name for name, mtime in after.iteritems() if before.get(name) != mtime]),
+        }
+        self.history.append(dict(result, finished_at=time.time()))
+        del self.history[:-100]
+        logger.info("Report %s %s finished in %.1fs" % (report, ' '.join(argv), seconds))
+        return result
+
+    def _files(self):
+        '''Returns the modification times of the files in the working directory.'''
+        files = {}
+        for name in os.listdir(self.workdir):
+            path = os.path.join(self.workdir, name)
+            if os.path.isfile(path):
+                files[name] = os.path.getmtime(path)
+        return files
+
+    def _mtime(self, path):
+        '''Returns the modification time of a file, or None if it doesn't exist.'''
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def run_page_views(self, argv):
+        module = load_tool('canvas_page_views')
+        module.load_settings(argv)
+        module.run()
+
+    def run_rubric(self, argv):
+        module = load_tool('rubricassessments')
+        parser = argparse.ArgumentParser(prog='rubric', description='Rubric assessments report.')
+        parser.add_argument('course_id', type=int, help="The canvas course ID")
+        parser.add_argument('--refresh', action='store_true', help="Fetch the data from the API again")
+        args = parser.parse_args(argv)
+        course_id = args.course_id
+        cache_json_filename = os.path.join(self.workdir, "%s.json" % course_id)
+
+        if args.refresh:
+            self.rubric_data.pop(course_id, None)
+        if course_id in self.rubric_data:
+            METRICS.cache_hit('rubric_memory')
+        else:
+            METRICS.cache_miss('rubric_memory')
+            if os.path.exists(cache_json_filename) and not args.refresh:
+                with open(cache_json_filename, 'r') as f:
+                    data = json.load(f)
+            else:
+                client, request_context = self.api(module)
+                data = module.load_rubric_data(course_id, client=client, request_context=request_context)
+                module.save_json(filename=cache_json_filename, data=data)
+            self.rubric_data[course_id] = (data, module.transform_rubric_data(data))
+
+        data, student_results = self.rubric_data[course_id]
+        module.save_json(filename=os.path.join(self.workdir, "%s-transformed.json" % course_id), data=student_results)
+        module.save_rubric_spreadsheet(filename=os.path.join(self.workdir, "%s.xls" % course_id), student_results=student_results)
+
+    def run_due_dates(self, argv):
+        module = load_tool('find_due_dates')
+        parser = argparse.ArgumentParser(prog='due_dates', description='Due dates report.', parents=[module.parser], add_help=False)
+        parser.add_argument('--refresh', action='store_true', help="Fetch the data from the API again")
+        args = parser.parse_args(argv)
+        if args.diff:
+            raise ReportError("--diff isn't supported by the service")
+        if args.entity_store:
+            raise ReportError("--entity_store isn't supported by the service")
+        module.args = args
+        module.client, module.request_context = self.api(module)
+
+        spreadsheet = None
+        if args.snapshot:
+            data = module.load_snapshot_data()
+        else:
+            # The data is loaded from the tool's cache.json (in the working
+            # directory), so it's loaded again when the file changes, e.g.
+            # when the tool is run from the command line
+            cache_file = os.path.join(self.workdir, 'cache.json')
+            key = (args.account_id, args.enrollment_term_id, args.workload)
+            if args.refresh:
+                self.due_date_data.pop(key, None)
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+            if key in self.due_date_data and self.due_date_data[key][1] == self._mtime(cache_file):
+                METRICS.cache_hit('due_dates_memory')
+            else:
+                METRICS.cache_miss('due_dates_memory')
+                if args.pipeline:
+                    spreadsheet = module.DueDateSpreadsheet()
+                data = module.load_data(spreadsheet=spreadsheet)
+                self.due_date_data[key] = (data, self._mtime(cache_file))
+            data = self.due_date_data[key][0]
+        module.save_spreadsheet(filename=os.path.join(self.workdir, 'duedates.xls'), data=data, spreadsheet=spreadsheet)
+
+    def status(self):
+        return {
+            'workdir': self.workdir,
+            'uptime': round(time.time() - self.started_at, 1),
+            'loaded_tools': [tool for tool in sorted(REPORT_TOOLS.values()) if is_loaded(tool)],
+            'rubric_courses': sorted(self.rubric_data),
+            'due_date_accounts': [list(key) for key in sorted(self.due_date_data)],
+            'recent_reports': self.history[-10:],
+            'metrics': METRICS.summary(),
+        }
+
+class ReportRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    GET /status returns the state of the service; POST /reports/:name with a
+    JSON body {"args": [...]} runs a report.
+    '''
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            return self.send_json(200, self.server.service.status())
+        self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'reports':
+            return self.send_json(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or '{}')
+            argv = [str(arg) for arg in body.get('args', [])]
+        except (ValueError, AttributeError):
+            return self.send_json(400, {'error': 'The body must be a JSON object like {"args": ["1693"]}'})
+        try:
+            self.send_json(200, self.server.service.run(parts[1], argv))
+        except ReportError as e:
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            logger.error("Report %s %s failed:\n%s" % (parts[1], ' '.join(argv), traceback.format_exc()))
+            self.send_json(500, {'error': '%s: %s' % (e.__class__.__name__, e)})
+
+    def send_json(self, status, data):
+        body = json.dumps(data, sort_keys=True, indent=2)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ReportServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReportRequestHandler)
+        self.service = service
+
+def main():
+    parser = argparse.ArgumentParser(description='Local service that generates page view, rubric and due date reports, keeping their data in memory between reports.')
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. Default: 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on. Default: 8080")
+    parser.add_argument('--workdir', default='.', help="Directory for the caches and reports. Default: the current directory")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of API requests made at the same time by the rubric and due date reports. Default: 4")
+    parser.add_argument('--http_cache', metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags).")
+    parser.add_argument('--preload', nargs='*', default=[], choices=sorted(REPORT_TOOLS), help="Reports whose tools are imported at startup instead of on the first request.")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    # The tools read and write their caches in the current directory
+    os.chdir(args.workdir)
+    service = ReportService(os.getcwd(), concurrency=args.concurrency, http_cache=args.http_cache)
+    for report in args.preload:
+        load_tool(REPORT_TOOLS[report])
+
+    server = ReportServer((args.host, args.port), service)
+    logger.info("Report service listening on http://%s:%s (working directory %s)" % (args.host, args.port, service.workdir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,38 @@
 from settings.secure import OAUTH_TOKEN, CANVAS_URL
-from canvas_sdk.methods import submissions, assignments, courses
-from canvas_sdk.utils import get_all_list_data
-from canvas_sdk import RequestContext
 import sys
 import os.path
 import logging
 import json
 import argparse
-import xlwt
 import datetime
 
-logging.basicConfig() # you need to initialize logging, otherwise you will not see anything from requests
-logging.getLogger().setLevel(logging.DEBUG)
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.DEBUG)
-requests_log.propagate = True
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.imports import lazy_import
+from canvasutils.metrics import METRICS, instrument_request_context
+from canvasutils.logs import LazyJSON, LazyRepr, configure_logging, add_logging_arguments
+from canvasutils.store import EntityStore
+from canvasutils.pipeline import pipeline
+
+# The Canvas SDK and xlwt are only imported when they're used
+canvas_sdk = lazy_import('canvas_sdk')
+assignments = lazy_import('canvas_sdk.methods.assignments')
+courses = lazy_import('canvas_sdk.methods.courses')
+xlwt = lazy_import('xlwt')
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 def main():
     # Parse the CLI arguments
     parser = argparse.ArgumentParser(description='Gets assignment and submission data with rubric assessments for a given course.')
     parser.add_argument('course_id', type=int, help="The canvas course ID")
+    parser.add_argument('--concurrency', type=int, default=1, help="Number of assignments whose submissions are fetched at the same time. Defaults to 1.")
+    parser.add_argument('--metrics', type=str, metavar='PREFIX', help="Save request metrics as a JSON summary to PREFIX.json and a Prometheus textfile to PREFIX.prom.")
+    parser.add_argument('--http_cache', type=str, metavar='DIR', help="Keep API responses in DIR and only download them again if they changed (using ETags).")
+    parser.add_argument('--pipeline', action='store_true', help="Transform and write the spreadsheet columns of each assignment as soon as its submissions are fetched, while the next assignments download.")
+    parser.add_argument('--entity_store', type=str, metavar='DB', help="Save the students, assignments and submissions to the SQLite entity store DB (created if needed), shared with the other scripts.")
+    add_logging_arguments(parser)
     args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
     
     # Get the data from local cache or Canvas API
     course_id = args.course_id
@@ -32,27 +42,45 @@ def main():
     spreadsheet_filename = os.path.join(base_path, "%s.xls" % course_id)
     
     data = None
+    student_results = None
+    spreadsheet = None
     logger.info("Checking cache: %s" % cache_json_filename)
     if os.path.exists(cache_json_filename):
         logger.info("Loading data from file %s instead of fetching from %s" % (cache_json_filename, CANVAS_URL))
         with open(cache_json_filename, 'r') as f:
             data = json.load(f)
             data['_cache'] = False
+        METRICS.cache_hit('course_json')
     else:
+        METRICS.cache_miss('course_json')
         logger.info("Loading data from %s" % CANVAS_URL)
-        data = load_rubric_data(course_id)
+        from canvasutils.httpcache import ConditionalCache
+        http_cache = args.http_cache and ConditionalCache(args.http_cache) or None
+        if args.pipeline:
+            data, student_results, spreadsheet = load_rubric_data_pipelined(course_id, concurrency=args.concurrency, http_cache=http_cache)
+        else:
+            data = load_rubric_data(course_id, concurrency=args.concurrency, http_cache=http_cache)
         data['_cache'] = True
     
     # Save the raw API data (i.e. cache it) since it's expensive to load
     if data['_cache'] is True:
         save_json(filename=cache_json_filename, data=data)
+    if args.entity_store:
+        update_entity_store(args.entity_store, course_id, data)
+    METRICS.log_summary()
+    if args.metrics:
+        METRICS.save(args.metrics, labels={'script': 'rubricassessments', 'course_id': course_id})
     
     # Transform the data to a per-student assignment results (rubric assessments)
-    student_results = transform_rubric_data(data)
+    if student_results is None:
+        student_results = transform_rubric_data(data)
     save_json(filename=transformed_json_filename, data=student_results)
     
     # Create a spreadsheet of the results by student
-    save_rubric_spreadsheet(filename=spreadsheet_filename, student_results=student_results)
+    if spreadsheet is None:
+        save_rubric_spreadsheet(filename=spreadsheet_filename, student_results=student_results)
+    else:
+        spreadsheet.save(spreadsheet_filename)
     
     logger.info("Done.")
 
@@ -62,9 +90,9 @@ def get_students_list(request_context, course_id):
     
     https://canvas.instructure.com/doc/api/courses.html#method.courses.users
     '''
-    results = get_all_list_data(request_context, courses.list_users_in_course_users, course_id, "email", enrollment_type="student")
+    results = canvas_sdk.utils.get_all_list_data(request_context, courses.list_users_in_course_users, course_id, "email", enrollment_type="student")
     students = sorted([{"sortable_name":x['sortable_name'], "id": x['id']} for x in results], key=lambda x: x['sortable_name'])
-    logger.debug("Students in course: %s" % students)
+    logger.debug("Students in course: %s", LazyJSON(students))
     return list(students)
 
 def get_assignments_list(request_context, course_id):
@@ -73,36 +101,61 @@ def get_assignments_list(request_context, course_id):
 
     https://canvas.instructure.com/doc/api/assignments.html#method.assignments_api.index 
     '''
-    results = get_all_list_data(request_context, assignments.list_assignments, course_id, '')
-    logger.debug("Assignments List: %s" % [r['id'] for r in results]) 
+    results = canvas_sdk.utils.get_all_list_data(request_context, assignments.list_assignments, course_id, '')
+    logger.debug("Assignments List: %s", LazyRepr([r['id'] for r in results], max_items=50))
     return results
 
-def get_submissions_with_rubric_assessments(request_context, course_id, assignment_ids):
+def get_submissions_with_rubric_assessments(client, course_id, assignment_ids):
     '''
     Returns the submission and rubric assessment data for each assignment.
 
     https://canvas.instructure.com/doc/api/submissions.html#method.submissions_api.index
     '''
-    include = "rubric_assessment"
+    submissions_of = {}
+    for assignment_id, list_data in client.map(lambda assignment_id: fetch_submissions(client, course_id, assignment_id), assignment_ids):
+        logger.debug("Submissions for assignment %s: %s submissions %s", assignment_id, len(list_data), LazyJSON(list_data, max_items=3))
+        submissions_of[assignment_id] = list_data
+
     results = []
     for assignment_id in assignment_ids:
-        list_data = get_all_list_data(request_context, submissions.list_assignment_submissions_courses, course_id, assignment_id, include)
-        logger.debug("Submissions for assignment %s: %s" % (assignment_id, list_data))
         results.append({
             "assignment_id": assignment_id,
-            "submissions": list_data,
+            "submissions": submissions_of[assignment_id],
         })
     return results
 
-def load_rubric_data(course_id):
+def fetch_submissions(client, course_id, assignment_id):
+    '''Returns the submissions of an assignment with their rubric assessments.'''
+    url = '/courses/%s/assignments/%s/submissions' % (course_id, assignment_id)
+    params = {'include[]': 'rubric_assessment'}
+    fields = ['user_id', 'assignment_id', 'rubric_assessment']
+    return client.get_all(url, params=params, fields=fields)
+
+def connect(concurrency=1, http_cache=None, client=None, request_context=None):
+    '''
+    Returns a tuple (client, canvas_sdk request context), creating the ones
+    that aren't given. The API modules (and requests) are only imported
+    here, so runs that load the cached data don't pay for them.
+    '''
+    from canvasutils.client import CanvasClient, api_base_url
+    from canvasutils.httpcache import install_request_context
+    if request_context is None:
+        request_context = install_request_context(instrument_request_context(canvas_sdk.RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)), http_cache)
+    if client is None:
+        client = CanvasClient(api_base_url(CANVAS_URL), OAUTH_TOKEN, max_connections=concurrency, http_cache=http_cache)
+    return client, request_context
+
+def load_rubric_data(course_id, concurrency=1, http_cache=None, client=None, request_context=None):
     '''
-    Loads all data needed to work with rubric assessments.
+    Loads all data needed to work with rubric assessments. API responses go
+    through the http_cache (a ConditionalCache), if given. An existing
+    client and request context can be passed in to reuse their connections.
     '''
-    request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)
+    client, request_context = connect(concurrency, http_cache, client=client, request_context=request_context)
     students = get_students_list(request_context, course_id)
     assignments = get_assignments_list(request_context, course_id)
     assignment_ids = [assignment['id'] for assignment in assignments]
-    submissions = get_submissions_with_rubric_assessments(request_context, course_id, assignment_ids)
+    submissions = get_submissions_with_rubric_assessments(client, course_id, assignment_ids)
     data = {
         'assignments': assignments,
         'submissions': submissions,
@@ -110,6 +163,55 @@ def load_rubric_data(course_id):
     }
     return data
 
+def update_entity_store(path, course_id, data):
+    '''
+    Saves the students, assignments and submissions of the course to the
+    entity store at path.
+    '''
+    entity_store = EntityStore(path)
+    try:
+        entity_store.upsert_users(data['students'])
+        entity_store.replace_enrollments({course_id: [s['id'] for s in data['students']]}, 'StudentEnrollment')
+        entity_store.replace_assignments({course_id: data['assignments']})
+        entity_store.replace_submissions(course_id, dict([(s['assignment_id'], s['submissions']) for s in data['submissions']]))
+    finally:
+        entity_store.close()
+    logger.info("Saved the data of course %s to %s" % (course_id, path))
+
+def load_rubric_data_pipelined(course_id, concurrency=1, http_cache=None):
+    '''
+    Loads the same data as load_rubric_data(), transforming and writing the
+    spreadsheet columns of each assignment while the submissions of the next
+    assignments are fetched (by `concurrency` threads, see
+    canvasutils/pipeline.py). Returns a tuple (data, student results,
+    RubricSpreadsheet), ready to be saved.
+    '''
+    client, request_context = connect(concurrency, http_cache)
+    students = get_students_list(request_context, course_id)
+    assignments = get_assignments_list(request_context, course_id)
+    rubric_assignments = [a for a in assignments if 'rubric' in a]
+    rubric_index = dict([(a['id'], index) for index, a in enumerate(rubric_assignments)])
+    spreadsheet = RubricSpreadsheet([{'user_id': s['id'], 'sortable_name': s['sortable_name']} for s in students],
+                                    [len(a['rubric']) for a in rubric_assignments])
+
+    submissions_of = {}
+    graded_assignments = [None] * len(rubric_assignments)
+    fetch = lambda assignment: fetch_submissions(client, course_id, assignment['id'])
+    for assignment, list_data in pipeline(fetch, assignments, concurrency=concurrency):
+        logger.debug("Submissions for assignment %s: %s submissions %s", assignment['id'], len(list_data), LazyJSON(list_data, max_items=3))
+        submissions_of[assignment['id']] = list_data
+        if assignment['id'] in rubric_index:
+            index = rubric_index[assignment['id']]
+            graded_assignments[index] = grade_assignment(students, assignment, list_data)
+            spreadsheet.write_assignment(index, graded_assignments[index])
+
+    data = {
+        'assignments': assignments,
+        'submissions': [{"assignment_id": a['id'], "submissions": submissions_of[a['id']]} for a in assignments],
+        'students': students,
+    }
+    return data, combine_student_results(students, graded_assignments), spreadsheet
+
 def transform_rubric_data(data):
     '''
     Transforms the raw rubric assessment data so that it's grouped by
@@ -118,66 +220,59 @@ def transform_rubric_data(data):
     if not ('assignments' in data and 'submissions' in data):
         raise Exception("missing 'assignments' and 'submissions' in data")
 
-    # Setup students lookup by canvas user ID 
-    students = data['students']
-    students_dict = dict([(s['id'], s['sortable_name']) for s in students])
-
     # Filter assignments so we only consider those with rubrics
     # and can easily lookup an assignment by its ID.
+    students = data['students']
     assignments = [a for a in data['assignments'] if 'rubric' in a]
     assignment_ids = [a['id'] for a in assignments]
-    assignment_dict = dict([(a['id'], a) for a in assignments])
     submissions_dict = dict([
         (s['assignment_id'], s['submissions']) 
         for s in data['submissions'] 
         if s['assignment_id'] in assignment_ids])
 
-    # Group the assignments and rubric assessments by student
-    # based on the existing submission data.
+    graded_assignments = [grade_assignment(students, a, submissions_dict.get(a['id'], [])) for a in assignments]
+    return combine_student_results(students, graded_assignments)
+
+def grade_assignment(students, assignment, submissions):
+    '''
+    Returns the graded assignment of each student (in the order of the
+    students), with the rubric assessment of their submission merged into
+    the rubric. If a student either did not submit the assignment, or no
+    rubric assessment was present, the rubric assessment is blank. This
+    ensures that every student has every assignment and every assignment
+    has a rubric assessment (blank or otherwise).
+    '''
+    assignment_id = assignment['id']
+    assignment_name = assignment['name']
+    rubric_definition = assignment['rubric']
     by_student = {}
-    for assignment in assignments:
-        assignment_id = assignment['id']
-        assignment_name = assignment['name']
-        rubric_definition = assignment['rubric']
-        for submission in submissions_dict.get(assignment_id, []):
-            rubric_assessment = submission.get('rubric_assessment', None)
-            user_id = submission['user_id']
-            by_student.setdefault(user_id, {})
-            by_student[user_id][assignment_id] = {
-                'assignment_id': assignment_id,
-                'assignment_name': assignment_name,
-                'rubric': _merge_rubric(rubric_definition, rubric_assessment),
-            }
-
-    # Generate a complete list of students and their associated assignment
-    # rubric assessments. If a student either did not submit the assignment,
-    # or no rubric assessment was present, insert a blank rubric assessment
-    # for the assignment. This ensures that every student has every assignment
-    # and every assignment has a rubric assessment (blank or otherwise).
-    student_results = []
+    for submission in submissions:
+        by_student[submission['user_id']] = submission.get('rubric_assessment', None)
+
+    graded = []
     for student in students:
-        user_id = student['id']
-        user_name = student['sortable_name']
-        student_assignments = []
-        for assignment in assignments:
-            assignment_id = assignment['id']
-            assignment_name = assignment['name']
-            rubric_definition = assignment['rubric']
-            if user_id in by_student and assignment_id in by_student[user_id]:
-                student_assignments.append(by_student[user_id][assignment_id])
-            else:
-                student_assignments.append({
-                    'assignment_id': assignment_id,
-                    'assignment_name': assignment_name,
-                    'rubric': _merge_rubric(rubric_definition, None),
-                })
+        graded.append({
+            'assignment_id': assignment_id,
+            'assignment_name': assignment_name,
+            'rubric': _merge_rubric(rubric_definition, by_student.get(student['id'])),
+        })
+    return graded
+
+def combine_student_results(students, graded_assignments):
+    '''
+    Groups the graded assignments (see grade_assignment()) by student, and
+    returns a complete list of students and their associated assignment
+    rubric assessments.
+    '''
+    student_results = []
+    for index, student in enumerate(students):
         student_results.append({
-            'user_id': user_id,
-            'sortable_name': user_name,
-            'data': student_assignments,
+            'user_id': student['id'],
+            'sortable_name': student['sortable_name'],
+            'data': [graded[index] for graded in graded_assignments],
         })
 
-    logger.info(json.dumps(student_results, sort_keys=True, indent=2, separators=(',', ': ')))
+    logger.debug("Student results: %s", LazyJSON(student_results, max_items=5))
 
     return student_results
 
@@ -219,49 +314,81 @@ def save_rubric_spreadsheet(filename=None, student_results=None):
     if filename is None:
         raise Exception("Filename is required")
 
-    # Formats/Styles
-    bold_style = xlwt.easyxf('font: bold 1')
-    right_align = xlwt.easyxf("align: horiz right")
+    num_criteria = [len(graded_assignment['rubric']) for graded_assignment in (student_results and student_results[0]['data'] or [])]
+    spreadsheet = RubricSpreadsheet(student_results, num_criteria)
+    for assignment_idx in range(len(num_criteria)):
+        spreadsheet.write_assignment(assignment_idx, [student['data'][assignment_idx] for student in student_results])
+    spreadsheet.save(filename)
+
+class RubricSpreadsheet(object):
+    '''
+    Spreadsheet of the rubric assessments, with a row per student and a
+    comments and a points column for each criterion of each assignment.
+    The columns of each assignment can be written as soon as it's graded,
+    in any order.
+    '''
+    # Formats
     student_name_fmt = u'{sortable_name} ({user_id})'
     assignment_name_fmt = u'{assignment_name} ({assignment_id})'
     criteria_name_fmt = u'Criteria {num}: {description}'
-    
-    # Create workbook
-    wb = xlwt.Workbook(encoding="utf-8")
-    ws = wb.add_sheet('Assignments Sheet', cell_overwrite_ok=True)
-    ws.write(0,0, u'Assignment \u2192'.encode('utf-8'), right_align)
-    ws.write(1,0, u'Rubric \u2192'.encode('utf-8'), right_align)
-    ws.write(2,0, u'Students \u2193'.encode('utf-8'))
-    ws.col(0).width = 256 * max([len(student_name_fmt.format(**s)) for s in student_results])
-
-    # Insert the worksheet data
-    start_row, start_col = (3, 1)
-    header_inserted = {'assignment':{},'criteria':{}}
-    for user_idx, student in enumerate(student_results):
-        user_row = start_row + user_idx
-        ws.write(user_row, 0, student_name_fmt.format(**student))
-        graded_assignments = student['data']
+
+    def __init__(self, students, num_criteria):
+        '''
+        Parameters:
+        - students: a list of dicts with the "user_id" and "sortable_name" of each student
+        - num_criteria: the number of rubric criteria of each assignment
+        '''
+        # Styles
+        self.bold_style = xlwt.easyxf('font: bold 1')
+        self.right_align = xlwt.easyxf("align: horiz right")
+
+        # Create workbook
+        self.wb = xlwt.Workbook(encoding="utf-8")
+        self.ws = ws = self.wb.add_sheet('Assignments Sheet', cell_overwrite_ok=True)
+        ws.write(0,0, u'Assignment \u2192'.encode('utf-8'), self.right_align)
+        ws.write(1,0, u'Rubric \u2192'.encode('utf-8'), self.right_align)
+        ws.write(2,0, u'Students \u2193'.encode('utf-8'))
+        ws.col(0).width = 256 * max([len(self.student_name_fmt.format(**s)) for s in students])
+
+        # Insert the student names, and find the first column of each assignment
+        start_row, start_col = (3, 1)
+        self.user_rows = []
+        for user_idx, student in enumerate(students):
+            user_row = start_row + user_idx
+            ws.write(user_row, 0, self.student_name_fmt.format(**student))
+            self.user_rows.append(user_row)
+        self.assignment_cols = []
         assignment_col = start_col
-        for assignment_idx, graded_assignment in enumerate(graded_assignments):
+        for count in num_criteria:
+            self.assignment_cols.append(assignment_col)
+            assignment_col += 2 * count
+
+    def write_assignment(self, assignment_idx, graded_assignments):
+        '''Writes the columns of an assignment, given the graded assignment of each student.'''
+        ws = self.ws
+        assignment_col = self.assignment_cols[assignment_idx]
+        for user_row, graded_assignment in zip(self.user_rows, graded_assignments):
             criteria_col = assignment_col
             for criteria_idx, criteria in enumerate(graded_assignment['rubric']):
                 ws.write(user_row, criteria_col, criteria['comments'])
                 ws.write(user_row, criteria_col + 1, criteria['points'])
-                if criteria_col not in header_inserted['criteria']:
-                    criteria_label = criteria_name_fmt.format(num=criteria_idx+1, description=criteria['description'])
-                    ws.write_merge(1, 1, criteria_col, criteria_col + 1, criteria_label)
-                    ws.write(2, criteria_col, "Comments")
-                    ws.write(2, criteria_col + 1, "Points")
-                    header_inserted['criteria'][criteria_col] = True
                 criteria_col += 2
-            if assignment_col not in header_inserted['assignment']:
-                assignment_name = assignment_name_fmt.format(**graded_assignment)
-                ws.write_merge(0,  0, assignment_col, criteria_col - 1, assignment_name, bold_style)
-                header_inserted['assignment'][assignment_col] = True
-            assignment_col = criteria_col
+        if graded_assignments:
+            # Headers
+            graded_assignment = graded_assignments[0]
+            criteria_col = assignment_col
+            for criteria_idx, criteria in enumerate(graded_assignment['rubric']):
+                criteria_label = self.criteria_name_fmt.format(num=criteria_idx+1, description=criteria['description'])
+                ws.write_merge(1, 1, criteria_col, criteria_col + 1, criteria_label)
+                ws.write(2, criteria_col, "Comments")
+                ws.write(2, criteria_col + 1, "Points")
+                criteria_col += 2
+            assignment_name = self.assignment_name_fmt.format(**graded_assignment)
+            ws.write_merge(0,  0, assignment_col, criteria_col - 1, assignment_name, self.bold_style)
 
-    logger.info("Writing data to %s" % filename)
-    wb.save(filename)
+    def save(self, filename):
+        logger.info("Writing data to %s" % filename)
+        self.wb.save(filename)
 
 
 if __name__ == '__main__':
@@ -1,29 +1,177 @@
+'''
+Exports the names and emails of the students in one or more courses.
+
+Students enrolled in several of the courses are listed once, with the IDs of
+all their courses. Courses are given by ID, or by account (and term):
+
+    $ python get_users_emails.py 1693
+    $ python get_users_emails.py 1693 1694 1695 --format ndjson
+    $ python get_users_emails.py --account_id 1 --enrollment_term_id 24 --concurrency 8 --output roster.csv
+
+The csv and ndjson formats are written once every course has been fetched,
+since a student's row lists all of their courses. With --format memberships,
+one line per student and course is written as soon as each course arrives
+(students in several courses appear on several lines):
+
+    $ python get_users_emails.py --account_id 1 --format memberships --output memberships.ndjson
+'''
 from settings.secure import OAUTH_TOKEN, CANVAS_URL
-from canvas_sdk.methods import courses
-from canvas_sdk.utils import get_all_list_data
-from canvas_sdk import RequestContext
+import os
 import sys
+import csv
+import json
+import argparse
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from canvasutils.client import CanvasClient, CanvasClientError, api_base_url
+from canvasutils.metrics import METRICS
+from canvasutils.logs import configure_logging, add_logging_arguments
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ['id', 'name', 'sortable_name', 'email']
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports the names and emails of the students in one or more courses, one row per student.')
+    parser.add_argument('course_ids', type=int, nargs='*', help="The canvas course IDs")
+    parser.add_argument('--account_id', type=int, help="Export the courses of this account (in addition to course_ids)")
+    parser.add_argument('--enrollment_term_id', type=int, help="Only export the courses of the account in this term")
+    parser.add_argument('--enrollment_type', nargs='*', default=['student'], help="Enrollment types to export: student teacher ta observer designer. Defaults to student.")
+    parser.add_argument('--format', choices=['csv', 'ndjson', 'memberships'], default='csv', help="Output format: CSV with a header row, or one JSON object per line, one row per student; or memberships, one JSON object per student and course, written as each course is fetched. Defaults to csv.")
+    parser.add_argument('--output', type=str, help="File to write to. Defaults to stdout.")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of courses whose users are fetched at the same time. Defaults to 4.")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level, http_debug=args.debug_http)
+
+    if not args.course_ids and args.account_id is None:
+        parser.error("missing course_ids or --account_id")
+
+    client = CanvasClient(api_base_url(CANVAS_URL), OAUTH_TOKEN, max_connections=args.concurrency)
+    course_ids = list(args.course_ids)
+    if args.account_id is not None:
+        course_ids.extend(get_account_course_ids(client, args.account_id, args.enrollment_term_id))
+    course_ids = sorted(set(course_ids))
+    logger.info("Exporting the users of %d courses" % len(course_ids))
+
+    output = args.output and open(args.output, 'wb') or sys.stdout
+    try:
+        if args.format == 'memberships':
+            num_users, failed = write_memberships(output, iter_course_users(client, course_ids, args.enrollment_type))
+        else:
+            users, failed = get_course_users(client, course_ids, args.enrollment_type)
+            num_users = len(users)
+            if args.format == 'ndjson':
+                write_ndjson(output, users)
+            else:
+                write_csv(output, users)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    logger.info("Exported %d users of %d courses" % (num_users, len(course_ids) - len(failed)))
+    METRICS.log_summary()
+    if failed:
+        logger.error("Could not fetch the users of %d courses: %s" % (len(failed), ' '.join([str(c) for c in failed])))
+        sys.exit(1)
+
+def get_account_course_ids(client, account_id, enrollment_term_id=None):
+    '''
+    Returns the IDs of the courses in an account (and term).
+
+    https://canvas.instructure.com/doc/api/accounts.html#method.accounts.courses_api
+    '''
+    params = {}
+    if enrollment_term_id is not None:
+        params['enrollment_term_id'] = enrollment_term_id
+    return [course['id'] for course in client.iter_items('/accounts/%s/courses' % account_id, params=params, fields=['id'])]
+
+def iter_course_users(client, course_ids, enrollment_types):
+    '''
+    Fetches the users of the courses concurrently, and yields (course ID,
+    list of users) as each course arrives. The list is None if the course
+    couldn't be fetched.
+
+    https://canvas.instructure.com/doc/api/courses.html#method.courses.users
+    '''
+    url = '/courses/%s/users'
+    params = {'include[]': 'email', 'enrollment_type[]': enrollment_types}
+
+    def fetch_users(course_id):
+        try:
+            return client.get_all(url % course_id, params=params, fields=USER_FIELDS)
+        except CanvasClientError as e:
+            logger.warning("Could not fetch the users of course %s: %s" % (course_id, e))
+            return None
+
+    for index, (course_id, result) in enumerate(client.map(fetch_users, course_ids)):
+        if result is not None:
+            logger.info("Fetched %d users of course %s (%d of %d)" % (len(result), course_id, index + 1, len(course_ids)))
+        yield course_id, result
+
+def get_course_users(client, course_ids, enrollment_types):
+    '''
+    Fetches the users of the courses concurrently (see iter_course_users()),
+    and returns an index of the users by ID (each with the sorted IDs of
+    their courses), and the list of courses that couldn't be fetched.
+    '''
+    users = {}
+    failed = []
+    for course_id, result in iter_course_users(client, course_ids, enrollment_types):
+        if result is None:
+            failed.append(course_id)
+            continue
+        for user in result:
+            entry = users.get(user['id'])
+            if entry is None:
+                entry = users[user['id']] = dict(user, course_ids=[])
+            entry['course_ids'].append(course_id)
+    for entry in users.itervalues():
+        entry['course_ids'].sort()
+    return users, sorted(failed)
+
+def sorted_users(users):
+    '''Returns the users of the index sorted by email (users without an email last).'''
+    return sorted(users.itervalues(), key=lambda u: (u.get('email') is None, u.get('email'), u['id']))
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def write_csv(output, users):
+    '''Writes one row per user: email, name, user ID and course IDs (separated by spaces).'''
+    writer = csv.writer(output)
+    writer.writerow(['email', 'name', 'user_id', 'course_ids'])
+    for user in sorted_users(users):
+        writer.writerow([_utf8(user.get('email')), _utf8(user.get('name')), user['id'], ' '.join([str(c) for c in user['course_ids']])])
+
+def write_ndjson(output, users):
+    '''Writes one JSON object per line per user.'''
+    for user in sorted_users(users):
+        output.write(json.dumps(user, sort_keys=True))
+        output.write('\n')
+
+def write_memberships(output, course_users):
+    '''
+    Writes one JSON object per line per user and course (the user's fields
+    and course_id) as the courses arrive from iter_course_users(), flushing
+    the output after each course. Returns the number of distinct users and
+    the sorted list of courses that couldn't be fetched.
+    '''
+    user_ids = set()
+    failed = []
+    for course_id, result in course_users:
+        if result is None:
+            failed.append(course_id)
+            continue
+        for user in result:
+            user_ids.add(user['id'])
+            output.write(json.dumps(dict(user, course_id=course_id), sort_keys=True))
+            output.write('\n')
+        output.flush()
+    return len(user_ids), sorted(failed)
 
-# Get the course ID from the command line
-course_id = None
-if len(sys.argv) == 2:
-    course_id = sys.argv[1]
-else:
-    sys.exit("Error: missing course_id")
-
-# Setup the request context with a large pagination limit (minimize # of requests)
-request_context = RequestContext(OAUTH_TOKEN, CANVAS_URL, per_page=100)
-
-# NOTE: you must use get_all_list_data() in order to follow the paginated results
-# and get all the data.
-#
-# If you just call the method directly, you'll get a single page (max 100 results)
-# which may or may not include everyone if there are >100 students in the course.
-results = get_all_list_data(request_context, courses.list_users_in_course_users, course_id, "email", enrollment_type="student")
-
-# Extract and sort the results we want. 
-users = sorted([(x['email'], x['name']) for x in results], key=lambda x: x[0])
-
-# Print the names and emails in CSV foramt
-for idx, user in enumerate(users):
-    print "%s,%s" % user
+if __name__ == '__main__':
+    main()